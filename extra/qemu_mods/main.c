@@ -3641,12 +3641,13 @@ struct qemu_argument {
     const char *help;
 };
 
-extern int GLOBAL_parent_id, GLOBAL_start_clnum, GLOBAL_id;
+extern int GLOBAL_parent_id, GLOBAL_id;
+extern uint64_t GLOBAL_start_clnum;
 
 static void handle_arg_qirachild(const char *arg) {
   singlestep = 1; // always
 
-  int ret = sscanf(arg, "%d %d %d", &GLOBAL_parent_id, &GLOBAL_start_clnum, &GLOBAL_id);
+  int ret = sscanf(arg, "%d %"SCNu64" %d", &GLOBAL_parent_id, &GLOBAL_start_clnum, &GLOBAL_id);
   if (ret != 3) {
     printf("CORRUPT qirachild\n");
   }
@@ -444,8 +444,9 @@ static bool tci_compare64(uint64_t u0, uint64_t u1, TCGCond condition)
 struct change {
   uint64_t address;
   uint64_t data;
-  uint32_t changelist_number;
+  uint64_t changelist_number;
   uint32_t flags;
+  uint32_t padding;
 };
 
 // prototypes
@@ -457,7 +458,7 @@ void track_read(target_ulong base, target_ulong offset, target_ulong data, int s
 void track_write(target_ulong base, target_ulong offset, target_ulong data, int size);
 void add_pending_change(target_ulong addr, uint64_t data, uint32_t flags);
 void commit_pending_changes(void);
-void resize_change_buffer(size_t size);
+void map_change_chunk(uint64_t chunk);
 
 // defined in qemu.h
 //void track_kernel_read(void *host_addr, target_ulong guest_addr, long len);
@@ -474,24 +475,33 @@ void resize_change_buffer(size_t size);
 
 int GLOBAL_QIRA_did_init = 0;
 CPUArchState *GLOBAL_CPUArchState;
-struct change *GLOBAL_change_buffer;
 
-uint32_t GLOBAL_qira_log_fd;
-uint32_t GLOBAL_change_size;
+// the log is /tmp/qira_logs/N with just the logstate, and the changes in
+// N_chunk_0, N_chunk_1, ... of 1<<LOG_CHUNK_SHIFT entries, entry 0 is the header
+#define LOG_MAGIC "QIRALOG2"
+#define LOG_CHUNK_SHIFT 20
+#define LOG_CHUNK_ENTRIES ((uint64_t)1 << LOG_CHUNK_SHIFT)
+
+int GLOBAL_qira_log_fd = -1;
+char GLOBAL_qira_log_fn[PATH_MAX];
+struct change *GLOBAL_change_buffer = NULL;
+uint64_t GLOBAL_change_chunk;
 
 // current state that must survive forks
 struct logstate {
-  uint32_t change_count;
-  uint32_t changelist_number;
+  char magic[8];
+  uint64_t change_count;
+  uint64_t changelist_number;
+  uint64_t first_changelist_number;
   uint32_t is_filtered;
-  uint32_t first_changelist_number;
+  uint32_t chunk_shift;
   int parent_id;
   int this_pid;
 };
-struct logstate *GLOBAL_logstate;
+struct logstate *GLOBAL_logstate = NULL;
 
 // input args
-uint32_t GLOBAL_start_clnum = 1;
+uint64_t GLOBAL_start_clnum = 1;
 int GLOBAL_parent_id = -1, GLOBAL_id = -1;
 
 int GLOBAL_tracelibraries = 0;
@@ -505,19 +515,27 @@ FILE *GLOBAL_strace_file = NULL;
 #define PENDING_CHANGES_MAX_ADDR 0x100
 struct change GLOBAL_pending_changes[PENDING_CHANGES_MAX_ADDR/4];
 
-uint32_t get_current_clnum(void);
-uint32_t get_current_clnum(void) {
+uint64_t get_current_clnum(void);
+uint64_t get_current_clnum(void) {
   return GLOBAL_logstate->changelist_number;
 }
 
-void resize_change_buffer(size_t size) {
-  if(ftruncate(GLOBAL_qira_log_fd, size)) {
+void map_change_chunk(uint64_t chunk) {
+  const size_t size = LOG_CHUNK_ENTRIES * sizeof(struct change);
+  if (GLOBAL_change_buffer != NULL) munmap(GLOBAL_change_buffer, size);
+
+  // full size up front, QIRA only reads up to change_count
+  char fn[PATH_MAX];
+  sprintf(fn, "%s_chunk_%"PRIu64, GLOBAL_qira_log_fn, chunk);
+  int fd = open(fn, O_RDWR | O_CREAT, 0644);
+  if (ftruncate(fd, size)) {
     perror("ftruncate");
   }
   GLOBAL_change_buffer = mmap(NULL, size,
-         PROT_READ | PROT_WRITE, MAP_SHARED, GLOBAL_qira_log_fd, 0);
-  GLOBAL_logstate = (struct logstate *)GLOBAL_change_buffer;
-  if (GLOBAL_change_buffer == NULL) QIRA_DEBUG("MMAP FAILED!\n");
+         PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  if (GLOBAL_change_buffer == MAP_FAILED) QIRA_DEBUG("MMAP FAILED!\n");
+  close(fd);
+  GLOBAL_change_chunk = chunk;
 }
 
 void init_QIRA(CPUArchState *env, int id) {
@@ -531,20 +549,28 @@ void init_QIRA(CPUArchState *env, int id) {
   sprintf(fn, "/tmp/qira_logs/%d_strace", id);
   GLOBAL_strace_file = fopen(fn, "w");
 
-  sprintf(fn, "/tmp/qira_logs/%d", id);
-
-  // unlink it first
-  unlink(fn);
-  GLOBAL_qira_log_fd = open(fn, O_RDWR | O_CREAT, 0644);
-  GLOBAL_change_size = 1;
+  sprintf(GLOBAL_qira_log_fn, "/tmp/qira_logs/%d", id);
   memset(GLOBAL_pending_changes, 0, (PENDING_CHANGES_MAX_ADDR/4) * sizeof(struct change));
 
-  resize_change_buffer(GLOBAL_change_size * sizeof(struct change));
+  // after a fork these are still the parent's
+  if (GLOBAL_logstate != NULL) munmap(GLOBAL_logstate, sizeof(struct logstate));
+  if (GLOBAL_qira_log_fd != -1) close(GLOBAL_qira_log_fd);
+  map_change_chunk(0);
   memset(GLOBAL_change_buffer, 0, sizeof(struct change));
 
+  // unlink it first
+  unlink(GLOBAL_qira_log_fn);
+  GLOBAL_qira_log_fd = open(GLOBAL_qira_log_fn, O_RDWR | O_CREAT, 0644);
+  if (ftruncate(GLOBAL_qira_log_fd, sizeof(struct logstate))) {
+    perror("ftruncate");
+  }
+  GLOBAL_logstate = mmap(NULL, sizeof(struct logstate),
+         PROT_READ | PROT_WRITE, MAP_SHARED, GLOBAL_qira_log_fd, 0);
+
   // skip the first change
   GLOBAL_logstate->change_count = 1;
   GLOBAL_logstate->is_filtered = 0;
+  GLOBAL_logstate->chunk_shift = LOG_CHUNK_SHIFT;
   GLOBAL_logstate->this_pid = getpid();
 
   // do this after init_QIRA
@@ -552,6 +578,9 @@ void init_QIRA(CPUArchState *env, int id) {
   GLOBAL_logstate->first_changelist_number = GLOBAL_start_clnum;
   GLOBAL_logstate->parent_id = GLOBAL_parent_id;
 
+  // QIRA waits for the magic, so it goes last
+  memcpy(GLOBAL_logstate->magic, LOG_MAGIC, sizeof(GLOBAL_logstate->magic));
+
   // use all fds up to 30
   int i;
   int dupme = open("/dev/null", O_RDONLY);
@@ -568,15 +597,14 @@ void init_QIRA(CPUArchState *env, int id) {
 }
 
 struct change *add_change(target_ulong addr, uint64_t data, uint32_t flags) {
-  int cc = __sync_fetch_and_add(&GLOBAL_logstate->change_count, 1);
+  uint64_t cc = __sync_fetch_and_add(&GLOBAL_logstate->change_count, 1);
 
-  if (cc == GLOBAL_change_size) {
-    // double the buffer size
-    QIRA_DEBUG("doubling buffer with size %d\n", GLOBAL_change_size);
-    resize_change_buffer(GLOBAL_change_size * sizeof(struct change) * 2);
-    GLOBAL_change_size *= 2;
+  if ((cc >> LOG_CHUNK_SHIFT) != GLOBAL_change_chunk) {
+    // on to the next chunk file
+    QIRA_DEBUG("starting chunk %"PRIu64"\n", cc >> LOG_CHUNK_SHIFT);
+    map_change_chunk(cc >> LOG_CHUNK_SHIFT);
   }
-  struct change *this_change = GLOBAL_change_buffer + cc;
+  struct change *this_change = GLOBAL_change_buffer + (cc & (LOG_CHUNK_ENTRIES-1));
   this_change->address = (uint64_t)addr;
   this_change->data = data;
   this_change->changelist_number = GLOBAL_logstate->changelist_number;
@@ -739,18 +767,28 @@ int get_next_id(void) {
   return this_id;
 }
 
-int run_QIRA_log_from_fd(CPUArchState *env, int qira_log_fd, uint32_t to_change);
-int run_QIRA_log_from_fd(CPUArchState *env, int qira_log_fd, uint32_t to_change) {
+int run_QIRA_log_from_file(CPUArchState *env, const char *fn, struct logstate *plogstate, uint64_t to_change);
+int run_QIRA_log_from_file(CPUArchState *env, const char *fn, struct logstate *plogstate, uint64_t to_change) {
   struct change pchange;
-  // skip the first change
-  lseek(qira_log_fd, sizeof(pchange), SEEK_SET);
+  char chunk_fn[PATH_MAX];
+  uint64_t chunk_entries = (uint64_t)1 << plogstate->chunk_shift;
+  int qira_log_fd = -1;
   int ret = 0;
-  while(1) {
+  // skip the first change
+  uint64_t i;
+  for (i = 1; i < plogstate->change_count; i++) {
+    if ((i & (chunk_entries-1)) == 0 || qira_log_fd == -1) {
+      if (qira_log_fd != -1) close(qira_log_fd);
+      sprintf(chunk_fn, "%s_chunk_%"PRIu64, fn, i >> plogstate->chunk_shift);
+      qira_log_fd = open(chunk_fn, O_RDONLY);
+      if (qira_log_fd == -1) break;
+      lseek(qira_log_fd, (i & (chunk_entries-1)) * sizeof(pchange), SEEK_SET);
+    }
     if (read(qira_log_fd, &pchange, sizeof(pchange)) != sizeof(pchange)) { break; }
     uint32_t flags = pchange.flags;
     if (!(flags & IS_VALID)) break;
     if (pchange.changelist_number >= to_change) break;
-    QIRA_DEBUG("running old change %lX %d\n", pchange.address, pchange.changelist_number);
+    QIRA_DEBUG("running old change %lX %"PRIu64"\n", pchange.address, pchange.changelist_number);
 
 #ifdef QEMU_USER
 #ifdef R_EAX
@@ -776,58 +814,55 @@ int run_QIRA_log_from_fd(CPUArchState *env, int qira_log_fd, uint32_t to_change)
 #endif
     ret++;
   }
+  if (qira_log_fd != -1) close(qira_log_fd);
+  return ret;
+}
+
+int read_QIRA_logstate(const char *fn, struct logstate *plogstate);
+int read_QIRA_logstate(const char *fn, struct logstate *plogstate) {
+  int qira_log_fd = open(fn, O_RDONLY);
+  if (qira_log_fd == -1) return 0;
+  int ret = read(qira_log_fd, plogstate, sizeof(*plogstate)) == sizeof(*plogstate) &&
+            memcmp(plogstate->magic, LOG_MAGIC, sizeof(plogstate->magic)) == 0;
+  close(qira_log_fd);
   return ret;
 }
 
 void run_QIRA_mods(CPUArchState *env, int this_id);
 void run_QIRA_mods(CPUArchState *env, int this_id) {
   char fn[PATH_MAX];
+  struct logstate plogstate;
   sprintf(fn, "/tmp/qira_logs/%d_mods", this_id);
-  int qira_log_fd = open(fn, O_RDONLY);
-  if (qira_log_fd == -1) return;
-
-  // seek past the header
-  lseek(qira_log_fd, sizeof(struct logstate), SEEK_SET);
+  if (!read_QIRA_logstate(fn, &plogstate)) return;
 
   // run all the changes in this file
-  int count = run_QIRA_log_from_fd(env, qira_log_fd, 0xFFFFFFFF);
-
-  close(qira_log_fd);
+  int count = run_QIRA_log_from_file(env, fn, &plogstate, ~(uint64_t)0);
 
   printf("+++ REPLAY %d MODS DONE with entry count %d\n", this_id, count);
 }
 
-void run_QIRA_log(CPUArchState *env, int this_id, int to_change);
-void run_QIRA_log(CPUArchState *env, int this_id, int to_change) {
+void run_QIRA_log(CPUArchState *env, int this_id, uint64_t to_change);
+void run_QIRA_log(CPUArchState *env, int this_id, uint64_t to_change) {
   char fn[PATH_MAX];
   sprintf(fn, "/tmp/qira_logs/%d", this_id);
 
-  int qira_log_fd, qira_log_fd_ = open(fn, O_RDONLY);
-  // qira_log_fd_ must be 30, if it isn't, i'm not sure what happened
-  dup2(qira_log_fd_, 100+this_id);
-  close(qira_log_fd_);
-  qira_log_fd = 100+this_id;
-
   struct logstate plogstate;
-  if (read(qira_log_fd, &plogstate, sizeof(plogstate)) != sizeof(plogstate)) {
+  if (!read_QIRA_logstate(fn, &plogstate)) {
     printf("HEADER READ ISSUE!\n");
     return;
   }
 
-  printf("+++ REPLAY %d START on fd %d(%d)\n", this_id, qira_log_fd, qira_log_fd_);
+  printf("+++ REPLAY %d START\n", this_id);
 
   // check if this one has a parent and recurse here
-  // BUG: FD ISSUE!
-  QIRA_DEBUG("parent is %d with first_change %d\n", plogstate.parent_id, plogstate.first_changelist_number);
+  QIRA_DEBUG("parent is %d with first_change %"PRIu64"\n", plogstate.parent_id, plogstate.first_changelist_number);
   if (plogstate.parent_id != -1) {
     run_QIRA_log(env, plogstate.parent_id, plogstate.first_changelist_number);
   }
 
-  int count = run_QIRA_log_from_fd(env, qira_log_fd, to_change);
-
-  close(qira_log_fd);
+  int count = run_QIRA_log_from_file(env, fn, &plogstate, to_change);
 
-  printf("+++ REPLAY %d DONE to %d with entry count %d\n", this_id, to_change, count);
+  printf("+++ REPLAY %d DONE to %"PRIu64" with entry count %d\n", this_id, to_change, count);
 }
 
 bool is_filtered_address(target_ulong pc, bool ignore_gatetrace);
@@ -864,7 +899,7 @@ void target_disas(FILE *out, CPUArchState *env, target_ulong code, target_ulong
 
 
 int GLOBAL_last_was_syscall = 0;
-uint32_t GLOBAL_last_fork_change = -1;
+uint64_t GLOBAL_last_fork_change = -1;
 target_long last_pc = 0;
 
 void write_out_base(CPUArchState *env, int id);
@@ -992,7 +1027,7 @@ uintptr_t tcg_qemu_tb_exec(CPUArchState *env, uint8_t *tb_ptr)
     }
 
 
-    QIRA_DEBUG("set changelist %d at %x(%d)\n", GLOBAL_logstate->changelist_number, tb->pc, tb->size);
+    QIRA_DEBUG("set changelist %"PRIu64" at %x(%d)\n", GLOBAL_logstate->changelist_number, tb->pc, tb->size);
 #endif
 
     long tcg_temps[CPU_TEMP_BUF_NLONGS];
@@ -28,6 +28,8 @@ if __name__ == '__main__':
   parser.add_argument("--web-port", metavar="PORT", help="listen port for web interface. 3002 by default", type=int, default=qira_config.WEB_PORT)
   parser.add_argument("--socat-port", metavar="PORT", help="listen port for socat. 4000 by default", type=int, default=qira_config.SOCAT_PORT)
   parser.add_argument('-S', '--static', help="enable static2", action="store_true")
+  parser.add_argument("--value-index", help="index the values in the trace, for searching by value", action="store_true")
+  parser.add_argument("--memory-budget", metavar="MB", help="spill the coldest parts of the trace indexes to disk past this much memory", type=int, default=0)
   #capstone flag in qira_config for now
 
   # parse arguments, first try
@@ -68,6 +70,11 @@ if __name__ == '__main__':
   if args.static:
     print("*** using static")
     qira_config.WITH_STATIC = True
+  if args.value_index:
+    qira_config.VALUE_INDEX = True
+  if args.memory_budget < 0:
+    raise Exception("--memory-budget can't be negative")
+  qira_config.MEMORY_BUDGET = args.memory_budget * 1024 * 1024
   if args.flush_cache:
     print("*** flushing caches")
     os.system("rm -rfv /tmp/qira*")
@@ -7,6 +7,10 @@ import time
 import math
 import sys
 import struct
+import bisect
+import collections
+import qiradb
+from array import array
 
 from PIL import Image
 import base64
@@ -278,21 +282,22 @@ def get_depth_map(fxns, maxclnum):
     dmap.append(thisd)
   return dmap
 
+# clnums per fetch_changes_range call, so the webserver still gets a turn
+FLOW_CHUNK = 100000
+
 def get_instruction_flow(trace, program, minclnum, maxclnum):
   start = time.time()
   ret = []
-  for i in range(minclnum, maxclnum):
-    r = trace.db.fetch_changes_by_clnum(i, 1)
-    if len(r) != 1:
-      continue
-    
-    # this will trigger the disassembly
-    instr = program.static[r[0]['address']]['instruction']
-    ins = str(instr)
-    ret.append((r[0]['address'], r[0]['data'], r[0]['clnum'], ins))
-    if (time.time() - start) > 0.01:
-      time.sleep(0.01)
-      start = time.time()
+  for clstart in range(minclnum, maxclnum, FLOW_CHUNK):
+    r = trace.db.fetch_changes_range(clstart, min(clstart+FLOW_CHUNK, maxclnum), "I", 1)
+    for (address, data, clnum) in zip(r['address'], r['data'], r['clnum']):
+      # this will trigger the disassembly
+      instr = program.static[address]['instruction']
+      ins = str(instr)
+      ret.append((address, data, clnum, ins))
+      if (time.time() - start) > 0.01:
+        time.sleep(0.01)
+        start = time.time()
 
   return ret
 
@@ -336,56 +341,150 @@ def guess_calling_conv(program,readregs,readstack):
 
   return ('UNKNOWN',0)
 
-def analyse_calls(trace):
-  program = trace.program
-  for (addr,data,clnum,ins) in trace.flow:
-    instr = program.static[addr]['instruction']
-    if not instr.is_call():
-      continue
-
-    endclnum = get_last_instr(trace.dmap,clnum)
-    if endclnum is None:
-      continue
-
+class CallFrame(object):
+  # a call that hasn't returned yet, with what's known about what it did so far
+  def __init__(self, clnum, depth, regs, esp):
+    self.clnum = clnum
+    self.depth = depth
+    # at the call
+    self.regs = regs
+    self.esp = esp
+    # per register, 'R' or 'W' for the first thing it did to it
+    self.first = [None]*len(regs)
+    # the highest address in the argument range of the stack it loaded or stored
+    self.seen = 0
+
+class CallSweep(object):
+  # analyses every call in one pass forward through the trace, a call is done when it returns
+  # a change is seen once however deep the call stack, what each open call needs from it is kept so it's cheap:
+  #  the calls that haven't touched a register yet are the newest ones, so per register only how far down
+  #   the stack they start is kept
+  #  likewise for the calls that had a register hold v at the call, and whether it was written back to v
+  #  the calls a stack access can be an argument to are found with a bisect, the stack grows down so
+  #   the newer a call the lower its esp
+  def __init__(self, trace):
+    self.trace = trace
+    self.program = trace.program
+    self.minclnum = trace.db.get_minclnum()
+    # the next clnum to look at
+    self.clnum = self.minclnum
+    self.is_call = {}
+    self.frames = []
+    # -esp of every frame, in the same order
+    self.negesps = []
+    # per register, the frames from here up haven't touched it
+    self.undecided = [0]*len(self.program.tregs[0])
+    # (register, value at the call) -> [the frames, how many of them saw it written back]
+    self.writebacks = {}
+
+    arch = self.program.static['arch']
+    self.abi = arch in ["i386","x86-64","arm"]
+    if self.abi:
+      self.stack_reg = self.program.tregs[0].index(["ESP","RSP","SP"][["i386","x86-64","arm"].index(arch)])
+
+  def run(self):
+    trace = self.trace
+    dmap = trace.dmap
+    # the depth after a clnum is needed to know if it returned, and the last one in dmap isn't final
+    endclnum = self.minclnum + len(dmap) - 2
+    start = time.time()
+    for clstart in range(self.clnum, endclnum, FLOW_CHUNK):
+      r = trace.db.fetch_changes_range(clstart, min(clstart+FLOW_CHUNK, endclnum), "ILSRW" if self.abi else "I")
+      last = None
+      for (address, data, clnum, typ) in zip(r['address'], r['data'], r['clnum'], r['type']):
+        if typ == 'I':
+          if last != None:
+            self.end_clnum(last)
+          last = (address, clnum)
+          # the ret isn't part of the call
+          depth = dmap[clnum+1 - self.minclnum]
+          while len(self.frames) > 0 and 0 <= depth <= self.frames[-1].depth:
+            self.pop()
+        elif typ in "RW":
+          self.register(address // self.program.tregs[1], typ, data)
+        else:
+          self.memory(address)
+        if (time.time() - start) > 0.01:
+          time.sleep(0.01)
+          start = time.time()
+      if last != None:
+        self.end_clnum(last)
+    self.clnum = max(self.clnum, endclnum)
+
+  def end_clnum(self, last):
+    (address, clnum) = last
+    if address not in self.is_call:
+      self.is_call[address] = self.program.static[address]['instruction'].is_call()
+    if not self.is_call[address]:
+      return
+    # only the abi needs what it did
+    regs = self.trace.db.fetch_registers(clnum) if self.abi else []
+    frame = CallFrame(clnum, self.trace.dmap[clnum - self.minclnum], regs, regs[self.stack_reg] if self.abi else 0)
+    self.frames.append(frame)
+    self.negesps.append(-frame.esp)
+    for (reg, value) in enumerate(regs):
+      self.writebacks.setdefault((reg, value), [[], 0])[0].append(frame)
+    # it can return right away
+    depth = self.trace.dmap[clnum+1 - self.minclnum]
+    if 0 <= depth <= frame.depth:
+      self.pop()
+
+  def register(self, reg, typ, data):
+    if reg >= len(self.undecided):
+      return
+    for i in range(self.undecided[reg], len(self.frames)):
+      self.frames[i].first[reg] = typ
+    self.undecided[reg] = len(self.frames)
+    if typ == 'W' and (reg, data) in self.writebacks:
+      wb = self.writebacks[(reg, data)]
+      wb[1] = len(wb[0])
+
+  def memory(self, address):
+    rsize = self.program.tregs[1]
+    # esp+rsize <= address <= esp+rsize*11
+    lo = bisect.bisect_left(self.negesps, rsize - address)
+    hi = bisect.bisect_right(self.negesps, rsize*11 - address)
+    for i in range(lo, hi):
+      self.frames[i].seen = max(self.frames[i].seen, address)
+
+  def pop(self):
+    frame = self.frames.pop()
+    self.negesps.pop()
+    for reg in range(len(self.undecided)):
+      self.undecided[reg] = min(self.undecided[reg], len(self.frames))
+    # read before it was written, unless it was only saved and restored
+    uninit_regs = set()
+    for (reg, value) in enumerate(frame.regs):
+      wb = self.writebacks[(reg, value)]
+      if frame.first[reg] == 'R' and wb[1] < len(wb[0]):
+        uninit_regs.add(reg)
+      wb[0].pop()
+      wb[1] = min(wb[1], len(wb[0]))
+      if len(wb[0]) == 0:
+        del self.writebacks[(reg, value)]
+    self.analyse(frame, uninit_regs)
+
+  def analyse(self, frame, uninit_regs):
+    program = self.program
     #the function ran from start to ret... analyze what happened in there
-    regs = trace.db.fetch_registers(clnum)
-    iptr = trace.db.fetch_changes_by_clnum(clnum+1, 1)[0]['address']
+    iptr = self.trace.db.fetch_changes_by_clnum(frame.clnum+1, 1)[0]['address']
 
     program.static.analyzer.make_function_at(program.static,iptr)
     func = program.static[iptr]['function']
 
-    if program.static['arch'] in ["i386","x86-64","arm"]:
-      stack_reg = ["ESP","RSP","SP"][["i386","x86-64","arm"].index(program.static['arch'])]
-      esp = regs[program.tregs[0].index(stack_reg)]
-
-      nregs = len(regs)
+    if self.abi:
       rsize = program.tregs[1]
-
-      argrange = [esp+rsize,esp+rsize*11]
-      seen = 0
-      init_regs = set()
-      uninit_regs = set()
-      for cl in range(clnum+1,endclnum):
-        changes = filter(lambda x:x['type'] in "LS",trace.db.fetch_changes_by_clnum(cl, -1))
-        argchanges = list(filter(lambda x:argrange[0] <= x['address'] <= argrange[1], changes))
-        if len(argchanges) > 0:
-          seen = max(max(map(lambda x:x['address'],argchanges)),seen)
-        rchanges = filter(lambda x:x['type'] in "RW",trace.db.fetch_changes_by_clnum(cl, -1))
-        for rchange in rchanges:
-          regnum = rchange['address']//rsize
-          if rchange['type'] is 'W' and regnum < nregs:
-            init_regs.add(regnum)
-            if ((regnum) in uninit_regs) and (rchange['data'] == regs[regnum]):
-              #if we thought they did an uninitialized read and they just clobbered it and wrote it later,
-              #don't consider this a possible argument
-              uninit_regs.remove(regnum)
-          elif (rchange['type'] is 'R' and regnum < nregs) and (regnum not in init_regs):
-            uninit_regs.add(regnum)
-      abi,nargs = guess_calling_conv(program,uninit_regs,((seen-esp)/rsize) if (seen > 0) else 0)
-      if func.abi is 'UNKNOWN':
+      abi,nargs = guess_calling_conv(program,uninit_regs,((frame.seen-frame.esp)//rsize) if (frame.seen > 0) else 0)
+      if func.abi == 'UNKNOWN':
         func.abi = abi
       func.nargs = max(nargs,func.nargs)
 
+def analyse_calls(trace, sweep=None):
+  # sweep is what the last call returned, it picks up where that one stopped
+  if sweep is None:
+    sweep = CallSweep(trace)
+  sweep.run()
+  return sweep
 
 def display_call_args(instr,trace,clnum):
   program = trace.program
@@ -423,79 +522,104 @@ def display_call_args(instr,trace,clnum):
     ret += ["-> " + ghex(endregs[program.tregs[0].index(outp)])]
   return " ".join(ret)
 
-#finds first occurence of a in l from the right
-#assumes a in l
-def rindex(l, a):
-  return len(l) - l[::-1].index(a) - 1
+class DepthMap(object):
+  # get_hacked_depth_map fed the flow a piece at a time, the return stack is carried between pieces
+  # dmap only grows, so the webserver can keep reading it while a piece is added
+  def __init__(self, program):
+    self.program = program
+    # branch delay slot
+    self.native = qiradb.PyDepthMap(program.tregs[3][:4] == "mips")
+    # the pcs the native one has been told about, only a new one is looked up in static
+    self.seen = set()
+    self.maxd = 0
+    # the last one is the depth after the last instruction so far
+    self.dmap = array('i', [0, 0])
+
+  def add(self, flow):
+    if len(flow) == 0:
+      return array('i')
+    (addresses, lengths, clnums, _) = zip(*flow)
+    for address in set(addresses) - self.seen:
+      if self.program.static[address]['instruction'].is_call():
+        self.native.set_call(address)
+      self.seen.add(address)
+    ret = self.native.add(addresses, lengths, clnums)
+    self.maxd = max(self.maxd, max(ret))
+    # in one go, it's never shorter than before
+    self.dmap[-1:] = ret
+    return ret[:-1]
 
 def get_hacked_depth_map(flow, program):
-  start = time.time()
-  return_stack = []
-  ret = [0]
-  last_clnum = None
-
-  branch_delay = False
-  for (address, length, clnum, ins) in flow:
-    # handing missing changes
-    if last_clnum != None and clnum != last_clnum+1:
-      for i in range(clnum-last_clnum-1):
-        ret.append(-1)
-    last_clnum = clnum
-
-    if address in return_stack:
-      return_stack = return_stack[:rindex(return_stack, address)]
-    # ugh, so gross
-    if branch_delay:
-        ret.append(len(return_stack)-1)
-        branch_delay = False
-    else:
-        ret.append(len(return_stack))
-
-    instr = program.static[address]['instruction']
-    if instr.is_call():
-      if program.tregs[3][:4] == "mips":
-        # branch delay slot
-        branch_delay = True
-        ret_offset = length*2
-      else:
-        ret_offset = length
-      return_stack.append(address+ret_offset)
-
-    if (time.time() - start) > 0.01:
-      time.sleep(0.01)
-      start = time.time()
-  ret.append(len(return_stack))  # missing last instruction
-  return ret
-
-def get_vtimeline_picture(trace, minclnum, maxclnum):
-  if trace.maxd == 0:
-    return None
-
-  r = maxclnum-minclnum
-  sampling = int(math.ceil(r/50000.0))
-
-  im_y = int(maxclnum/sampling)
-  im = Image.new( 'RGB', (1, im_y), "black")
-  px = im.load()
-
-  for i in range(0, r, sampling):
-    # could average the sampled
-    try:
-      if trace.dmap[i] == -1:
-        raise Exception("nope")
-      c = int((trace.dmap[i]*128.0)/trace.maxd)
-      if i/sampling < im_y:
-        px[0, i/sampling] = (0,c,c)
-    except:
-      # make missing changes red
-      if i/sampling < im_y:
-        px[0, i/sampling] = (96, 32, 32)
-
-  buf = StringIO()
-  im.save(buf, format='PNG')
-
-  dat = b"data:image/png;base64,"+base64.b64encode(buf.getvalue())
-  return dat.decode('utf-8')
+  dm = DepthMap(program)
+  dm.add(flow)
+  return dm.dmap
+
+# rows in a vtimeline tile
+VTIMELINE_TILE = 256
+
+class VtimelineTiles(object):
+  # the depth map as a pyramid of tiles, a row of a level k tile is every 2**k th clnum
+  # the client asks for the tiles of its view at the level that fits its scale, so it's never stretched
+  # a tile is rendered when it's asked for, and kept once the trace is past its end
+  def __init__(self, trace):
+    self.trace = trace
+    self.tiles = {}
+    # the colors are scaled to it, the tiles go when it changes
+    self.maxd = None
+
+  def get_level(self, cscale):
+    # the most clnums a row can have and still be at least a pixel
+    if cscale < 2:
+      return 0
+    return int(math.floor(math.log(cscale, 2)))
+
+  def get_tiles(self, clstart, clend, cscale):
+    # [(clstart, clend, png data url)] of the tiles that cover [clstart, clend)
+    trace = self.trace
+    if trace.maxd == 0 or trace.minclnum == None:
+      return []
+    if self.maxd != trace.maxd:
+      self.tiles = {}
+      self.maxd = trace.maxd
+    level = self.get_level(cscale)
+    span = VTIMELINE_TILE << level
+    # the analysis thread moves them on
+    (minclnum, maxclnum) = (trace.minclnum, trace.maxclnum)
+    r = maxclnum - minclnum
+    clstart = max(clstart, minclnum) - minclnum
+    clend = min(clend, maxclnum) - minclnum
+    ret = []
+    for n in range(clstart // span, (clend + span - 1) // span):
+      dat = self.tiles.get((level, n))
+      if dat == None:
+        (dat, fits) = self.render(level, n, r)
+        # the last one still grows
+        if fits and (n+1)*span <= r:
+          self.tiles[(level, n)] = dat
+      ret.append((minclnum + n*span, minclnum + (n+1)*span, dat))
+    return ret
+
+  def render(self, level, n, r):
+    # the png of the tile with the first r clnums of the trace, and if it was scaled right to keep
+    step = 1 << level
+    start = n * (VTIMELINE_TILE << level)
+    rows = self.trace.dmap[start:min(start + (VTIMELINE_TILE << level), r):step]
+    # dmap can be ahead of maxd while the analysis updates, deeper is drawn as maxd and not kept
+    fits = len(rows) == 0 or max(rows) <= self.maxd
+    # a row is every step th clnum, it could average them
+    colors = [bytes(bytearray((0, c, c))) for c in [int((d*128.0)/self.maxd) for d in range(self.maxd+1)]]
+    # make missing changes red, at -1
+    colors.append(bytes(bytearray((96, 32, 32))))
+    # past the end of the trace is black
+    im = Image.new('RGB', (1, VTIMELINE_TILE), "black")
+    if len(rows) > 0:
+      im.paste(Image.frombytes('RGB', (1, len(rows)), b"".join(colors[min(d, self.maxd)] for d in rows)), (0, 0))
+
+    buf = StringIO()
+    im.save(buf, format='PNG')
+
+    dat = b"data:image/png;base64,"+base64.b64encode(buf.getvalue())
+    return (dat.decode('utf-8'), fits)
 
 def analyze(trace, program):
   minclnum = trace.db.get_minclnum()
@@ -522,43 +646,39 @@ def analyze(trace, program):
   #loops = do_loop_analysis(blocks)
   #print loops
 
-def slice(trace, inclnum):
-  def is_store(r):
-    return r['type'] == "W" or r['type'] == "S"
-  def is_load(r):
-    return r['type'] == "R" or r['type'] == "L"
-  def get_stores(clnum):
-    return set(map(lambda x: x['address'], filter(is_store, trace.db.fetch_changes_by_clnum(clnum, 100))))
-  def get_loads(clnum):
-    return set(map(lambda x: x['address'], filter(is_load, trace.db.fetch_changes_by_clnum(clnum, 100))))
-
-  clnum = inclnum
-  st = get_loads(clnum)
-  cls = [clnum]
-
-  # so only things before this can affect it
-  while clnum > max(0, inclnum-100):
-    st.discard(0x10)  # never follow the stack, X86 HAXX
-    if len(trace.db.fetch_changes_by_clnum(clnum, 100)) > 20:
-      break
-    overwrite = st.intersection(get_stores(clnum))
-    if len(overwrite) > 0:
-      st = st.difference(overwrite)
-      st = st.union(get_loads(clnum))
-      cls.append(clnum)
-      #print clnum, overwrite, st
-    
-    """
-    r = trace.db.fetch_changes_by_clnum(clnum, 100)
-    for e in r:
-      print e
-    """
-
-    clnum -= 1
-
-  cls = set(cls)
-  cls.discard(inclnum)
-  return list(cls)
+# how long the slice shown with the instructions gets, it's whatever was found by then
+SLICE_BUDGET = 0.02
+
+def get_stack_registers(program):
+  # never follow the stack pointer, everything reads it
+  return [i*program.tregs[1] for (i, name) in enumerate(program.tregs[0]) if name in ["ESP", "RSP", "SP"]]
+
+def slice(trace, inclnum, forward=False, budget=SLICE_BUDGET):
+  s = trace.db.slice(inclnum, forward, get_stack_registers(trace.program))
+  return s.step(0, budget)
+
+class SliceCache(object):
+  # the instruction view asks for the slice of the selected clnum every time it moves
+  # a slice is kept per (clnum, direction), an ask goes on from where the last one stopped until it's done
+  # a slice back doesn't change as the trace grows, so they're kept until it starts over
+  def __init__(self, trace, size=16):
+    self.trace = trace
+    self.size = size
+    # (clnum, forward) -> (the native slice, the clnums it found so far), the newest last
+    self.slices = collections.OrderedDict()
+
+  def get(self, clnum, forward=False, budget=SLICE_BUDGET):
+    # taken out while it's stepped, so another ask at the same time can't step it too
+    ent = self.slices.pop((clnum, forward), None)
+    if ent == None:
+      ent = (self.trace.db.slice(clnum, forward, get_stack_registers(self.trace.program)), set())
+    (s, found) = ent
+    if not s.done():
+      found.update(s.step(0, budget))
+    self.slices[(clnum, forward)] = ent
+    while len(self.slices) > self.size:
+      self.slices.popitem(last=False)
+    return found
 
 if __name__ == "__main__":
   # can run standalone for testing
@@ -20,3 +20,9 @@ STATIC_CACHE_BASE = "/tmp/qira_static_cache/"
 
 WEBSOCKET_DEBUG = False
 
+# index every loaded, stored and written value, for searchvalue
+VALUE_INDEX = False
+
+# bytes of index the traces keep in memory before spilling the coldest parts to disk, 0 for no limit
+MEMORY_BUDGET = 0
+
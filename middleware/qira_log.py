@@ -1,5 +1,6 @@
 #!/usr/bin/env python2.7
 import struct
+import zlib
 
 IS_VALID = 0x80000000
 IS_WRITE = 0x40000000
@@ -8,6 +9,27 @@ IS_START = 0x10000000
 IS_BIGE  = 0x08000000    # not supported
 SIZE_MASK = 0xFF
 
+# one change in the log, also what qiradb's fetch_raw_changes exports
+# numpy.frombuffer(trace.db.fetch_raw_changes(), dtype=CHANGE_DTYPE) works
+CHANGE_SIZE = 0x20
+CHANGE_DTYPE = [('address', '<u8'), ('data', '<u8'), ('clnum', '<u8'), ('flags', '<u4'), ('padding', '<u4')]
+
+# a log N is just this header, the changes are in N_chunk_0, N_chunk_1, ...
+# with 1<<chunk_shift entries each, and entry 0 is the header's slot
+LOG_MAGIC = b"QIRALOG2"
+LOGSTATE_FORMAT = "8sQQQIIii"
+LOG_CHUNK_SHIFT = 20
+
+# an archived log is one file, the same header with LOG_Z_MAGIC, then a LOG_BLOCK_FORMAT
+# (offset, size, first_clnum) for each chunk, then the chunks zlib compressed
+LOG_Z_MAGIC = b"QIRALOGZ"
+LOG_BLOCK_FORMAT = "QQQ"
+LOG_Z_CHUNK_SHIFT = 12
+
+# the old format, one file with 32-bit counters and 0x18 byte changes
+LOGSTATE_V1_FORMAT = "IIIIii"
+CHANGE_V1_SIZE = 0x18
+
 LOGFILE = "/tmp/qira_log"
 LOGDIR = "/tmp/qira_logs/"
 
@@ -24,41 +46,129 @@ def flag_to_type(flags):
     typ = "R"
   return typ
 
+def read_logstate(fn):
+  # (change_count, first_clnum, parent_id, chunk_shift) or None, chunk_shift is None for a v1 log
+  try:
+    with open(fn, "rb") as f:
+      dat = f.read(struct.calcsize(LOGSTATE_FORMAT))
+  except IOError:
+    return None
+  if dat[0:len(LOG_MAGIC)] in (LOG_MAGIC, LOG_Z_MAGIC) and len(dat) == struct.calcsize(LOGSTATE_FORMAT):
+    (_, change_count, _, first_clnum, _, chunk_shift, parent_id, _) = struct.unpack(LOGSTATE_FORMAT, dat)
+    return (change_count, first_clnum, parent_id, chunk_shift)
+  if len(dat) < struct.calcsize(LOGSTATE_V1_FORMAT):
+    return None
+  (change_count, _, _, first_clnum, parent_id, _) = struct.unpack_from(LOGSTATE_V1_FORMAT, dat)
+  return (change_count, first_clnum, parent_id, None)
+
 def get_log_length(f):
   try:
-    f.seek(0)
-    dat = f.read(4)
-    return struct.unpack("I", dat)[0]
+    return read_logstate(f.name)[0]
   except:
     return None
 
 def read_log(f, seek=1, cnt=0):
-  f.seek(seek*0x18)
-  if cnt == 0:
-    dat = f.read()
-  else:
-    dat = f.read(cnt * 0x18)
+  fn = f if isinstance(f, str) else f.name
+  (change_count, _, _, chunk_shift) = read_logstate(fn)
+  end = change_count if cnt == 0 else min(change_count, seek+cnt)
+  if chunk_shift is None:
+    with open(fn, "rb") as lf:
+      lf.seek(seek*CHANGE_V1_SIZE)
+      dat = lf.read(max(end-seek, 0)*CHANGE_V1_SIZE)
+    ret = []
+    for i in range(0, len(dat) - len(dat) % CHANGE_V1_SIZE, CHANGE_V1_SIZE):
+      (address, data, clnum, flags) = struct.unpack_from("QQII", dat, i)
+      if not flags & IS_VALID:
+        break
+      ret.append((address, data, clnum, flags))
+    return ret
 
+  # a chunk at a time
+  blocks = read_blocks(fn, change_count, chunk_shift)
   ret = []
-  for i in range(0, len(dat), 0x18):
-    (address, data, clnum, flags) = struct.unpack("QQII", dat[i:i+0x18])
+  while seek < end:
+    chunk_end = min(end, ((seek >> chunk_shift) + 1) << chunk_shift)
+    offset = (seek & ((1 << chunk_shift) - 1))*CHANGE_SIZE
+    if blocks is not None:
+      with open(fn, "rb") as lf:
+        (block_offset, block_size, _) = blocks[seek >> chunk_shift]
+        lf.seek(block_offset)
+        dat = zlib.decompress(lf.read(block_size))
+      changes = parse_changes(dat[offset:offset + (chunk_end-seek)*CHANGE_SIZE])
+    else:
+      with open("%s_chunk_%d" % (fn, seek >> chunk_shift), "rb") as lf:
+        lf.seek(offset)
+        changes = parse_changes(lf.read((chunk_end-seek)*CHANGE_SIZE))
+    ret += changes
+    if len(changes) < chunk_end-seek:
+      break
+    seek = chunk_end
+  return ret
+
+def read_blocks(fn, change_count, chunk_shift):
+  # the block index of an archived log, None for anything else
+  with open(fn, "rb") as f:
+    if f.read(len(LOG_Z_MAGIC)) != LOG_Z_MAGIC:
+      return None
+    f.seek(struct.calcsize(LOGSTATE_FORMAT))
+    cnt = (change_count + (1 << chunk_shift) - 1) >> chunk_shift
+    dat = f.read(cnt*struct.calcsize(LOG_BLOCK_FORMAT))
+  return [struct.unpack_from(LOG_BLOCK_FORMAT, dat, i*struct.calcsize(LOG_BLOCK_FORMAT)) for i in range(cnt)]
+
+def parse_changes(dat):
+  # dat is anything with the buffer protocol, like bytes or a qiradb RawChanges
+  dat = memoryview(dat).cast('B') if hasattr(memoryview, 'cast') else dat
+  ret = []
+  for i in range(0, len(dat) - len(dat) % CHANGE_SIZE, CHANGE_SIZE):
+    (address, data, clnum, flags, _) = struct.unpack_from("QQQII", dat, i)
     if not flags & IS_VALID:
       break
     ret.append((address, data, clnum, flags))
 
   return ret
 
-def write_log(fn, dat):
-  # untested
-  ss = [struct.pack("I", len(dat)) + "\x00"*0x14]
-  for (address, data, clnum, flags) in dat:
-    ss.append(struct.pack("QQII", address, data, clnum, flags))
-  f = open(fn, "wb")
-  f.write(''.join(ss))
-  f.close()
+def write_log(fn, dat, chunk_shift=LOG_CHUNK_SHIFT, first_clnum=0, parent_id=-1):
+  chunk_entries = 1 << chunk_shift
+  changes = [struct.pack("QQQII", address, data, clnum, flags, 0) for (address, data, clnum, flags) in dat]
+  # entry 0 is the header's slot
+  changes.insert(0, b"\x00"*CHANGE_SIZE)
+  for i in range(0, len(changes), chunk_entries):
+    with open("%s_chunk_%d" % (fn, i >> chunk_shift), "wb") as f:
+      f.write(b''.join(changes[i:i+chunk_entries]))
+  # the header last, qiradb waits on it
+  with open(fn, "wb") as f:
+    f.write(struct.pack(LOGSTATE_FORMAT, LOG_MAGIC, len(changes), first_clnum, first_clnum, 0, chunk_shift, parent_id, 0))
+
+def compress_log(fn, out_fn, chunk_shift=LOG_Z_CHUNK_SHIFT):
+  # archives any log into one compressed file that qiradb and read_log still read
+  # small chunks so a lookup only inflates a little
+  (change_count, first_clnum, parent_id, _) = read_logstate(fn)
+  chunk_entries = 1 << chunk_shift
+  block_size = struct.calcsize(LOG_BLOCK_FORMAT)
+  blocks = []
+  with open(out_fn, "wb") as f:
+    f.write(struct.pack(LOGSTATE_FORMAT, LOG_Z_MAGIC, change_count, first_clnum, first_clnum, 0, chunk_shift, parent_id, 0))
+    # the index goes back in once the blocks are written
+    f.write(b"\x00" * (block_size * ((change_count + chunk_entries - 1) >> chunk_shift)))
+    for i in range(0, change_count, chunk_entries):
+      # entry 0 is the header's slot
+      changes = read_log(fn, max(i, 1), i + chunk_entries - max(i, 1))
+      if i == 0:
+        changes.insert(0, None)
+      dat = b''.join(b"\x00"*CHANGE_SIZE if c is None else struct.pack("QQQII", c[0], c[1], c[2], c[3], 0) for c in changes)
+      dat = zlib.compress(dat)
+      first = [c for c in changes if c is not None][:1]
+      blocks.append((f.tell(), len(dat), first[0][2] if first else first_clnum))
+      f.write(dat)
+    f.seek(struct.calcsize(LOGSTATE_FORMAT))
+    for b in blocks:
+      f.write(struct.pack(LOG_BLOCK_FORMAT, *b))
 
 if __name__ == "__main__":
   import sys
+  if len(sys.argv) == 4 and sys.argv[1] == "compress":
+    compress_log(sys.argv[2], sys.argv[3])
+    sys.exit(0)
   # standalone this can dump a log
   for (address, data, clnum, flags) in read_log(open(sys.argv[1])):
     print("%4d: %X -> %X  %X" % (clnum, address, data, flags))
@@ -2,6 +2,7 @@ from __future__ import print_function
 from qira_base import *
 import qira_config
 import qira_analysis
+import qira_log
 
 import os
 import shutil
@@ -47,6 +48,9 @@ class Program:
     except:
       pass
 
+    # shared by every trace, it's per process
+    qiradb.set_memory_budget(qira_config.MEMORY_BUDGET)
+
     # call which to match the behavior of strace and gdb
     self.program = which(prog)
     self.args = args
@@ -377,6 +381,14 @@ class Program:
 
   def add_trace(self, fn, i):
     self.traces[i] = Trace(fn, i, self, self.tregs[1], len(self.tregs[0]), self.tregs[2])
+    # a fork only logs what happened after it, the history before is read from the parent
+    # the parent can show up before or after its forks
+    db = self.traces[i].db
+    if db.get_parent_id() != i and db.get_parent_id() in self.traces:
+      db.set_parent(self.traces[db.get_parent_id()].db)
+    for t in self.traces.values():
+      if t.db is not db and t.db.parent is None and t.db.get_parent_id() == i:
+        t.db.set_parent(db)
     return self.traces[i]
 
   def execqira(self, args=[], shouldfork=True):
@@ -402,7 +414,8 @@ class Trace:
   def __init__(self, fn, forknum, program, r1, r2, r3):
     self.forknum = forknum
     self.program = program
-    self.db = qiradb.PyTrace(fn, forknum, r1, r2, r3)
+    # the index next to the log lets a restarted qira skip the ingest
+    self.db = qiradb.PyTrace(fn, forknum, r1, r2, r3, index_filename=fn+"_index", value_index=qira_config.VALUE_INDEX)
     self.load_base_memory()
 
     # analysis stuff
@@ -412,7 +425,11 @@ class Trace:
     self.dmap = None
     self.maxd = 0
     self.analysisready = False
-    self.picture = None
+    self.vtimeline = qira_analysis.VtimelineTiles(self)
+    self.slices = qira_analysis.SliceCache(self)
+    # carried between updates of the analysis, so only the new clnums are looked at
+    self.depthmap = None
+    self.calls = None
     self.needs_update = False
     self.strace = []
     self.mapped = []
@@ -506,33 +523,52 @@ class Trace:
     print("*** started analysis_thread", self.forknum)
     while self.keep_analysis_thread:
       time.sleep(0.2)
-      # so this is done poorly, analysis can be incremental
-      if self.maxclnum == None or self.db.get_maxclnum() != self.maxclnum:
-        self.analysisready = False
-        minclnum = self.db.get_minclnum()
-        maxclnum = self.db.get_maxclnum()
-        self.program.read_asm_file()
-        self.flow = qira_analysis.get_instruction_flow(self, self.program, minclnum, maxclnum)
-        self.dmap = qira_analysis.get_hacked_depth_map(self.flow, self.program)
-        qira_analysis.analyse_calls(self)
-
-        # hacky pin offset problem fix
+      self.update_analysis()
+    print("*** ended analysis_thread", self.forknum)
+
+  def update_analysis(self):
+    # only the clnums since the last time around are analysed
+    if self.maxclnum == None or self.db.get_maxclnum() != self.maxclnum:
+      self.analysisready = False
+      minclnum = self.db.get_minclnum()
+      maxclnum = self.db.get_maxclnum()
+      # the trace started over, so does the analysis
+      if self.depthmap == None or minclnum != self.minclnum or maxclnum < self.maxclnum:
+        self.depthmap = qira_analysis.DepthMap(self.program)
+        self.flow = []
+        self.dmap = self.depthmap.dmap
+        self.maxd = 0
+        self.calls = None
+        self.vtimeline = qira_analysis.VtimelineTiles(self)
+        self.slices = qira_analysis.SliceCache(self)
+        fromclnum = minclnum
+        fixed_offset = False
+      else:
+        fromclnum = self.maxclnum
+        fixed_offset = len(self.flow) > 0
+      self.program.read_asm_file()
+      flow = qira_analysis.get_instruction_flow(self, self.program, fromclnum, maxclnum)
+      self.flow.extend(flow)
+      self.depthmap.add(flow)
+      # before anything reads the new depths
+      self.maxd = self.depthmap.maxd
+
+      # hacky pin offset problem fix, the offset doesn't change after the first flow
+      if not fixed_offset and len(self.flow) > 0:
         hpo = len(self.dmap)-(maxclnum-minclnum)
         if hpo == 2:
-          self.dmap = self.dmap[1:]
+          del self.dmap[0]
 
-        self.maxd = max(self.dmap)
-        self.picture = qira_analysis.get_vtimeline_picture(self, minclnum, maxclnum)
-        self.minclnum = minclnum
-        self.maxclnum = maxclnum
-        self.needs_update = True
+      self.calls = qira_analysis.analyse_calls(self, self.calls)
+      self.minclnum = minclnum
+      self.maxclnum = maxclnum
+      self.needs_update = True
 
-        #print "analysis is ready"
-    print("*** ended analysis_thread", self.forknum)
+      #print "analysis is ready"
 
   def load_base_memory(self):
     def get_forkbase_from_log(n):
-      ret = struct.unpack("i", open(qira_config.TRACE_FILE_BASE+str(n), 'rb').read(0x18)[0x10:0x14])[0]
+      ret = qira_log.read_logstate(qira_config.TRACE_FILE_BASE+str(n))[2]
       if ret == -1:
         return n
       else:
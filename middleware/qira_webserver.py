@@ -6,6 +6,8 @@ import os
 import sys
 import time
 import base64
+import binascii
+import glob
 import json
 
 sys.path.append(qira_config.BASEDIR+"/static2")
@@ -37,8 +39,11 @@ import time
 
 import qira_analysis
 import qira_log
+import qiradb
 
 LIMIT = 0
+# how long a doslice goes on for
+SLICE_TIMEOUT = 5.0
 
 from flask import Flask, Response, redirect, request
 from flask_socketio import SocketIO, emit
@@ -56,9 +61,9 @@ socketio = SocketIO(app)
 # ***** middleware moved here *****
 def push_trace_update(i):
   t = program.traces[i]
-  if t.picture != None:
-    #print t.forknum, t.picture
-    socketio.emit('setpicture', {"forknum":t.forknum, "data":t.picture,
+  if t.maxd != 0:
+    # the clients ask for the tiles of their view again
+    socketio.emit('vtimelineupdate', {"forknum":t.forknum,
       "minclnum":t.minclnum, "maxclnum":t.maxclnum}, namespace='/qira')
   socketio.emit('strace', {'forknum': t.forknum, 'dat': t.strace}, namespace='/qira')
   t.needs_update = False
@@ -100,8 +105,10 @@ def mwpoll():
     push_updates(False)
 
 def mwpoller():
+  seq = 0
   while 1:
-    time.sleep(0.2)
+    # wakes up as soon as a trace ingests something, new traces are still found on the timeout
+    seq = qiradb.wait_for_update(seq, 0.2)
     mwpoll()
 
 # ***** after this line is the new server stuff *****
@@ -146,6 +153,11 @@ def deletefork(forknum):
   global program
   print("deletefork", forknum)
   os.unlink(qira_config.TRACE_FILE_BASE+str(int(forknum)))
+  for fn in [qira_config.TRACE_FILE_BASE+str(int(forknum))+"_index"] + glob.glob(qira_config.TRACE_FILE_BASE+str(int(forknum))+"_chunk_*"):
+    try:
+      os.unlink(fn)
+    except OSError:
+      pass
   if forknum in program.traces:
     program.traces[forknum].keep_analysis_thread = False
     del program.traces[forknum]
@@ -153,20 +165,36 @@ def deletefork(forknum):
 
 @socketio.on('doslice', namespace='/qira')
 @socket_method
-def slice(forknum, clnum):
+def slice(forknum, clnum, forward=False):
+  # over the whole trace, sent as it's found until it's done or SLICE_TIMEOUT runs out
+  if forknum not in program.traces:
+    return
   trace = program.traces[forknum]
-  data = qira_analysis.slice(trace, clnum)
-  print("slice",forknum,clnum, data)
-  emit('slice', forknum, data);
+  s = trace.db.slice(clnum, forward, qira_analysis.get_stack_registers(program))
+  start = time.time()
+  while 1:
+    data = s.step(0, 0.05)
+    done = s.done() or (time.time() - start) > SLICE_TIMEOUT
+    emit('slice', {'forknum': forknum, 'clnum': clnum, 'forward': forward, 'clnums': data, 'done': done})
+    if done:
+      break
+    # let the other sockets in between
+    socketio.sleep(0)
 
 @socketio.on('doanalysis', namespace='/qira')
 @socket_method
 def analysis(forknum):
-  trace = program.traces[forknum]
+  push_trace_update(forknum)
 
-  data = qira_analysis.get_vtimeline_picture(trace)
-  if data != None:
-    emit('setpicture', {"forknum":forknum, "data":data})
+@socketio.on('getvtimeline', namespace='/qira')
+@socket_method
+def getvtimeline(forknum, cview, cscale):
+  if forknum not in program.traces:
+    return
+  vtimeline = program.traces[forknum].vtimeline
+  tiles = vtimeline.get_tiles(cview[0], cview[1], cscale)
+  emit('vtimelinetiles', {'forknum': forknum, 'cview': cview, 'level': vtimeline.get_level(cscale),
+    'tiles': [{'clstart': clstart, 'clend': clend, 'data': data} for (clstart, clend, data) in tiles]})
 
 @socketio.on('connect', namespace='/qira')
 @socket_method
@@ -228,6 +256,46 @@ def getchanges(forknum, address, typ, cview, cscale, clnum):
       ret[forknum] = db
   emit('changes', {'type': typ, 'clnums': ret})
 
+@socketio.on('searchvalue', namespace='/qira')
+@socket_method
+def searchvalue(forknum, value, mask, types, cview, limit):
+  if forknum != -1 and forknum not in program.traces:
+    return
+  if not qira_config.VALUE_INDEX:
+    print("*** searchvalue needs --value-index")
+    return
+  value = fhex(value)
+  mask = fhex(mask)
+  if value is None or mask is None:
+    return
+
+  if forknum == -1:
+    forknums = program.traces.keys()
+  else:
+    forknums = [forknum]
+  ret = {}
+  for forknum in forknums:
+    ret[forknum] = program.traces[forknum].db.fetch_clnums_by_value(value, mask, types, cview[0], cview[1], limit)
+  emit('values', {'value': ghex(value), 'clnums': ret})
+
+@socketio.on('getrangechanges', namespace='/qira')
+@socket_method
+def getrangechanges(forknum, lo, hi, types, cview, limit):
+  # every change to a struct or buffer in [lo, hi), in one query
+  if forknum not in program.traces:
+    return
+  lo = fhex(lo)
+  hi = fhex(hi)
+  if lo is None or hi is None:
+    return
+  ret = program.traces[forknum].db.fetch_changes_in_range(lo, hi, types, cview[0], cview[1], limit)
+  emit('rangechanges', {'forknum': forknum,
+    'clnums': list(ret['clnum']),
+    'addresses': [ghex(a) for a in ret['address']],
+    'data': [ghex(d) for d in ret['data']],
+    'types': ret['type'],
+    'sizes': list(ret['size'])})
+
 @socketio.on('navigatefunction', namespace='/qira')
 @socket_method
 def navigatefunction(forknum, clnum, start):
@@ -252,7 +320,7 @@ def navigatefunction(forknum, clnum, start):
 @socket_method
 def getinstructions(forknum, clnum, clstart, clend):
   trace = program.traces[forknum]
-  slce = qira_analysis.slice(trace, clnum)
+  slce = trace.slices.get(clnum)
   ret = []
 
   def get_instruction(i):
@@ -332,6 +400,60 @@ def getmemory(forknum, clnum, address, ln):
   ret = {'address': ghex(address), 'len': ln, 'dat': dat, 'is_big_endian': program.tregs[2], 'ptrsize': program.tregs[1]}
   emit('memory', ret)
 
+@socketio.on('getpageheatmap', namespace='/qira')
+@socket_method
+def getpageheatmap(forknum, cview, buckets):
+  if forknum not in program.traces:
+    return
+  ret = program.traces[forknum].db.get_page_heatmap(cview[0], cview[1], buckets)
+  emit('pageheatmap', {'forknum': forknum, 'cview': cview, 'heat': dict((ghex(page), counts) for page, counts in ret.items())})
+
+@socketio.on('getpcsummary', namespace='/qira')
+@socket_method
+def getpcsummary(forknum, lo, hi):
+  # the execution count and first and last clnum of every instruction in [lo, hi), like a whole function
+  if forknum not in program.traces:
+    return
+  lo = fhex(lo)
+  hi = fhex(hi)
+  if lo is None or hi is None:
+    return
+  ret = program.traces[forknum].db.fetch_pc_summary(lo, hi)
+  emit('pcsummary', {'forknum': forknum, 'lo': ghex(lo), 'hi': ghex(hi),
+    'pcs': dict((ghex(pc), list(summary)) for pc, summary in ret.items())})
+
+@socketio.on('searchmemory', namespace='/qira')
+@socket_method
+def searchmemory(forknum, clnum, pattern, ranges, limit):
+  # pattern is hex bytes, ranges is a list of [start, end) in hex, empty for everywhere
+  if forknum not in program.traces:
+    return
+  try:
+    pattern = binascii.unhexlify(pattern)
+  except (TypeError, ValueError):
+    return
+  ranges = [(fhex(start), fhex(end)) for (start, end) in ranges]
+  ret = program.traces[forknum].db.search_memory(clnum, pattern, ranges, limit)
+  emit('memorysearch', {'forknum': forknum, 'clnum': clnum, 'addresses': [ghex(a) for a in ret]})
+
+@socketio.on('difftraces', namespace='/qira')
+@socket_method
+def difftraces(forknum, otherforknum, clstart, clnums, limit):
+  # where otherforknum went another way than forknum, and what differs at clnums
+  if forknum not in program.traces or otherforknum not in program.traces:
+    return
+  ret = program.traces[forknum].db.diff(program.traces[otherforknum].db, clstart, limit=limit, clnums=clnums)
+  REGS = program.tregs[0]
+  states = {}
+  for clnum, state in ret['states'].items():
+    states[clnum] = {
+      'registers': [(REGS[i] if i < len(REGS) else i, ghex(v), ghex(ov)) for (i, v, ov) in state['registers']],
+      'memory': [(ghex(a), v, ov) for (a, v, ov) in state['memory']]}
+  emit('tracediff', {'forknum': forknum, 'otherforknum': otherforknum,
+    'first_clnum': ret['first_clnum'],
+    'branches': [(clnum, ghex(a), ghex(oa)) for (clnum, a, oa) in ret['branches']],
+    'states': states})
+
 @socketio.on('setfunctionargswrap', namespace='/qira')
 @socket_method
 def setfunctionargswrap(func, args):
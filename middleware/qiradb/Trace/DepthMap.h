@@ -0,0 +1,72 @@
+#ifndef DEPTHMAP_H
+#define DEPTHMAP_H
+
+// the call depth at every clnum, from the instruction addresses in clnum order
+// a call pushes where it returns to, reaching an address on the stack pops back to before it
+// the counts of the addresses on the stack make "is it on the stack" a lookup instead of a scan
+// it's fed a piece at a time, the stack carries over
+
+#define DEPTH_MISSING -1
+
+class DepthMap {
+public:
+  // with branch delay slots a call returns past the slot, and the slot is a level down
+  DepthMap(bool branch_delay_slots) : branch_delay_slots_(branch_delay_slots), branch_delay_(false),
+                                      have_last_(false), last_clnum_(0) {}
+
+  // pc is a call instruction
+  void SetCall(Address pc) { calls_.insert(pc); }
+
+  // appends the depth at each clnum, DEPTH_MISSING for the clnums missing in between
+  void Add(const Address *addresses, const uint64_t *lengths, const Clnum *clnums, size_t count, vector<int32_t> *out) {
+    for (size_t i = 0; i < count; i++) {
+      Address address = addresses[i];
+      if (have_last_ && clnums[i] > last_clnum_+1) out->insert(out->end(), clnums[i]-last_clnum_-1, DEPTH_MISSING);
+      have_last_ = true;
+      last_clnum_ = clnums[i];
+
+      unordered_map<Address, int>::iterator it = on_stack_.find(address);
+      if (it != on_stack_.end() && it->second > 0) {
+        // back to before the last time it was pushed
+        while (stack_.back() != address) pop();
+        pop();
+      }
+
+      if (branch_delay_) {
+        out->push_back(stack_.size()-1);
+        branch_delay_ = false;
+      } else {
+        out->push_back(stack_.size());
+      }
+
+      if (calls_.find(address) != calls_.end()) {
+        uint64_t ret_offset = lengths[i];
+        if (branch_delay_slots_) {
+          branch_delay_ = true;
+          ret_offset *= 2;
+        }
+        stack_.push_back(address+ret_offset);
+        on_stack_[address+ret_offset]++;
+      }
+    }
+  }
+
+  // after the last instruction so far
+  int32_t Depth() const { return stack_.size(); }
+
+private:
+  void pop() {
+    on_stack_[stack_.back()]--;
+    stack_.pop_back();
+  }
+
+  bool branch_delay_slots_, branch_delay_;
+  bool have_last_;
+  Clnum last_clnum_;
+  vector<Address> stack_;
+  unordered_map<Address, int> on_stack_;
+  set<Address> calls_;
+};
+
+#endif
+
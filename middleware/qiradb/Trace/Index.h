@@ -0,0 +1,56 @@
+#ifndef INDEX_H
+#define INDEX_H
+
+// helpers for the on disk index that lives next to the log
+// the format is native endian, it never leaves the machine that made it
+
+#include <stdio.h>
+#include <string.h>
+
+#define INDEX_MAGIC "QIRAIDX"
+#define INDEX_VERSION 11
+
+class IndexWriter {
+public:
+  IndexWriter(FILE *f) : f_(f), ok_(true) {}
+  template<typename T> void put(const T &v) { put_bytes(&v, sizeof(T)); }
+  void put_bytes(const void *dat, size_t len) {
+    if (ok_ && len > 0 && fwrite(dat, 1, len, f_) != len) ok_ = false;
+  }
+  // an empty vector has no [0] to take the address of
+  template<typename T> void put_vector(const vector<T> &v) {
+    if (!v.empty()) put_bytes(&v[0], v.size()*sizeof(T));
+  }
+  // for a part that couldn't be written, so a broken index doesn't replace a good one
+  void fail() { ok_ = false; }
+  bool ok() { return ok_; }
+private:
+  FILE *f_;
+  bool ok_;
+};
+
+// reads from the mapped index, runs dry instead of running off the end
+class IndexReader {
+public:
+  IndexReader(const uint8_t *dat, size_t len) : p_(dat), end_(dat+len), ok_(true) {}
+  template<typename T> T get() {
+    T v;
+    const uint8_t *dat = get_bytes(sizeof(T));
+    if (dat == NULL) memset((void*)&v, 0, sizeof(T));
+    else memcpy((void*)&v, dat, sizeof(T));
+    return v;
+  }
+  const uint8_t *get_bytes(size_t len) {
+    if (!ok_ || (size_t)(end_ - p_) < len) { ok_ = false; return NULL; }
+    const uint8_t *ret = p_;
+    p_ += len;
+    return ret;
+  }
+  bool ok() { return ok_; }
+private:
+  const uint8_t *p_, *end_;
+  bool ok_;
+};
+
+#endif
+
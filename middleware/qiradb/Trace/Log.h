@@ -0,0 +1,449 @@
+#ifndef LOG_H
+#define LOG_H
+
+// the change log the tracer writes
+// v1 is one file, a 24 byte header and then struct change_v1s, with 32-bit counters
+// v2 is a manifest with just the header, and the changes in fixed size chunk files next to it
+//   N_chunk_0, N_chunk_1, ... with entry e at e & chunk mask in chunk e >> chunk_shift
+// v3 is an archive, one file with the v2 header, a block index, and then every chunk zlib compressed
+//   qira_log.compress_log makes them, nothing writes to one as it's traced
+// in all of them, entry 0 is the header and the changes start at 1
+// only the chunks being looked at are mapped, v1 is read and widened a chunk at a time, v3 is inflated a chunk at a time
+
+#include <stdlib.h>
+#include <string.h>
+#include <zlib.h>
+
+#define LOG_MAGIC "QIRALOG2"
+#define LOG_Z_MAGIC "QIRALOGZ"
+#define LOG_MAGIC_SIZE 8
+// how much of a v1 log is widened at once
+#define LOG_V1_CHUNK_SHIFT 20
+// unpinned chunks are dropped past this many
+#define LOG_MAX_CHUNKS 4
+
+// the header of a v1 log
+struct logstate_v1 {
+  uint32_t change_count;
+  uint32_t changelist_number;
+  uint32_t is_filtered;
+  uint32_t first_changelist_number;
+  int32_t parent_id;
+  int32_t this_pid;
+};
+
+// the v1 log record
+struct change_v1 {
+  Address address;
+  uint64_t data;
+  uint32_t clnum;
+  uint32_t flags;
+};
+
+// copied from qemu_mods/tci.c, the v2 manifest
+struct logstate {
+  char magic[LOG_MAGIC_SIZE];
+  uint64_t change_count;
+  uint64_t changelist_number;
+  uint64_t first_changelist_number;
+  uint32_t is_filtered;
+  uint32_t chunk_shift;
+  int32_t parent_id;
+  int32_t this_pid;
+};
+
+// right after the v3 header, one per chunk
+struct log_block {
+  // where the compressed chunk is in the file
+  uint64_t offset;
+  uint64_t size;
+  // the clnum of the first change in it, so a reader can find a clnum without inflating
+  Clnum first_clnum;
+};
+
+class Log {
+public:
+  Log() : version_(0), chunk_shift_(LOG_V1_CHUNK_SHIFT), header_(NULL), use_clock_(0) {
+#ifdef _WIN32
+    fd_ = INVALID_HANDLE_VALUE;
+#else
+    fd_ = -1;
+#endif
+    MUTEX_INIT(mutex_);
+  }
+
+  ~Log() {
+    for (map<EntryNumber, Chunk>::iterator it = chunks_.begin(); it != chunks_.end(); ++it) {
+      drop_chunk(&it->second);
+    }
+#ifdef _WIN32
+    if (header_ != NULL) UnmapViewOfFile(header_);
+    if (fd_ != INVALID_HANDLE_VALUE) CloseHandle(fd_);
+#else
+    if (header_ != NULL) munmap((void*)header_, header_size());
+    if (fd_ != -1) close(fd_);
+#endif
+  }
+
+  // waits for the tracer to write the header
+  bool Open(const char *filename) {
+    filename_ = filename;
+#ifdef _WIN32
+    fd_ = CreateFile(filename, GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE, NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+    if (fd_ == INVALID_HANDLE_VALUE) {
+#else
+    fd_ = open(filename, O_RDONLY);
+    if (fd_ == -1) {
+#endif
+      printf("ERROR: file open failed\n");
+      return false;
+    }
+
+    // a v1 header starts with the change count, which is never 0 once it's written
+    char magic[LOG_MAGIC_SIZE];
+    while (1) {
+      // and a half written magic isn't a v1 count
+      if (read_at(0, magic, sizeof(magic)) == sizeof(magic) && memcmp(magic, "\0\0\0\0", 4) != 0 &&
+          (memcmp(magic, LOG_MAGIC, 4) != 0 || memcmp(magic, LOG_MAGIC, LOG_MAGIC_SIZE) == 0 ||
+           memcmp(magic, LOG_Z_MAGIC, LOG_MAGIC_SIZE) == 0)) break;
+      printf("WARNING: waiting for the header of %s\n", filename);
+      usleep(100 * 1000);
+    }
+    version_ = (memcmp(magic, LOG_MAGIC, LOG_MAGIC_SIZE) == 0) ? 2 :
+               ((memcmp(magic, LOG_Z_MAGIC, LOG_MAGIC_SIZE) == 0) ? 3 : 1);
+    while (file_size(fd_) < header_size()) {
+      printf("WARNING: waiting for the header of %s\n", filename);
+      usleep(100 * 1000);
+    }
+
+#ifdef _WIN32
+    HANDLE mapping = CreateFileMapping(fd_, NULL, PAGE_READONLY, 0, 0, NULL);
+    if (mapping != NULL) {
+      header_ = MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, header_size());
+      CloseHandle(mapping);
+    }
+#else
+    header_ = mmap(NULL, header_size(), PROT_READ, MAP_SHARED, fd_, 0);
+    if (header_ == MAP_FAILED) header_ = NULL;
+#endif
+    if (header_ == NULL) {
+      printf("ERROR: can't map the header of %s\n", filename);
+      return false;
+    }
+
+    if (version_ >= 2) {
+      chunk_shift_ = v2()->chunk_shift;
+      if (chunk_shift_ < 8 || chunk_shift_ > 30) {
+        printf("ERROR: bad chunk size in %s\n", filename);
+        return false;
+      }
+    }
+    if (version_ == 3) {
+      // an archive is done, so the index is read once
+      blocks_.resize((GetEntryCount() + chunk_mask()) >> chunk_shift_);
+      uint64_t len = blocks_.size() * sizeof(struct log_block);
+      if (len > 0 && read_at(sizeof(struct logstate), &blocks_[0], len) != len) {
+        printf("ERROR: can't read the block index of %s\n", filename);
+        return false;
+      }
+    }
+    return true;
+  }
+
+  int version() const { return version_; }
+
+  // what the tracer has written so far, including the header entry
+  EntryNumber GetEntryCount() const {
+    if (version_ >= 2) return ((volatile const struct logstate *)header_)->change_count;
+    return ((volatile const struct logstate_v1 *)header_)->change_count;
+  }
+
+  Clnum GetFirstClnum() const {
+    return (version_ >= 2) ? v2()->first_changelist_number : v1()->first_changelist_number;
+  }
+  int GetParentId() const { return (version_ >= 2) ? v2()->parent_id : v1()->parent_id; }
+  int GetPid() const { return (version_ >= 2) ? v2()->this_pid : v1()->this_pid; }
+
+  // entries [start, start+*count) as one array, *count is cut at the end of start's chunk
+  // it stays mapped until it's unpinned
+  const struct change *Pin(EntryNumber start, EntryNumber *count) {
+    MUTEX_LOCK(mutex_);
+    EntryNumber chunk = start >> chunk_shift_;
+    EntryNumber offset = start & chunk_mask();
+    *count = min(*count, chunk_entries() - offset);
+    Chunk *c = get_chunk(chunk, offset + *count);
+    const struct change *ret = NULL;
+    if (c != NULL) {
+      // a short chunk is all there is
+      *count = (offset < c->loaded) ? min(*count, c->loaded - offset) : 0;
+      c->pins++;
+      ret = c->data + offset;
+    } else {
+      *count = 0;
+    }
+    MUTEX_UNLOCK(mutex_);
+    return ret;
+  }
+
+  // entries [start, start+count) as a piece per chunk, none of them copies, each one is unpinned on its own
+  // it stops short at a chunk that's missing
+  void PinChunks(EntryNumber start, EntryNumber count, vector<pair<const struct change *, EntryNumber> > *out) {
+    for (EntryNumber done = 0; done < count; ) {
+      EntryNumber got = count - done;
+      const struct change *part = Pin(start + done, &got);
+      if (got == 0) {
+        Unpin(part);
+        break;
+      }
+      out->push_back(make_pair(part, got));
+      done += got;
+    }
+  }
+
+  // entries [start, start+count) as one array, a copy if they span chunks
+  const struct change *PinContiguous(EntryNumber start, EntryNumber count) {
+    EntryNumber got = count;
+    const struct change *ret = Pin(start, &got);
+    if (ret != NULL && got == count) return ret;
+    if (ret != NULL) Unpin(ret);
+
+    struct change *copy = (struct change *)malloc(max(count, (EntryNumber)1) * sizeof(struct change));
+    if (copy == NULL) return NULL;
+    for (EntryNumber done = 0; done < count; ) {
+      got = count - done;
+      const struct change *part = Pin(start + done, &got);
+      if (part != NULL) {
+        memcpy(copy + done, part, got * sizeof(struct change));
+        Unpin(part);
+      }
+      if (got == 0) {
+        // a missing chunk
+        memset(copy + done, 0, (count - done) * sizeof(struct change));
+        break;
+      }
+      done += got;
+    }
+    MUTEX_LOCK(mutex_);
+    copies_.insert(copy);
+    MUTEX_UNLOCK(mutex_);
+    return copy;
+  }
+
+  void Unpin(const struct change *changes) {
+    if (changes == NULL) return;
+    MUTEX_LOCK(mutex_);
+    set<const struct change *>::iterator cit = copies_.find(changes);
+    if (cit != copies_.end()) {
+      copies_.erase(cit);
+      free((void*)changes);
+    } else {
+      for (map<EntryNumber, Chunk>::iterator it = chunks_.begin(); it != chunks_.end(); ++it) {
+        if (changes >= it->second.data && changes < it->second.data + chunk_entries()) {
+          it->second.pins--;
+          break;
+        }
+      }
+      evict();
+    }
+    MUTEX_UNLOCK(mutex_);
+  }
+
+private:
+  struct Chunk {
+    struct change *data;
+    // how many entries in it can be read
+    EntryNumber loaded;
+    int pins;
+    uint64_t last_used;
+    // v2 chunks are mapped, v1 and v3 chunks are in memory
+    size_t mapped_size;
+  };
+
+  const struct logstate *v2() const { return (const struct logstate *)header_; }
+  const struct logstate_v1 *v1() const { return (const struct logstate_v1 *)header_; }
+  uint64_t header_size() const { return (version_ >= 2) ? sizeof(struct logstate) : sizeof(struct logstate_v1); }
+  EntryNumber chunk_entries() const { return ((EntryNumber)1) << chunk_shift_; }
+  EntryNumber chunk_mask() const { return chunk_entries() - 1; }
+
+  // must hold mutex_, makes sure the first end entries of the chunk are there if they can be
+  Chunk *get_chunk(EntryNumber chunk, EntryNumber end) {
+    map<EntryNumber, Chunk>::iterator it = chunks_.find(chunk);
+    if (it == chunks_.end()) {
+      Chunk c;
+      c.data = NULL;
+      c.loaded = 0;
+      c.pins = 0;
+      c.mapped_size = 0;
+      if (version_ == 2) {
+        if (!map_chunk(chunk, &c)) return NULL;
+      } else {
+        c.data = (struct change *)malloc(chunk_entries() * sizeof(struct change));
+        if (c.data == NULL) return NULL;
+        if (version_ == 3 && !inflate_chunk(chunk, &c)) {
+          free(c.data);
+          return NULL;
+        }
+      }
+      it = chunks_.insert(make_pair(chunk, c)).first;
+    }
+    Chunk *c = &it->second;
+    c->last_used = ++use_clock_;
+    if (version_ == 1 && c->loaded < end) widen_v1(chunk, c, end);
+    return c;
+  }
+
+  bool map_chunk(EntryNumber chunk, Chunk *c) {
+    char fn[0x20];
+    snprintf(fn, sizeof(fn), "_chunk_%" PRIu64, (uint64_t)chunk);
+    string chunk_filename = filename_ + fn;
+#ifdef _WIN32
+    HANDLE fd = CreateFile(chunk_filename.c_str(), GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE, NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+    if (fd == INVALID_HANDLE_VALUE) {
+#else
+    int fd = open(chunk_filename.c_str(), O_RDONLY);
+    if (fd == -1) {
+#endif
+      printf("ERROR: can't open %s\n", chunk_filename.c_str());
+      return false;
+    }
+    // the tracer makes them full size, but don't map past the end of a short one
+    uint64_t size = min(file_size(fd), (uint64_t)(chunk_entries() * sizeof(struct change)));
+    void *dat = NULL;
+    if (size > 0) {
+#ifdef _WIN32
+      HANDLE mapping = CreateFileMapping(fd, NULL, PAGE_READONLY, 0, 0, NULL);
+      if (mapping != NULL) {
+        dat = MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, size);
+        CloseHandle(mapping);
+      }
+#else
+      dat = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+      if (dat == MAP_FAILED) dat = NULL;
+#endif
+    }
+#ifdef _WIN32
+    CloseHandle(fd);
+#else
+    close(fd);
+#endif
+    if (dat == NULL) {
+      printf("ERROR: can't map %s\n", chunk_filename.c_str());
+      return false;
+    }
+    c->data = (struct change *)dat;
+    c->mapped_size = size;
+    c->loaded = size / sizeof(struct change);
+    return true;
+  }
+
+  // the whole chunk, it's one zlib stream
+  bool inflate_chunk(EntryNumber chunk, Chunk *c) {
+    if (chunk >= blocks_.size()) return false;
+    const struct log_block &b = blocks_[chunk];
+    vector<uint8_t> compressed(b.size);
+    if (b.size == 0 || read_at(b.offset, &compressed[0], b.size) != b.size) {
+      printf("ERROR: can't read block %" PRIu64 " of %s\n", (uint64_t)chunk, filename_.c_str());
+      return false;
+    }
+    uLongf len = chunk_entries() * sizeof(struct change);
+    if (uncompress((Bytef *)c->data, &len, &compressed[0], b.size) != Z_OK) {
+      printf("ERROR: block %" PRIu64 " of %s is corrupt\n", (uint64_t)chunk, filename_.c_str());
+      return false;
+    }
+    c->loaded = len / sizeof(struct change);
+    return true;
+  }
+
+  // reads the v1 entries up to end that the tracer has written
+  void widen_v1(EntryNumber chunk, Chunk *c, EntryNumber end) {
+    EntryNumber first = chunk << chunk_shift_;
+    EntryNumber written = GetEntryCount();
+    end = min(end, (written > first) ? (written - first) : 0);
+    struct change_v1 buf[0x1000];
+    while (c->loaded < end) {
+      EntryNumber n = min(end - c->loaded, (EntryNumber)(sizeof(buf)/sizeof(buf[0])));
+      uint64_t got = read_at((first + c->loaded) * sizeof(struct change_v1), buf, n * sizeof(struct change_v1));
+      n = got / sizeof(struct change_v1);
+      if (n == 0) break;
+      for (EntryNumber i = 0; i < n; i++) {
+        struct change *d = &c->data[c->loaded + i];
+        d->address = buf[i].address;
+        d->data = buf[i].data;
+        d->clnum = (buf[i].clnum == 0xFFFFFFFF) ? INVALID_CLNUM : buf[i].clnum;
+        d->flags = buf[i].flags;
+        d->padding = 0;
+      }
+      c->loaded += n;
+    }
+  }
+
+  // must hold mutex_
+  void evict() {
+    while (chunks_.size() > LOG_MAX_CHUNKS) {
+      map<EntryNumber, Chunk>::iterator victim = chunks_.end();
+      for (map<EntryNumber, Chunk>::iterator it = chunks_.begin(); it != chunks_.end(); ++it) {
+        if (it->second.pins > 0) continue;
+        if (victim == chunks_.end() || it->second.last_used < victim->second.last_used) victim = it;
+      }
+      if (victim == chunks_.end()) break;
+      drop_chunk(&victim->second);
+      chunks_.erase(victim);
+    }
+  }
+
+  void drop_chunk(Chunk *c) {
+    if (version_ != 2) {
+      free(c->data);
+    } else {
+#ifdef _WIN32
+      UnmapViewOfFile(c->data);
+#else
+      munmap(c->data, c->mapped_size);
+#endif
+    }
+  }
+
+  uint64_t read_at(uint64_t offset, void *buf, uint64_t len) {
+#ifdef _WIN32
+    OVERLAPPED o;
+    memset(&o, 0, sizeof(o));
+    o.Offset = (DWORD)offset;
+    o.OffsetHigh = (DWORD)(offset >> 32);
+    DWORD got = 0;
+    if (!ReadFile(fd_, buf, (DWORD)len, &got, &o)) return 0;
+    return got;
+#else
+    ssize_t got = pread(fd_, buf, len, offset);
+    return (got < 0) ? 0 : got;
+#endif
+  }
+
+  static uint64_t file_size(QIRAFILE fd) {
+#ifdef _WIN32
+    LARGE_INTEGER size;
+    if (!GetFileSizeEx(fd, &size)) return 0;
+    return size.QuadPart;
+#else
+    off_t size = lseek(fd, 0, SEEK_END);
+    return (size < 0) ? 0 : size;
+#endif
+  }
+
+  // no copying, the chunks are owned
+  Log(const Log &);
+  Log &operator=(const Log &);
+
+  string filename_;
+  int version_;
+  unsigned int chunk_shift_;
+  QIRAFILE fd_;
+  const void *header_;
+  vector<struct log_block> blocks_;
+
+  MUTEX mutex_;
+  map<EntryNumber, Chunk> chunks_;
+  set<const struct change *> copies_;
+  uint64_t use_clock_;
+};
+
+#endif
@@ -0,0 +1,270 @@
+#ifndef MEMORY_H
+#define MEMORY_H
+
+// the history of one page of memory
+// every write is a delta, and every KEYFRAME_DELTAS deltas a segment is sealed and the next
+// one starts with a snapshot of the whole page, so a fetch replays at most KEYFRAME_DELTAS deltas
+// the sealed segments can spill, the last one is being written to and never does
+
+#include <string.h>
+#include <algorithm>
+#include "Index.h"
+
+#define MEMORY_PAGE_SIZE 0x1000
+#define MEMORY_PAGE_MASK (~((Address)MEMORY_PAGE_SIZE-1))
+#define KEYFRAME_DELTAS 0x1000
+
+// one byte written, as ingest hands it over
+struct MemoryWrite {
+  Clnum clnum;
+  uint16_t offset;
+  uint8_t data;
+};
+
+inline bool operator<(const MemoryWrite &a, const MemoryWrite &b) { return a.clnum < b.clnum; }
+
+// packed to 8 bytes, the clnum is counted from the first_clnum of the segment it's in
+// a segment is sealed early instead of holding one that doesn't fit
+#define MEMORY_DELTA_CLNUM_BITS 44
+#define MEMORY_DELTA_MAX_CLNUM ((((Clnum)1) << MEMORY_DELTA_CLNUM_BITS) - 1)
+struct MemoryDelta {
+  Clnum rel_clnum:MEMORY_DELTA_CLNUM_BITS;
+  uint64_t offset:12;
+  uint64_t data:8;
+};
+
+struct MemoryKeyframe {
+  uint8_t data[MEMORY_PAGE_SIZE];
+  uint8_t valid[MEMORY_PAGE_SIZE/8];
+};
+
+// only within a segment
+inline bool operator<(const MemoryDelta &a, const MemoryDelta &b) { return a.rel_clnum < b.rel_clnum; }
+
+class MemorySegment : public Spillable {
+public:
+  // owns start, the page before the deltas, NULL for the first segment
+  MemorySegment(MemoryKeyframe *start) : first_clnum(0), delta_count(0), start(start) {}
+  ~MemorySegment() { spill_forget(this); delete start; }
+
+  size_t resident_bytes() const {
+    return deltas.capacity()*sizeof(MemoryDelta) + ((start == NULL) ? 0 : sizeof(MemoryKeyframe));
+  }
+  void save(vector<uint8_t> *out) const {
+    out->push_back(start != NULL);
+    if (start != NULL) out->insert(out->end(), (const uint8_t *)start, (const uint8_t *)(start+1));
+    if (!deltas.empty()) out->insert(out->end(), (const uint8_t *)&deltas[0], (const uint8_t *)&deltas[0] + deltas.size()*sizeof(MemoryDelta));
+  }
+  bool load(const uint8_t *dat, size_t len) {
+    if (len < 1) return false;
+    size_t keyframe_size = dat[0] ? sizeof(MemoryKeyframe) : 0;
+    if ((len - 1 - keyframe_size) % sizeof(MemoryDelta) != 0) return false;
+    if (keyframe_size > 0) {
+      start = new MemoryKeyframe;
+      memcpy(start, dat+1, keyframe_size);
+    }
+    const MemoryDelta *d = (const MemoryDelta *)(dat + 1 + keyframe_size);
+    deltas.assign(d, d + (len - 1 - keyframe_size)/sizeof(MemoryDelta));
+    return true;
+  }
+  void drop() {
+    delete start;
+    start = NULL;
+    vector<MemoryDelta>().swap(deltas);
+  }
+
+  // only while it's in memory
+  Clnum last_clnum() const { return first_clnum + deltas.back().rel_clnum; }
+
+  // kept when it spills, first_clnum is what a fetch searches
+  Clnum first_clnum;
+  size_t delta_count;
+  MemoryKeyframe *start;
+  vector<MemoryDelta> deltas;
+
+private:
+  MemorySegment(const MemorySegment &);
+  MemorySegment &operator=(const MemorySegment &);
+};
+
+class MemoryPage {
+public:
+  MemoryPage() : delta_count_(0) {}
+  ~MemoryPage() { drop_segments(0); }
+
+  void Commit(Clnum clnum, uint16_t offset, uint8_t data) {
+    MemoryWrite d;
+    d.clnum = clnum; d.offset = offset; d.data = data;
+    if (segments_.empty() || segments_.back()->deltas.empty() || segments_.back()->last_clnum() <= clnum) {
+      append(d);
+      return;
+    }
+    // out of order, the segments from the one it lands in on are rebuilt
+    size_t s = find_segment(clnum);
+    if (s > 0) s--;
+    MemoryKeyframe *start = NULL;
+    vector<MemoryWrite> writes;
+    for (size_t i = s; i < segments_.size(); i++) {
+      MemorySegment *seg = segments_[i];
+      spill_pin(seg);
+      if (i == s && seg->start != NULL) {
+        start = new MemoryKeyframe;
+        memcpy(start, seg->start, sizeof(MemoryKeyframe));
+      }
+      for (size_t j = 0; j < seg->deltas.size(); j++) {
+        MemoryWrite w;
+        w.clnum = seg->first_clnum + seg->deltas[j].rel_clnum;
+        w.offset = seg->deltas[j].offset;
+        w.data = seg->deltas[j].data;
+        writes.push_back(w);
+      }
+      spill_unpin(seg);
+    }
+    writes.insert(upper_bound(writes.begin(), writes.end(), d), d);
+    drop_segments(s);
+    segments_.push_back(new MemorySegment(start));
+    for (size_t i = 0; i < writes.size(); i++) append(writes[i]);
+  }
+
+  // fills in the bytes of [offset, offset+len) known as of clnum, leaves the rest of out alone
+  void Fetch(Clnum clnum, int offset, int len, MemoryWithValid *out) const {
+    size_t s = find_segment(clnum);
+    if (s == 0) return;
+    MemorySegment *seg = segments_[s-1];
+    spill_pin(seg);
+    if (seg->start != NULL) {
+      const MemoryKeyframe *kf = seg->start;
+      for (int i = offset; i < offset+len; i++) {
+        if (kf->valid[i/8] & (1 << (i%8))) out[i-offset] = MEMORY_VALID | kf->data[i];
+      }
+    }
+    const vector<MemoryDelta> &deltas = seg->deltas;
+    Clnum rel_clnum = clnum - seg->first_clnum;
+    for (size_t i = 0; i < deltas.size() && deltas[i].rel_clnum <= rel_clnum; i++) {
+      const MemoryDelta &d = deltas[i];
+      if (d.offset >= offset && d.offset < offset+len) {
+        out[d.offset-offset] = MEMORY_VALID | d.data;
+      }
+    }
+    spill_unpin(seg);
+  }
+
+  // if any delta is in [start_clnum, end_clnum]
+  bool HasDeltas(Clnum start_clnum, Clnum end_clnum) const {
+    size_t s = find_segment(end_clnum);
+    if (s == 0) return false;
+    MemorySegment *seg = segments_[s-1];
+    if (seg->first_clnum >= start_clnum) return true;
+    MemoryDelta d;
+    d.rel_clnum = start_clnum - seg->first_clnum;
+    spill_pin(seg);
+    vector<MemoryDelta>::const_iterator it = lower_bound(seg->deltas.begin(), seg->deltas.end(), d);
+    bool ret = it != seg->deltas.end() && it->rel_clnum <= end_clnum - seg->first_clnum;
+    spill_unpin(seg);
+    return ret;
+  }
+
+  // every segment as it spills, keyframe and all, so loading doesn't replay anything
+  void Save(IndexWriter *w) const {
+    w->put<uint64_t>(segments_.size());
+    for (size_t i = 0; i < segments_.size(); i++) {
+      w->put<Clnum>(segments_[i]->first_clnum);
+      w->put<uint64_t>(segments_[i]->delta_count);
+      spill_put(segments_[i], w);
+    }
+  }
+
+  // the sealed segments stay in the mapped index until they're pinned, only the last one is copied
+  // r's data must outlive the page
+  bool Load(IndexReader *r) {
+    drop_segments(0);
+    for (uint64_t cnt = r->get<uint64_t>(); r->ok() && cnt > 0; cnt--) {
+      Clnum first_clnum = r->get<Clnum>();
+      uint64_t delta_count = r->get<uint64_t>();
+      uint64_t len = r->get<uint64_t>();
+      const uint8_t *dat = r->get_bytes(len);
+      if (dat == NULL || len < 1 + delta_count*sizeof(MemoryDelta)) return false;
+      MemorySegment *seg = new MemorySegment(NULL);
+      seg->first_clnum = first_clnum;
+      seg->delta_count = delta_count;
+      segments_.push_back(seg);
+      delta_count_ += delta_count;
+      if (cnt > 1) {
+        spill_add_mapped(seg, dat, len);
+      } else if (!seg->load(dat, len) || seg->deltas.size() != delta_count) {
+        return false;
+      }
+    }
+    return r->ok();
+  }
+
+private:
+  // the number of segments that start at or before clnum
+  size_t find_segment(Clnum clnum) const {
+    size_t lo = 0, hi = segments_.size();
+    while (lo < hi) {
+      size_t mid = (lo+hi)/2;
+      if (segments_[mid]->first_clnum <= clnum) lo = mid+1;
+      else hi = mid;
+    }
+    return lo;
+  }
+
+  // w is at or after every delta
+  void append(const MemoryWrite &w) {
+    if (segments_.empty()) segments_.push_back(new MemorySegment(NULL));
+    MemorySegment *tail = segments_.back();
+    // don't split a clnum across segments
+    if (!tail->deltas.empty() && tail->last_clnum() != w.clnum &&
+        (tail->deltas.size() >= KEYFRAME_DELTAS || w.clnum - tail->first_clnum > MEMORY_DELTA_MAX_CLNUM)) {
+      seal();
+      tail = segments_.back();
+    }
+    if (tail->deltas.empty()) tail->first_clnum = w.clnum;
+    MemoryDelta d;
+    d.rel_clnum = w.clnum - tail->first_clnum;
+    d.offset = w.offset;
+    d.data = w.data;
+    tail->deltas.push_back(d);
+    tail->delta_count++;
+    delta_count_++;
+  }
+
+  void seal() {
+    MemorySegment *tail = segments_.back();
+    MemoryKeyframe *kf = new MemoryKeyframe;
+    if (tail->start == NULL) {
+      memset(kf->data, 0, sizeof(kf->data));
+      memset(kf->valid, 0, sizeof(kf->valid));
+    } else {
+      memcpy(kf, tail->start, sizeof(MemoryKeyframe));
+    }
+    for (size_t i = 0; i < tail->deltas.size(); i++) {
+      const MemoryDelta &d = tail->deltas[i];
+      kf->data[d.offset] = d.data;
+      kf->valid[d.offset/8] |= 1 << (d.offset%8);
+    }
+    vector<MemoryDelta>(tail->deltas).swap(tail->deltas);
+    segments_.push_back(new MemorySegment(kf));
+    spill_add(tail);
+  }
+
+  void drop_segments(size_t from) {
+    for (size_t i = from; i < segments_.size(); i++) {
+      delta_count_ -= segments_[i]->delta_count;
+      delete segments_[i];
+    }
+    segments_.resize(from);
+  }
+
+  // no copying, the segments are owned
+  MemoryPage(const MemoryPage &);
+  MemoryPage &operator=(const MemoryPage &);
+
+  // by first_clnum, only the last isn't sealed
+  vector<MemorySegment*> segments_;
+  uint64_t delta_count_;
+};
+
+#endif
+
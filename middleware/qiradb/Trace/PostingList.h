@@ -0,0 +1,379 @@
+#ifndef POSTINGLIST_H
+#define POSTINGLIST_H
+
+// a sorted list of clnums, stored as varint deltas in blocks of POSTING_BLOCK
+// clnums arrive in order, so it's append only
+// the first clnum of every block is kept whole in a skip list to binary search
+// every POSTING_SPAN_BLOCKS blocks are sealed into a span that can spill, the offsets are into the span
+// most addresses are only touched once or twice, a list of one or two clnums is only its 32 bytes
+// measured with the map node and malloc's overhead, a key with 1, 2, 3 or 4 clnums is 88, 88, 200 and 200 bytes,
+// where it was 144, 188, 224 and 267 with a std::set<Clnum>
+
+#include <algorithm>
+#include "Index.h"
+
+#define POSTING_BLOCK 128
+#define POSTING_SPAN_BLOCKS 64
+
+class PostingSpan : public Spillable {
+public:
+  PostingSpan() {}
+  ~PostingSpan() { spill_forget(this); }
+
+  size_t resident_bytes() const { return data.capacity(); }
+  void save(vector<uint8_t> *out) const { out->insert(out->end(), data.begin(), data.end()); }
+  bool load(const uint8_t *dat, size_t len) { data.assign(dat, dat+len); return true; }
+  void drop() { vector<uint8_t>().swap(data); }
+
+  vector<uint8_t> data;
+
+private:
+  PostingSpan(const PostingSpan &);
+  PostingSpan &operator=(const PostingSpan &);
+};
+
+class PostingList {
+public:
+  PostingList() : count_(0), first_(0), last_(0), blocks_(NULL) {}
+  ~PostingList() { delete blocks_; }
+
+  PostingList(const PostingList &pl) : count_(0), first_(0), last_(0), blocks_(NULL) { *this = pl; }
+  PostingList &operator=(const PostingList &pl) {
+    if (this == &pl) return *this;
+    count_ = pl.count_; first_ = pl.first_; last_ = pl.last_;
+    delete blocks_;
+    blocks_ = NULL;
+    if (pl.blocks_ != NULL) {
+      blocks_ = new Blocks();
+      blocks_->data = pl.blocks_->data;
+      blocks_->skips = pl.blocks_->skips;
+      if (pl.blocks_->unsorted != NULL) blocks_->unsorted = new set<Clnum>(*pl.blocks_->unsorted);
+      for (size_t i = 0; i < pl.blocks_->spans.size(); i++) {
+        PostingSpan *span = new PostingSpan();
+        spill_pin(pl.blocks_->spans[i]);
+        span->data = pl.blocks_->spans[i]->data;
+        spill_unpin(pl.blocks_->spans[i]);
+        blocks_->spans.push_back(span);
+        spill_add(span);
+      }
+    }
+    return *this;
+  }
+
+  void Append(Clnum clnum) {
+    if (count_ > 0 && clnum <= last_) {
+      if (clnum == last_) return;
+      // out of order, this is rare enough to not compress
+      Blocks *b = blocks();
+      if (b->unsorted == NULL) b->unsorted = new set<Clnum>();
+      b->unsorted->insert(clnum);
+      return;
+    }
+    if (count_ == 0) {
+      first_ = clnum;
+    } else if (count_ % POSTING_BLOCK == 0) {
+      if ((count_ / POSTING_BLOCK) % POSTING_SPAN_BLOCKS == 0) seal();
+      Skip s;
+      s.first = clnum;
+      s.offset = blocks_->data.size();
+      blocks_->skips.push_back(s);
+    } else if (count_ > 1) {
+      // the second one was only in last_ until now
+      if (count_ == 2) put_varint(last_ - first_);
+      put_varint(clnum - last_);
+    }
+    last_ = clnum;
+    count_++;
+  }
+
+  size_t size() const { return count_ + ((blocks_ == NULL || blocks_->unsorted == NULL) ? 0 : blocks_->unsorted->size()); }
+
+  // the clnums in [start_clnum, end_clnum), at most limit of them if limit isn't 0
+  void Fetch(Clnum start_clnum, Clnum end_clnum, unsigned int limit, vector<Clnum> *out) const {
+    size_t base = out->size();
+    const set<Clnum> *unsorted = (blocks_ == NULL) ? NULL : blocks_->unsorted;
+    // with out of order clnums, get everything in the range and cut after the merge
+    unsigned int block_limit = (unsorted == NULL) ? limit : 0;
+    if (count_ > 0 && count_ <= 2) {
+      Clnum clnums[2] = {first_, last_};
+      for (uint64_t i = 0; i < count_ && clnums[i] < end_clnum; i++) {
+        if (clnums[i] >= start_clnum && (block_limit == 0 || out->size() - base < block_limit)) out->push_back(clnums[i]);
+      }
+    } else if (count_ > 0 && start_clnum <= last_) {
+      const vector<Skip> &skips = blocks_->skips;
+      size_t block = block_at(start_clnum);
+      Clnum clnum = (block == 0) ? first_ : skips[block-1].first;
+      size_t offset = (block == 0) ? 0 : skips[block-1].offset;
+      PostingSpan *span = NULL;
+      const uint8_t *dat = block_data(block, &span);
+      uint64_t left = count_ - block*POSTING_BLOCK;
+      for (uint64_t i = 0; i < left; i++) {
+        if (i > 0) {
+          if (i % POSTING_BLOCK == 0) {
+            size_t b = block + i/POSTING_BLOCK;
+            clnum = skips[b-1].first;
+            offset = skips[b-1].offset;
+            if (b % POSTING_SPAN_BLOCKS == 0) {
+              if (span != NULL) spill_unpin(span);
+              dat = block_data(b, &span);
+            }
+          } else {
+            clnum += get_varint(dat, &offset);
+          }
+        }
+        if (clnum >= end_clnum) break;
+        if (clnum < start_clnum) continue;
+        out->push_back(clnum);
+        if (block_limit != 0 && out->size() - base == block_limit) break;
+      }
+      if (span != NULL) spill_unpin(span);
+    }
+    if (unsorted != NULL) {
+      for (set<Clnum>::const_iterator it = unsorted->lower_bound(start_clnum);
+           it != unsorted->end() && *it < end_clnum; ++it) {
+        out->push_back(*it);
+      }
+      sort(out->begin() + base, out->end());
+      out->erase(unique(out->begin() + base, out->end()), out->end());
+      if (limit != 0 && out->size() - base > limit) out->resize(base + limit);
+    }
+  }
+
+  // how many clnums are in [start_clnum, end_clnum), and the first and last of them, without fetching them
+  // the blocks in the middle are counted whole, only the ones at the ends are decoded
+  uint64_t Count(Clnum start_clnum, Clnum end_clnum, Clnum *first, Clnum *last) const {
+    uint64_t ret = 0;
+    *first = INVALID_CLNUM;
+    *last = 0;
+    if (count_ > 0 && start_clnum < end_clnum && start_clnum <= last_ && end_clnum > first_) {
+      if (start_clnum <= first_ && end_clnum > last_) {
+        ret = count_;
+        *first = first_;
+        *last = last_;
+      } else {
+        size_t b0 = block_at(start_clnum), b1 = block_at(end_clnum-1);
+        for (size_t b = b0; b <= b1; b++) {
+          if (b > b0 && b < b1) {
+            // block b starts at skips[b-1]
+            ret += POSTING_BLOCK;
+            *first = min(*first, blocks_->skips[b-1].first);
+            continue;
+          }
+          vector<Clnum> clnums;
+          decode_block(b, &clnums);
+          for (size_t i = 0; i < clnums.size(); i++) {
+            if (clnums[i] < start_clnum || clnums[i] >= end_clnum) continue;
+            ret++;
+            *first = min(*first, clnums[i]);
+            *last = max(*last, clnums[i]);
+          }
+        }
+      }
+    }
+    if (blocks_ != NULL && blocks_->unsorted != NULL) {
+      for (set<Clnum>::const_iterator it = blocks_->unsorted->lower_bound(start_clnum);
+           it != blocks_->unsorted->end() && *it < end_clnum; ++it) {
+        // it can also be in the blocks
+        vector<Clnum> clnums;
+        if (count_ > 0 && *it >= first_ && *it <= last_) decode_block(block_at(*it), &clnums);
+        if (binary_search(clnums.begin(), clnums.end(), *it)) continue;
+        ret++;
+        *first = min(*first, *it);
+        *last = max(*last, *it);
+      }
+    }
+    return ret;
+  }
+
+  // the last clnum before clnum, INVALID_CLNUM if there's none, only the block it's in is decoded
+  Clnum Before(Clnum clnum) const {
+    Clnum ret = INVALID_CLNUM;
+    if (count_ > 0 && clnum > first_) {
+      vector<Clnum> clnums;
+      // the block starts before clnum, so it has one
+      decode_block(block_at(clnum-1), &clnums);
+      ret = *(lower_bound(clnums.begin(), clnums.end(), clnum) - 1);
+    }
+    if (blocks_ != NULL && blocks_->unsorted != NULL) {
+      set<Clnum>::const_iterator it = blocks_->unsorted->lower_bound(clnum);
+      if (it != blocks_->unsorted->begin()) {
+        --it;
+        if (ret == INVALID_CLNUM || *it > ret) ret = *it;
+      }
+    }
+    return ret;
+  }
+
+  // the spans as they spill, then the blocks past them
+  void Save(IndexWriter *w) const {
+    w->put<uint64_t>(count_);
+    w->put<Clnum>(first_);
+    w->put<Clnum>(last_);
+    if (blocks_ == NULL) {
+      // no spans, no data, no skips and nothing out of order
+      for (int i = 0; i < 4; i++) w->put<uint64_t>(0);
+      return;
+    }
+    w->put<uint64_t>(blocks_->spans.size());
+    for (size_t i = 0; i < blocks_->spans.size(); i++) spill_put(blocks_->spans[i], w);
+    w->put<uint64_t>(blocks_->data.size());
+    w->put_vector(blocks_->data);
+    w->put<uint64_t>(blocks_->skips.size());
+    w->put_vector(blocks_->skips);
+    w->put<uint64_t>((blocks_->unsorted == NULL) ? 0 : blocks_->unsorted->size());
+    if (blocks_->unsorted != NULL) {
+      for (set<Clnum>::const_iterator it = blocks_->unsorted->begin(); it != blocks_->unsorted->end(); ++it) {
+        w->put<Clnum>(*it);
+      }
+    }
+  }
+
+  // the spans stay in the mapped index until they're pinned, r's data must outlive the list
+  bool Load(IndexReader *r) {
+    delete blocks_;
+    blocks_ = NULL;
+    count_ = r->get<uint64_t>();
+    first_ = r->get<Clnum>();
+    last_ = r->get<Clnum>();
+    vector<uint64_t> lens;
+    for (uint64_t cnt = r->get<uint64_t>(); r->ok() && cnt > 0; cnt--) {
+      uint64_t len = r->get<uint64_t>();
+      const uint8_t *dat = r->get_bytes(len);
+      if (dat == NULL) return false;
+      PostingSpan *span = new PostingSpan();
+      blocks()->spans.push_back(span);
+      spill_add_mapped(span, dat, len);
+      lens.push_back(len);
+    }
+    uint64_t len = r->get<uint64_t>();
+    const uint8_t *dat = r->get_bytes(len);
+    if (dat == NULL) return false;
+    if (len > 0) blocks()->data.assign(dat, dat+len);
+    lens.push_back(len);
+    len = r->get<uint64_t>();
+    dat = r->get_bytes(len*sizeof(Skip));
+    if (dat == NULL) return false;
+    if (len > 0) blocks()->skips.assign((const Skip *)dat, ((const Skip *)dat) + len);
+    // block b starts at skips[b-1].offset into span b / POSTING_SPAN_BLOCKS
+    for (uint64_t i = 0; i < len; i++) {
+      size_t s = (i+1) / POSTING_SPAN_BLOCKS;
+      if (s >= lens.size() || blocks_->skips[i].offset > lens[s]) return false;
+    }
+    for (uint64_t cnt = r->get<uint64_t>(); r->ok() && cnt > 0; cnt--) {
+      Blocks *b = blocks();
+      if (b->unsorted == NULL) b->unsorted = new set<Clnum>();
+      b->unsorted->insert(r->get<Clnum>());
+    }
+    // the first two clnums are never in the blocks
+    if (count_ > 2 && blocks_ == NULL) return false;
+    return r->ok();
+  }
+
+private:
+  struct Skip {
+    Clnum first;
+    uint64_t offset;
+  };
+
+  // what a list has past its first two clnums, and the out of order ones
+  // most lists never have any, so they're just count_, first_ and last_
+  struct Blocks {
+    Blocks() : unsorted(NULL) {}
+    ~Blocks() {
+      for (size_t i = 0; i < spans.size(); i++) delete spans[i];
+      delete unsorted;
+    }
+    // the blocks past the spans
+    vector<uint8_t> data;
+    vector<PostingSpan*> spans;
+    vector<Skip> skips;
+    set<Clnum> *unsorted;
+  };
+
+  Blocks *blocks() {
+    if (blocks_ == NULL) blocks_ = new Blocks();
+    return blocks_;
+  }
+
+  // the last block that starts at or before clnum
+  size_t block_at(Clnum clnum) const {
+    if (blocks_ == NULL) return 0;
+    const vector<Skip> &skips = blocks_->skips;
+    size_t lo = 0, hi = skips.size();
+    while (lo < hi) {
+      size_t mid = (lo+hi)/2;
+      if (skips[mid].first <= clnum) lo = mid+1;
+      else hi = mid;
+    }
+    return lo;
+  }
+
+  void decode_block(size_t block, vector<Clnum> *out) const {
+    if (count_ <= 2) {
+      if (count_ > 0) out->push_back(first_);
+      if (count_ > 1) out->push_back(last_);
+      return;
+    }
+    Clnum clnum = (block == 0) ? first_ : blocks_->skips[block-1].first;
+    size_t offset = (block == 0) ? 0 : blocks_->skips[block-1].offset;
+    PostingSpan *span = NULL;
+    const uint8_t *dat = block_data(block, &span);
+    uint64_t n = min((uint64_t)POSTING_BLOCK, count_ - block*POSTING_BLOCK);
+    for (uint64_t i = 0; i < n; i++) {
+      if (i > 0) clnum += get_varint(dat, &offset);
+      out->push_back(clnum);
+    }
+    if (span != NULL) spill_unpin(span);
+  }
+
+  // the bytes block is in, if it's in a span it's pinned
+  const uint8_t *block_data(size_t block, PostingSpan **span) const {
+    size_t s = block / POSTING_SPAN_BLOCKS;
+    if (s < blocks_->spans.size()) {
+      *span = blocks_->spans[s];
+      spill_pin(*span);
+      return (*span)->data.empty() ? NULL : &(*span)->data[0];
+    }
+    *span = NULL;
+    return blocks_->data.empty() ? NULL : &blocks_->data[0];
+  }
+
+  // the blocks so far are full, they go to a span and data starts over
+  void seal() {
+    PostingSpan *span = new PostingSpan();
+    span->data.swap(blocks_->data);
+    vector<uint8_t>(span->data).swap(span->data);
+    blocks_->spans.push_back(span);
+    spill_add(span);
+  }
+
+  void put_varint(Clnum v) {
+    vector<uint8_t> &data = blocks()->data;
+    while (v >= 0x80) {
+      data.push_back((v & 0x7F) | 0x80);
+      v >>= 7;
+    }
+    data.push_back(v);
+  }
+
+  static Clnum get_varint(const uint8_t *dat, size_t *offset) {
+    Clnum ret = 0;
+    int shift = 0;
+    while (1) {
+      uint8_t b = dat[(*offset)++];
+      ret |= (Clnum)(b & 0x7F) << shift;
+      if (!(b & 0x80)) break;
+      shift += 7;
+    }
+    return ret;
+  }
+
+  uint64_t count_;
+  // block 0 starts at first_ and offset 0, a list of one or two clnums is only first_ and last_
+  Clnum first_, last_;
+  // NULL until there's a third clnum or an out of order one
+  Blocks *blocks_;
+};
+
+#endif
+
@@ -0,0 +1,284 @@
+#ifndef SPILL_H
+#define SPILL_H
+
+// a memory budget for the whole process, shared by every trace in it
+// the indexes are cut into segments by clnum, and once a segment is sealed nothing changes it
+// over the budget, the least recently used sealed segments are written to a temp file and dropped
+// a query that needs one pins it, which reads it back in
+// the file I/O runs without spill_mutex_, a segment it's running for is busy_ until it's done
+// the sealed segments of a loaded index start out like that, read in from the index's mapping
+// the budget is 0 by default, which never spills
+
+#include <list>
+#include "Index.h"
+
+#ifndef _WIN32
+#include <stdlib.h>
+#include <unistd.h>
+#endif
+
+class Spillable {
+public:
+  Spillable() : pins_(0), resident_(true), added_(false), on_disk_(false), busy_(false), disk_offset_(0), disk_size_(0), bytes_(0), mapped_(NULL) {}
+  // subclasses call spill_forget before they free anything
+  virtual ~Spillable() {}
+
+  // what it holds while it's in memory
+  virtual size_t resident_bytes() const = 0;
+  virtual void save(vector<uint8_t> *out) const = 0;
+  virtual bool load(const uint8_t *dat, size_t len) = 0;
+  virtual void drop() = 0;
+
+  // only the spill functions touch these, under spill_mutex_
+  int pins_;
+  bool resident_, added_, on_disk_;
+  // being read in, or written out while it stays readable, nobody else reads it in, spills or frees it meanwhile
+  bool busy_;
+  uint64_t disk_offset_, disk_size_;
+  size_t bytes_;
+  // where what save() writes already is in a mapping that outlives it, instead of the spill file
+  const uint8_t *mapped_;
+  list<Spillable*>::iterator lru_;
+};
+
+struct SpillStats {
+  uint64_t budget;
+  // the sealed segments in memory, and the ones only on disk
+  uint64_t resident_bytes, spilled_bytes;
+  uint64_t spills, reloads;
+};
+
+static MUTEX spill_mutex_ = MUTEX_INITIALIZER;
+// broadcast when a segment stops being busy_
+static COND spill_cond_ = COND_INITIALIZER;
+// the front is the most recently used, only the resident sealed segments are in it
+static list<Spillable*> spill_lru_;
+static SpillStats spill_stats_ = {0, 0, 0, 0, 0};
+// the spilled segments are appended and never rewritten, a forgotten one's space isn't reused
+static uint64_t spill_end_ = 0;
+// what's being written out still counts as resident until it's dropped
+static uint64_t spill_writing_bytes_ = 0;
+static bool spill_open_ = false;
+static QIRAFILE spill_fd_;
+
+static bool spill_open_file() {
+  if (spill_open_) return true;
+#ifdef _WIN32
+  char dir[MAX_PATH], fn[MAX_PATH];
+  if (GetTempPathA(MAX_PATH, dir) == 0 || GetTempFileNameA(dir, "qsp", 0, fn) == 0) return false;
+  spill_fd_ = CreateFileA(fn, GENERIC_READ | GENERIC_WRITE, 0, NULL, CREATE_ALWAYS,
+                          FILE_ATTRIBUTE_TEMPORARY | FILE_FLAG_DELETE_ON_CLOSE, NULL);
+  if (spill_fd_ == INVALID_HANDLE_VALUE) return false;
+#else
+  const char *dir = getenv("TMPDIR");
+  string fn = string((dir != NULL) ? dir : "/tmp") + "/qira_spill_XXXXXX";
+  vector<char> tmpl(fn.begin(), fn.end());
+  tmpl.push_back('\0');
+  spill_fd_ = mkstemp(&tmpl[0]);
+  if (spill_fd_ == -1) return false;
+  // it goes away with the process
+  unlink(&tmpl[0]);
+#endif
+  spill_open_ = true;
+  return true;
+}
+
+// the file I/O, without the lock
+// the spill file is only appended to, so what a segment spilled to never changes
+static bool spill_write(const vector<uint8_t> &dat, uint64_t offset) {
+#ifdef _WIN32
+  OVERLAPPED o;
+  memset(&o, 0, sizeof(o));
+  o.Offset = (DWORD)offset;
+  o.OffsetHigh = (DWORD)(offset >> 32);
+  DWORD wrote = 0;
+  return dat.empty() || (WriteFile(spill_fd_, &dat[0], (DWORD)dat.size(), &wrote, &o) && wrote == dat.size());
+#else
+  return dat.empty() || pwrite(spill_fd_, &dat[0], dat.size(), offset) == (ssize_t)dat.size();
+#endif
+}
+
+static bool spill_read(const Spillable *s, vector<uint8_t> *dat) {
+  dat->resize(s->disk_size_);
+#ifdef _WIN32
+  OVERLAPPED o;
+  memset(&o, 0, sizeof(o));
+  o.Offset = (DWORD)s->disk_offset_;
+  o.OffsetHigh = (DWORD)(s->disk_offset_ >> 32);
+  DWORD got = 0;
+  return dat->empty() || (ReadFile(spill_fd_, &(*dat)[0], (DWORD)dat->size(), &got, &o) && got == dat->size());
+#else
+  return dat->empty() || pread(spill_fd_, &(*dat)[0], dat->size(), s->disk_offset_) == (ssize_t)dat->size();
+#endif
+}
+
+static bool spill_load(Spillable *s) {
+  if (s->mapped_ != NULL) return s->load(s->mapped_, s->disk_size_);
+  vector<uint8_t> dat;
+  return spill_read(s, &dat) && s->load(dat.empty() ? NULL : &dat[0], dat.size());
+}
+
+// drops the least recently used unpinned segments until it's under the budget, writing out the ones that
+// were never spilled first, the lock is let go for the writes and the segment stays readable meanwhile
+// called without the lock
+static void spill_evict() {
+  MUTEX_LOCK(spill_mutex_);
+  while (spill_stats_.budget != 0 && spill_stats_.resident_bytes - spill_writing_bytes_ > spill_stats_.budget) {
+    Spillable *s = NULL;
+    for (list<Spillable*>::reverse_iterator it = spill_lru_.rbegin(); it != spill_lru_.rend(); ++it) {
+      if ((*it)->pins_ == 0 && !(*it)->busy_) {
+        s = *it;
+        break;
+      }
+    }
+    if (s == NULL) break;
+    // a segment that was spilled before is still on disk
+    if (!s->on_disk_) {
+      if (!spill_open_file()) {
+        printf("ERROR: can't open a spill file, staying over the memory budget\n");
+        break;
+      }
+      s->busy_ = true;
+      spill_writing_bytes_ += s->bytes_;
+      MUTEX_UNLOCK(spill_mutex_);
+      // it's sealed, nothing changes it under the save
+      vector<uint8_t> dat;
+      s->save(&dat);
+      MUTEX_LOCK(spill_mutex_);
+      uint64_t offset = spill_end_;
+      spill_end_ += dat.size();
+      MUTEX_UNLOCK(spill_mutex_);
+      bool ok = spill_write(dat, offset);
+      MUTEX_LOCK(spill_mutex_);
+      s->busy_ = false;
+      spill_writing_bytes_ -= s->bytes_;
+      COND_BROADCAST(spill_cond_);
+      if (!ok) {
+        printf("ERROR: writing the spill file failed, staying over the memory budget\n");
+        break;
+      }
+      s->disk_offset_ = offset;
+      s->disk_size_ = dat.size();
+      s->on_disk_ = true;
+      // a query pinned it while it was written, it's dropped next time
+      if (s->pins_ > 0) continue;
+    }
+    s->drop();
+    s->resident_ = false;
+    spill_stats_.resident_bytes -= s->bytes_;
+    spill_stats_.spilled_bytes += s->disk_size_;
+    spill_stats_.spills++;
+    spill_lru_.erase(s->lru_);
+  }
+  MUTEX_UNLOCK(spill_mutex_);
+}
+
+// s is sealed, from here on it can spill
+static void spill_add(Spillable *s) {
+  MUTEX_LOCK(spill_mutex_);
+  s->bytes_ = s->resident_bytes();
+  s->added_ = true;
+  spill_lru_.push_front(s);
+  s->lru_ = spill_lru_.begin();
+  spill_stats_.resident_bytes += s->bytes_;
+  MUTEX_UNLOCK(spill_mutex_);
+  spill_evict();
+}
+
+// s is sealed and what its save() wrote is the len bytes at dat, it isn't read in until it's pinned
+static void spill_add_mapped(Spillable *s, const uint8_t *dat, size_t len) {
+  MUTEX_LOCK(spill_mutex_);
+  s->drop();
+  s->added_ = true;
+  s->resident_ = false;
+  s->on_disk_ = true;
+  s->mapped_ = dat;
+  s->disk_size_ = len;
+  spill_stats_.spilled_bytes += len;
+  MUTEX_UNLOCK(spill_mutex_);
+}
+
+// s stays in memory until it's unpinned
+static void spill_pin(Spillable *s) {
+  MUTEX_LOCK(spill_mutex_);
+  // another query is reading it in
+  while (s->busy_ && !s->resident_) COND_WAIT(spill_cond_, spill_mutex_);
+  s->pins_++;
+  if (!s->resident_) {
+    s->busy_ = true;
+    MUTEX_UNLOCK(spill_mutex_);
+    if (!spill_load(s)) {
+      // a query gets less back instead of the server going down
+      printf("ERROR: reading back a spilled segment failed\n");
+      s->drop();
+    }
+    MUTEX_LOCK(spill_mutex_);
+    s->busy_ = false;
+    s->resident_ = true;
+    s->bytes_ = s->resident_bytes();
+    spill_lru_.push_front(s);
+    s->lru_ = spill_lru_.begin();
+    spill_stats_.resident_bytes += s->bytes_;
+    spill_stats_.spilled_bytes -= s->disk_size_;
+    spill_stats_.reloads++;
+    COND_BROADCAST(spill_cond_);
+  } else if (s->added_) {
+    spill_lru_.splice(spill_lru_.begin(), spill_lru_, s->lru_);
+  }
+  MUTEX_UNLOCK(spill_mutex_);
+  spill_evict();
+}
+
+static void spill_unpin(Spillable *s) {
+  MUTEX_LOCK(spill_mutex_);
+  s->pins_--;
+  bool unpinned = s->pins_ == 0;
+  MUTEX_UNLOCK(spill_mutex_);
+  if (unpinned) spill_evict();
+}
+
+// the length and then what s->save() writes, for the index
+// a spilled segment is copied from where it spilled to, it isn't read back in
+static void spill_put(Spillable *s, IndexWriter *w) {
+  MUTEX_LOCK(spill_mutex_);
+  while (s->busy_ && !s->resident_) COND_WAIT(spill_cond_, spill_mutex_);
+  bool resident = s->resident_;
+  if (resident) s->pins_++;
+  MUTEX_UNLOCK(spill_mutex_);
+  // only its owner frees it, and that's who saves it
+  if (!resident && s->mapped_ != NULL) {
+    w->put<uint64_t>(s->disk_size_);
+    w->put_bytes(s->mapped_, s->disk_size_);
+    return;
+  }
+  vector<uint8_t> dat;
+  if (resident) {
+    s->save(&dat);
+    spill_unpin(s);
+  } else if (!spill_read(s, &dat)) {
+    printf("ERROR: reading a spilled segment for the index failed\n");
+    w->fail();
+  }
+  w->put<uint64_t>(dat.size());
+  w->put_vector(dat);
+}
+
+// before s is freed
+static void spill_forget(Spillable *s) {
+  MUTEX_LOCK(spill_mutex_);
+  // it can still be being written out
+  while (s->busy_) COND_WAIT(spill_cond_, spill_mutex_);
+  if (s->added_) {
+    if (s->resident_) {
+      spill_lru_.erase(s->lru_);
+      spill_stats_.resident_bytes -= s->bytes_;
+    } else {
+      spill_stats_.spilled_bytes -= s->disk_size_;
+    }
+    s->added_ = false;
+  }
+  MUTEX_UNLOCK(spill_mutex_);
+}
+
+#endif
+
@@ -10,13 +10,81 @@
 #include <unistd.h>
 #include <sys/time.h>
 #include <sys/resource.h>
+#include <poll.h>
+#include <time.h>
+#endif
+#ifdef __linux__
+#include <sys/inotify.h>
 #endif
 
 #include "Trace.h"
+#include "Index.h"
 
 #define MP make_pair
 #define PAGE_MASK 0xFFFFFFFFFFFFF000LL
-#define INVALID_CLNUM 0xFFFFFFFF
+
+static MUTEX update_mutex_ = MUTEX_INITIALIZER;
+static COND update_cond_ = COND_INITIALIZER;
+static uint64_t update_seq_ = 0;
+
+static void notify_update() {
+  MUTEX_LOCK(update_mutex_);
+  update_seq_++;
+  COND_BROADCAST(update_cond_);
+  MUTEX_UNLOCK(update_mutex_);
+}
+
+// for time budgets, not the time of day
+static uint64_t now_ms() {
+#ifdef _WIN32
+  return GetTickCount64();
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec*1000 + ts.tv_nsec/1000000;
+#endif
+}
+
+uint64_t WaitForTraceUpdate(uint64_t seq, int timeout_ms) {
+  MUTEX_LOCK(update_mutex_);
+#ifdef _WIN32
+  DWORD deadline = GetTickCount() + timeout_ms;
+  while (update_seq_ == seq) {
+    DWORD now = GetTickCount();
+    if ((int)(deadline - now) <= 0) break;
+    SleepConditionVariableSRW(&update_cond_, &update_mutex_, deadline - now, 0);
+  }
+#else
+  struct timespec deadline;
+  clock_gettime(CLOCK_REALTIME, &deadline);
+  deadline.tv_sec += timeout_ms / 1000;
+  deadline.tv_nsec += (timeout_ms % 1000) * 1000000L;
+  if (deadline.tv_nsec >= 1000000000L) {
+    deadline.tv_sec++;
+    deadline.tv_nsec -= 1000000000L;
+  }
+  while (update_seq_ == seq) {
+    if (pthread_cond_timedwait(&update_cond_, &update_mutex_, &deadline) != 0) break;
+  }
+#endif
+  uint64_t ret = update_seq_;
+  MUTEX_UNLOCK(update_mutex_);
+  return ret;
+}
+
+void SetMemoryBudget(uint64_t budget) {
+  MUTEX_LOCK(spill_mutex_);
+  spill_stats_.budget = budget;
+  MUTEX_UNLOCK(spill_mutex_);
+  spill_evict();
+}
+
+SpillStats GetSpillStats() {
+  MUTEX_LOCK(spill_mutex_);
+  SpillStats ret = spill_stats_;
+  MUTEX_UNLOCK(spill_mutex_);
+  return ret;
+}
 
 void *thread_entry(void *trace_class) {
   Trace *t = (Trace *)trace_class;  // best c++ casting
@@ -25,36 +93,90 @@ void *thread_entry(void *trace_class) {
 #ifndef _WIN32
   setpriority(PRIO_PROCESS, 0, getpriority(PRIO_PROCESS, 0)+1);
 #endif
+  // here and not in the constructor, the trace is readable as it fills in either way
+  t->LoadIndex();
+
+  int idle_ms = INGEST_IDLE_MIN_MS;
   while (t->is_running_) {   // running?
-    t->process();
-    usleep(10 * 1000);
+    if (t->process()) {
+      // the batch was clamped, go right back for the rest
+      if (!t->IsCaughtUp()) continue;
+      idle_ms = INGEST_IDLE_MIN_MS;
+    } else {
+      if (t->WantsSave()) {
+        // caught up with the tracer, a good time to save
+        t->SaveIndex();
+      }
+      idle_ms = min(idle_ms*2, INGEST_IDLE_MAX_MS);
+    }
+    t->WaitForLog(idle_ms);
   }
   return NULL;
 }
 
 Trace::Trace() {
   entries_done_ = 1;
-  fd_ = 0;
-  backing_ = NULL;
   did_update_ = false;
+  value_index_ = false;
+  heat_shift_ = 0;
+  clnum_base_ = 0;
   max_clnum_ = 0;
   min_clnum_ = INVALID_CLNUM;
-  backing_size_ = 0;
   trace_index_ = 0;
   is_running_ = true;
+  index_dirty_ = false;
+  next_save_ms_ = 0;
+  index_map_ = NULL;
+  index_map_len_ = 0;
+  notify_fd_ = -1;
+  wake_fds_[0] = wake_fds_[1] = -1;
+  parent_id_ = -1;
+  first_clnum_ = 0;
+  MUTEX_INIT(epoch_mutex_);
+  epoch_.parent = NULL;
+  epoch_.fork_clnum = 0;
+  publish_epoch();
+
+  // one ingest worker per core
+#ifdef _WIN32
+  SYSTEM_INFO si;
+  GetSystemInfo(&si);
+  SetIngestThreads(si.dwNumberOfProcessors);
+#else
+  SetIngestThreads(sysconf(_SC_NPROCESSORS_ONLN));
+#endif
+}
+
+void Trace::SetIngestThreads(int ingest_threads) {
+  // each worker owns at least one shard
+  ingest_threads_ = max(1, min(ingest_threads, INDEX_SHARDS));
 }
 
 // the destructor isn't thread safe wrt to the accessor functions
 Trace::~Trace() {
   is_running_ = false;
+#ifndef _WIN32
+  // don't wait out the idle sleep
+  if (wake_fds_[1] != -1 && write(wake_fds_[1], "", 1) != 1) printf("WARNING: can't wake the ingest thread\n");
+#endif
   THREAD_JOIN(thread);
   // mutex lock isn't required now that the thread stopped
-#ifdef _WIN32
-  CloseHandle(fd_);
-#else
-  munmap((void*)backing_, backing_size_);
-  close(fd_);
+  // what came in since the last save would be ingested again next time
+  if (index_dirty_) SaveIndex();
+#ifndef _WIN32
+  if (notify_fd_ != -1) close(notify_fd_);
+  if (wake_fds_[0] != -1) close(wake_fds_[0]);
+  if (wake_fds_[1] != -1) close(wake_fds_[1]);
 #endif
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    for (map<Address, MemoryPage*>::iterator it = shards_[s].memory.begin(); it != shards_[s].memory.end(); ++it) {
+      delete it->second;
+    }
+    // the posting lists can be in the index too
+    shards_[s].addresstype_to_clnums.clear();
+    shards_[s].valuetype_to_clnums.clear();
+  }
+  unmap_index();
   //printf("dead\n");
 }
 
@@ -73,101 +195,81 @@ char Trace::get_type_from_flags(uint32_t flags) {
   return '?';
 }
 
-inline void Trace::commit_memory(Clnum clnum, Address a, uint8_t d) {
-  pair<map<Address, MemoryCell>::iterator, bool> ret = memory_.insert(MP(a, MemoryCell()));
-  ret.first->second[clnum] = d;
-}
-
-inline MemoryWithValid Trace::get_byte(Clnum clnum, Address a) {
-  //printf("get_byte %u %llx\n", clnum, a);
-  map<Address, MemoryCell>::iterator it = memory_.find(a);
-  if (it == memory_.end()) return 0;
-
-  MemoryCell::iterator it2 = it->second.upper_bound(clnum);
-  if (it2 == it->second.begin()) return 0;
-  else { --it2; return MEMORY_VALID | it2->second; }
-}
-
-bool Trace::remap_backing(uint64_t new_size) {
-  if (backing_size_ == new_size) return true;
-
-#ifdef _WIN32
-  while (1) {
-    DWORD fs = GetFileSize(fd_, NULL);
-    if (fs < new_size) {
-      printf("WARNING: requested %" PRIu64 " bytes, but only %llx are in the file...waiting\n", new_size, fs);
-      usleep(100 * 1000);
-    } else {
-      break;
-    }
-  }
-  MUTEX_LOCK(backing_mutex_);
-  HANDLE fileMapping = CreateFileMapping(fd_, NULL, PAGE_READONLY, 0, 0, NULL);
-  backing_ = (const struct change *)MapViewOfFileEx(fileMapping, FILE_MAP_READ, 0, 0, new_size, NULL);
-  // LEAKS!!!
-  MUTEX_UNLOCK(backing_mutex_);
-#else
-  while (1) {
-    off_t fs = lseek(fd_, 0, SEEK_END);
-    if ((unsigned int)fs < new_size) {
-      printf("WARNING: requested %" PRIu64 " bytes, but only %" PRIx64 " are in the file...waiting\n", new_size, fs);
-      usleep(100 * 1000);
+inline void Trace::commit_register(Clnum clnum, int reg, uint64_t d) {
+  RegisterColumn &col = registers_[reg];
+  if (col.clnums.empty() || col.clnums.back() < clnum) {
+    col.clnums.push_back(clnum);
+    col.values.push_back(d);
+  } else if (col.clnums.back() == clnum) {
+    col.values.back() = d;
+  } else {
+    // out of order
+    vector<Clnum>::iterator it = lower_bound(col.clnums.begin(), col.clnums.end(), clnum);
+    size_t idx = it - col.clnums.begin();
+    if (*it == clnum) {
+      col.values[idx] = d;
     } else {
-      break;
+      col.clnums.insert(it, clnum);
+      col.values.insert(col.values.begin() + idx, d);
     }
   }
-  MUTEX_LOCK(backing_mutex_);
-  munmap((void*)backing_, backing_size_);
-  backing_size_ = new_size;
-  backing_ = (const struct change *)mmap(NULL, backing_size_, PROT_READ, MAP_SHARED, fd_, 0);
-  MUTEX_UNLOCK(backing_mutex_);
-#endif
-
-  if (backing_ == NULL) {
-    printf("ERROR: remap_backing is about to return NULL\n");
-  }
-  return (backing_ != NULL);
 }
 
-bool Trace::ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian) {
+bool Trace::ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian, char *index_filename) {
   trace_index_ = trace_index;
   is_big_endian_ = is_big_endian;
   register_size_ = register_size;
   register_count_ = register_count;
-  RWLOCK_INIT(db_lock_);
-  MUTEX_INIT(backing_mutex_);
+  RWLOCK_INIT(clnums_lock_);
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    RWLOCK_INIT(shards_[s].lock);
+    shards_[s].heat_shift = 0;
+  }
 
   registers_.resize(register_count_);
+  for (int i = 0; i < register_count_; i++) RWLOCK_INIT(registers_[i].lock);
 
-#ifdef _WIN32
-  fd_ = CreateFile(filename, GENERIC_READ, FILE_SHARE_READ, NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
-#else
-  fd_ = open(filename, O_RDONLY);
-  if (fd_ == -1) {
-    printf("ERROR: file open failed\n");
+  if (!log_.Open(filename)) return false;
+  first_clnum_ = log_.GetFirstClnum();
+  parent_id_ = log_.GetParentId();
+
+  // the ingest thread loads it
+  if (index_filename != NULL) index_filename_ = index_filename;
+
+#ifndef _WIN32
+  if (pipe(wake_fds_) != 0) {
+    printf("ERROR: wake pipe failed\n");
     return false;
   }
 #endif
-
-  if (!remap_backing(sizeof(struct change))) {
-    printf("ERROR: remap backing failed\n");
-    return false;
+#ifdef __linux__
+  // a v1 tracer grows the file with ftruncate, the writes into the mapping don't show up
+  notify_fd_ = inotify_init1(IN_NONBLOCK | IN_CLOEXEC);
+  if (notify_fd_ != -1 && inotify_add_watch(notify_fd_, filename, IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE) == -1) {
+    close(notify_fd_);
+    notify_fd_ = -1;
   }
+#endif
 
   THREAD_CREATE(thread, thread_entry, this);
   return true;
 }
 
-void Trace::process() {
-  MUTEX_LOCK(backing_mutex_);
-  EntryNumber entry_count = *((EntryNumber*)backing_);  // don't let this change under me
-  MUTEX_UNLOCK(backing_mutex_);
+bool Trace::process() {
+  EntryNumber entry_count = log_.GetEntryCount();  // don't let this change under me
+  if (entries_done_ >= entry_count) return false;       // handle the > case better
 
-  if (entries_done_ >= entry_count) return;       // handle the > case better
-
-  remap_backing(sizeof(struct change)*entry_count); // what if this fails?
+  // clamping, to the batch and to the chunk
+  EntryNumber count = min(entry_count - entries_done_, (EntryNumber)INGEST_BATCH);
+  const struct change *entries = log_.Pin(entries_done_, &count);
+  if (count == 0) {
+    printf("ERROR: on %u entry %" PRIu64 " isn't in the log\n", trace_index_, entries_done_);
+    log_.Unpin(entries);
+    return false;
+  }
+  entry_count = entries_done_ + count;
 
-  printf("on %u going from %u to %u...", trace_index_, entries_done_, entry_count);
+  printf("on %u going from %" PRIu64 " to %" PRIu64 "...", trace_index_, entries_done_, entry_count);
   fflush(stdout);
 
 #ifndef _WIN32
@@ -175,156 +277,1229 @@ void Trace::process() {
   gettimeofday(&tv_start, NULL);
 #endif
 
-  // clamping
-  if ((entries_done_ + 1000000) < entry_count) {
-    entry_count = entries_done_ + 1000000;
+  int workers = (count < INGEST_MIN_PARALLEL) ? 1 : ingest_threads_;
+  vector<IngestJob> jobs(workers);
+  THREAD threads[INDEX_SHARDS];
+  for (int w = 0; w < workers; w++) {
+    jobs[w].trace = this;
+    jobs[w].worker = w;
+    jobs[w].workers = workers;
+    jobs[w].entries = entries;
+    jobs[w].count = count;
+    jobs[w].heat_shift = heat_shift_;
   }
 
-  while (entries_done_ != entry_count) {
-    // no need to lock this here, because this is the only thread that changes it
-    const struct change *c = &backing_[entries_done_];
-    char type = get_type_from_flags(c->flags);
+  // build phase, the workers split up the batch by shard without the lock
+  for (int w = 1; w < workers; w++) THREAD_CREATE(threads[w], build_entry, &jobs[w]);
+  build_batch(&jobs[0]);
 
-    RWLOCK_WRLOCK(db_lock_);
-    // clnum_to_entry_number_, instruction_pages_
-    if (type == 'I') {
-      if (clnum_to_entry_number_.size() < c->clnum) {
-        // there really shouldn't be holes
-        clnum_to_entry_number_.resize(c->clnum);
-      }
-      clnum_to_entry_number_.push_back(entries_done_);
-      pages_[c->address & PAGE_MASK] |= PAGE_INSTRUCTION;
+  // the clnum bits are in log order, so they stay on this thread
+  vector<pair<Clnum, EntryNumber> > instructions;
+  Clnum max_clnum = max_clnum_, min_clnum = min_clnum_;
+  for (EntryNumber i = 0; i < count; i++) {
+    const struct change *c = &entries[i];
+    if (get_type_from_flags(c->flags) == 'I') {
+      instructions.push_back(MP(c->clnum, entries_done_ + i));
     }
+    if (max_clnum < c->clnum && c->clnum != INVALID_CLNUM) {
+      max_clnum = c->clnum;
+    }
+    if (min_clnum == INVALID_CLNUM || c->clnum < min_clnum) {
+      min_clnum = c->clnum;
+    }
+  }
+  for (int w = 1; w < workers; w++) THREAD_JOIN(threads[w]);
+  log_.Unpin(entries);
 
-    // addresstype_to_clnums_
-    // ** this is 75% of the perf, real unordered_map should improve, but c++11 is hard to build
-    pair<unordered_map<pair<Address, char>, set<Clnum> >::iterator, bool> ret =
-      addresstype_to_clnums_.insert(MP(MP(c->address, type), set<Clnum>()));
-    ret.first->second.insert(c->clnum);
+  // the heat buckets get wider to stay under HEAT_BUCKETS
+  if (max_clnum != INVALID_CLNUM && max_clnum >= first_clnum_) {
+    while (((max_clnum - first_clnum_) >> heat_shift_) >= HEAT_BUCKETS) heat_shift_++;
+  }
+  for (int w = 0; w < workers; w++) jobs[w].merge_heat_shift = heat_shift_;
 
-    // registers_
-    if (type == 'W' && (c->address < (unsigned int)(register_size_ * register_count_))) {
-      registers_[c->address / register_size_][c->clnum] = c->data;
+  // merge phase, the shards are disjoint so it's parallel too
+  // each shard is only locked while it's merged into, the rest stay readable
+  for (int w = 1; w < workers; w++) THREAD_CREATE(threads[w], merge_entry, &jobs[w]);
+  merge_batch(&jobs[0]);
+  RWLOCK_WRLOCK(clnums_lock_);
+  for (size_t i = 0; i < instructions.size(); i++) {
+    // a fork starts far from 0, so it's indexed from the first instruction
+    if (clnum_to_entry_number_.empty()) clnum_base_ = instructions[i].first;
+    if (instructions[i].first < clnum_base_) continue;
+    Clnum idx = instructions[i].first - clnum_base_;
+    if (clnum_to_entry_number_.size() < idx) {
+      // there really shouldn't be holes
+      clnum_to_entry_number_.resize(idx);
     }
+    clnum_to_entry_number_.push_back(instructions[i].second);
+  }
+  RWLOCK_WRUNLOCK(clnums_lock_);
+  for (int w = 1; w < workers; w++) THREAD_JOIN(threads[w]);
+  max_clnum_ = max_clnum;
+  min_clnum_ = min_clnum;
+  entries_done_ = entry_count;
+  // now the readers can see it
+  publish_epoch();
 
-    // memory_, data_pages_
-    if (type == 'L' || type == 'S') {
-      if (type == 'L') {
-        pages_[c->address & PAGE_MASK] |= PAGE_READ;
+#ifndef _WIN32
+  gettimeofday(&tv_end, NULL);
+  double t = (tv_end.tv_usec-tv_start.tv_usec)/1000.0 +
+             (tv_end.tv_sec-tv_start.tv_sec)*1000.0;
+  printf("done %f ms\n", t);
+#else
+  printf("done\n");
+#endif
+
+  // set this at the end
+  did_update_ = true;
+  if (!index_filename_.empty()) index_dirty_ = true;
+  notify_update();
+  return true;
+}
+
+void Trace::SetParent(Trace *parent) {
+  // with nothing before it, a fork has nothing to read through to
+  if (first_clnum_ == 0) return;
+  MUTEX_LOCK(epoch_mutex_);
+  epoch_.parent = parent;
+  epoch_.fork_clnum = first_clnum_;
+  MUTEX_UNLOCK(epoch_mutex_);
+}
+
+void Trace::publish_epoch() {
+  MUTEX_LOCK(epoch_mutex_);
+  epoch_.entries = entries_done_;
+  epoch_.max_clnum = max_clnum_;
+  epoch_.min_clnum = min_clnum_;
+  MUTEX_UNLOCK(epoch_mutex_);
+}
+
+bool Trace::IsCaughtUp() {
+  return entries_done_ >= log_.GetEntryCount();
+}
+
+// sleeps until the log changes, the destructor is called, or timeout_ms
+void Trace::WaitForLog(int timeout_ms) {
+#ifdef _WIN32
+  usleep(timeout_ms * 1000);
+#else
+  struct pollfd fds[2];
+  int nfds = 0;
+  fds[nfds].fd = wake_fds_[0];
+  fds[nfds++].events = POLLIN;
+  if (notify_fd_ != -1) {
+    fds[nfds].fd = notify_fd_;
+    fds[nfds++].events = POLLIN;
+  }
+  if (poll(fds, nfds, timeout_ms) > 0 && notify_fd_ != -1) {
+    // drain the events, all that matters is that there were some
+    char buf[0x1000];
+    while (read(notify_fd_, buf, sizeof(buf)) > 0);
+  }
+#endif
+}
+
+void *Trace::build_entry(void *job) {
+  ((IngestJob *)job)->trace->build_batch((IngestJob *)job);
+  return NULL;
+}
+
+void *Trace::merge_entry(void *job) {
+  ((IngestJob *)job)->trace->merge_batch((IngestJob *)job);
+  return NULL;
+}
+
+// pull out everything in the batch that lands in this worker's shards
+void Trace::build_batch(IngestJob *job) {
+  int w = job->worker, workers = job->workers;
+  Address register_end = register_size_ * register_count_;
+  job->registers.resize(register_count_);
+  Address last_page = 0;
+  vector<MemoryWrite> *last_deltas = NULL;
+  pair<Address, uint64_t> last_heat_key;
+  uint32_t *last_heat = NULL;
+
+  for (EntryNumber i = 0; i < job->count; i++) {
+    const struct change *c = &job->entries[i];
+    char type = get_type_from_flags(c->flags);
+
+    // addresstype_to_clnums
+    // ** this was 75% of the perf, now it's a small map per batch
+    int s = shard_for(c->address);
+    if (s % workers == w) {
+      job->shards[s].addresstype_to_clnums[MP(c->address, type)].push_back(c->clnum);
+    }
+
+    // registers
+    if (type == 'W' && c->address < register_end && (int)((c->address / register_size_) % workers) == w) {
+      job->registers[c->address / register_size_].push_back(MP(c->clnum, c->data));
+    }
+
+    // valuetype_to_clnums
+    if (value_index_ && (type == 'L' || type == 'S' || type == 'W')) {
+      s = shard_for(c->data);
+      if (s % workers == w) {
+        job->shards[s].valuetype_to_clnums[MP(c->data, type)].push_back(c->clnum);
       }
-      if (type == 'S') {
-        pages_[c->address & PAGE_MASK] |= PAGE_WRITE;
+    }
+
+    // pages
+    if (type == 'I' || type == 'L' || type == 'S') {
+      Address page = c->address & PAGE_MASK;
+      s = shard_for(page);
+      if (s % workers == w) {
+        job->shards[s].pages[page] |= (type == 'I') ? PAGE_INSTRUCTION : ((type == 'L') ? PAGE_READ : PAGE_WRITE);
+        // runs of changes hit the same page in the same bucket
+        pair<Address, uint64_t> key = MP(page, (c->clnum > first_clnum_) ? (c->clnum - first_clnum_) >> job->heat_shift : 0);
+        if (last_heat == NULL || last_heat_key != key) {
+          last_heat_key = key;
+          last_heat = &job->shards[s].heat[key];
+        }
+        (*last_heat)++;
       }
+    }
 
+    // memory
+    if (type == 'L' || type == 'S') {
       // no harm in doing the memory commit every time there's a load, right?
       int byte_count = (c->flags&SIZE_MASK)/8;
       uint64_t data = c->data;
-      if (is_big_endian_) {
-        for (int i = byte_count-1; i >= 0; --i) {
-          commit_memory(c->clnum, c->address+i, data&0xFF);
-          data >>= 8;
+      for (int j = 0; j < byte_count; j++) {
+        // the last byte comes first on big endian
+        Address a = c->address + (is_big_endian_ ? byte_count-1-j : j);
+        Address page = a & PAGE_MASK;
+        if (last_deltas == NULL || last_page != page) {
+          s = shard_for(page);
+          if (s % workers != w) { data >>= 8; continue; }
+          last_page = page;
+          last_deltas = &job->shards[s].memory[page];
         }
-      } else {
-        // little endian
-        for (int i = 0; i < byte_count; i++) {
-          commit_memory(c->clnum, c->address+i, data&0xFF);
-          data >>= 8;
+        MemoryWrite d;
+        d.clnum = c->clnum;
+        d.offset = a - page;
+        d.data = data&0xFF;
+        last_deltas->push_back(d);
+        data >>= 8;
+      }
+    }
+  }
+}
+
+// only touches the shards and registers this worker owns, each under its own lock
+void Trace::merge_batch(IngestJob *job) {
+  for (int s = job->worker; s < INDEX_SHARDS; s += job->workers) {
+    IngestShard &in = job->shards[s];
+    IndexShard &shard = shards_[s];
+    if (in.addresstype_to_clnums.empty() && in.valuetype_to_clnums.empty() && in.pages.empty() && in.memory.empty()) continue;
+    RWLOCK_WRLOCK(shard.lock);
+
+    if (shard.heat_shift < job->merge_heat_shift) {
+      int by = job->merge_heat_shift - shard.heat_shift;
+      for (map<Address, vector<uint32_t> >::iterator it = shard.heat.begin(); it != shard.heat.end(); ++it) {
+        vector<uint32_t> &counts = it->second;
+        for (size_t b = 0; b < counts.size(); b++) {
+          if ((b >> by) != b) { counts[b >> by] += counts[b]; counts[b] = 0; }
         }
+        counts.resize(((counts.size()-1) >> by) + 1);
       }
+      shard.heat_shift = job->merge_heat_shift;
+    }
+    for (map<pair<Address, uint64_t>, uint32_t>::iterator it = in.heat.begin(); it != in.heat.end(); ++it) {
+      vector<uint32_t> &counts = shard.heat[it->first.first];
+      uint64_t b = it->first.second >> (shard.heat_shift - job->heat_shift);
+      if (counts.size() <= b) counts.resize(b+1);
+      counts[b] += it->second;
     }
-    RWLOCK_WRUNLOCK(db_lock_);
 
-    // max_clnum_
-    if (max_clnum_ < c->clnum && c->clnum != INVALID_CLNUM) {
-      max_clnum_ = c->clnum;
+    for (map<pair<Address, char>, vector<Clnum> >::iterator it = in.addresstype_to_clnums.begin();
+         it != in.addresstype_to_clnums.end(); ++it) {
+      PostingList &clnums = shard.addresstype_to_clnums[it->first];
+      for (vector<Clnum>::iterator it2 = it->second.begin(); it2 != it->second.end(); ++it2) {
+        clnums.Append(*it2);
+      }
+    }
+
+    for (map<pair<uint64_t, char>, vector<Clnum> >::iterator it = in.valuetype_to_clnums.begin();
+         it != in.valuetype_to_clnums.end(); ++it) {
+      PostingList &clnums = shard.valuetype_to_clnums[it->first];
+      for (vector<Clnum>::iterator it2 = it->second.begin(); it2 != it->second.end(); ++it2) {
+        clnums.Append(*it2);
+      }
     }
 
-    if (min_clnum_ == INVALID_CLNUM || c->clnum < min_clnum_) {
-      min_clnum_ = c->clnum;
+    for (map<Address, char>::iterator it = in.pages.begin(); it != in.pages.end(); ++it) {
+      shard.pages[it->first] |= it->second;
     }
-    
-    entries_done_++;
+
+    for (map<Address, vector<MemoryWrite> >::iterator it = in.memory.begin(); it != in.memory.end(); ++it) {
+      map<Address, MemoryPage*>::iterator mit = shard.memory.lower_bound(it->first);
+      if (mit == shard.memory.end() || mit->first != it->first) {
+        mit = shard.memory.insert(mit, MP(it->first, new MemoryPage()));
+      }
+      for (size_t j = 0; j < it->second.size(); j++) {
+        mit->second->Commit(it->second[j].clnum, it->second[j].offset, it->second[j].data);
+      }
+    }
+
+    RWLOCK_WRUNLOCK(shard.lock);
   }
 
-#ifndef _WIN32
-  gettimeofday(&tv_end, NULL);
-  double t = (tv_end.tv_usec-tv_start.tv_usec)/1000.0 +
-             (tv_end.tv_sec-tv_start.tv_sec)*1000.0;
-  printf("done %f ms\n", t);
+  for (int i = job->worker; i < register_count_; i += job->workers) {
+    vector<pair<Clnum, uint64_t> > &changes = job->registers[i];
+    if (changes.empty()) continue;
+    RWLOCK_WRLOCK(registers_[i].lock);
+    for (size_t j = 0; j < changes.size(); j++) {
+      commit_register(changes[j].first, i, changes[j].second);
+    }
+    RWLOCK_WRUNLOCK(registers_[i].lock);
+  }
+}
+
+bool Trace::WantsSave() {
+  return index_dirty_ && now_ms() >= next_save_ms_;
+}
+
+bool Trace::SaveIndex() {
+  // only the ingest thread changes the database, so no lock is needed to read it here
+  uint64_t start_ms = now_ms();
+  // a failed save doesn't retry right away either
+  next_save_ms_ = start_ms + INDEX_SAVE_MIN_MS;
+  string tmp_filename = index_filename_ + ".tmp";
+  FILE *f = fopen(tmp_filename.c_str(), "wb");
+  if (f == NULL) {
+    printf("ERROR: can't open index %s\n", tmp_filename.c_str());
+    return false;
+  }
+  IndexWriter w(f);
+
+  w.put_bytes(INDEX_MAGIC, sizeof(INDEX_MAGIC));
+  w.put<uint32_t>(INDEX_VERSION);
+  w.put<uint32_t>(register_size_);
+  w.put<uint32_t>(register_count_);
+  w.put<uint32_t>(is_big_endian_);
+  w.put<uint32_t>(value_index_);
+  // these don't change while the trace grows, so they key the index
+  w.put<uint32_t>(log_.version());
+  w.put<Clnum>(log_.GetFirstClnum());
+  w.put<int32_t>(log_.GetParentId());
+  w.put<int32_t>(log_.GetPid());
+  w.put<EntryNumber>(entries_done_);
+  struct change last_change;
+  log_entry(entries_done_-1, &last_change);
+  w.put<struct change>(last_change);
+  w.put<Clnum>(max_clnum_);
+  w.put<Clnum>(min_clnum_);
+
+  w.put<Clnum>(clnum_base_);
+  w.put<uint64_t>(clnum_to_entry_number_.size());
+  w.put_vector(clnum_to_entry_number_);
+
+  for (int i = 0; i < register_count_; i++) {
+    w.put<uint64_t>(registers_[i].clnums.size());
+    w.put_vector(registers_[i].clnums);
+    w.put_vector(registers_[i].values);
+  }
+
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    IndexShard &shard = shards_[s];
+    w.put<uint64_t>(shard.pages.size());
+    for (map<Address, char>::iterator it = shard.pages.begin(); it != shard.pages.end(); ++it) {
+      w.put<Address>(it->first);
+      w.put<char>(it->second);
+    }
+
+    w.put<uint32_t>(shard.heat_shift);
+    w.put<uint64_t>(shard.heat.size());
+    for (map<Address, vector<uint32_t> >::iterator it = shard.heat.begin(); it != shard.heat.end(); ++it) {
+      w.put<Address>(it->first);
+      w.put<uint64_t>(it->second.size());
+      w.put_vector(it->second);
+    }
+
+    w.put<uint64_t>(shard.memory.size());
+    for (map<Address, MemoryPage*>::iterator it = shard.memory.begin(); it != shard.memory.end(); ++it) {
+      w.put<Address>(it->first);
+      it->second->Save(&w);
+    }
+
+    w.put<uint64_t>(shard.addresstype_to_clnums.size());
+    for (map<pair<Address, char>, PostingList>::iterator it = shard.addresstype_to_clnums.begin();
+         it != shard.addresstype_to_clnums.end(); ++it) {
+      w.put<Address>(it->first.first);
+      w.put<char>(it->first.second);
+      it->second.Save(&w);
+    }
+
+    w.put<uint64_t>(shard.valuetype_to_clnums.size());
+    for (map<pair<uint64_t, char>, PostingList>::iterator it = shard.valuetype_to_clnums.begin();
+         it != shard.valuetype_to_clnums.end(); ++it) {
+      w.put<uint64_t>(it->first.first);
+      w.put<char>(it->first.second);
+      it->second.Save(&w);
+    }
+  }
+
+  bool ok = w.ok();
+  if (fclose(f) != 0) ok = false;
+#ifdef _WIN32
+  if (ok) remove(index_filename_.c_str());
+#endif
+  if (!ok || rename(tmp_filename.c_str(), index_filename_.c_str()) != 0) {
+    printf("ERROR: writing index %s failed\n", index_filename_.c_str());
+    remove(tmp_filename.c_str());
+    return false;
+  }
+  index_dirty_ = false;
+  uint64_t end_ms = now_ms();
+  next_save_ms_ = max(next_save_ms_, end_ms + (end_ms - start_ms)*INDEX_SAVE_RATIO);
+  return true;
+}
+
+bool Trace::LoadIndex() {
+  // on the ingest thread before it ingests anything, readers see nothing until the epoch is published
+  // it's filled in under the locks, the big parts stay in the mapping and are only read when a query needs them
+  if (index_filename_.empty()) return false;
+  FILE *f = fopen(index_filename_.c_str(), "rb");
+  if (f == NULL) return false;
+  fseek(f, 0, SEEK_END);
+  long len = ftell(f);
+  if (len <= 0) { fclose(f); return false; }
+#ifdef _WIN32
+  uint8_t *dat = (uint8_t *)malloc(len);
+  fseek(f, 0, SEEK_SET);
+  if (dat != NULL && fread(dat, 1, len, f) != (size_t)len) { free(dat); dat = NULL; }
 #else
-  printf("done\n");
+  // the index is only ever replaced by a rename, so the mapping stays what was loaded
+  uint8_t *dat = (uint8_t *)mmap(NULL, len, PROT_READ, MAP_PRIVATE, fileno(f), 0);
+  if (dat == MAP_FAILED) dat = NULL;
 #endif
+  fclose(f);
+  if (dat == NULL) return false;
+  index_map_ = dat;
+  index_map_len_ = len;
 
-  // set this at the end
-  did_update_ = true;
+  IndexReader r(dat, len);
+  bool ok = false;
+  EntryNumber entries_done = 0;
+  struct change last_change, logged_change;
+  EntryNumber entry_count = log_.GetEntryCount();
+
+  const uint8_t *magic = r.get_bytes(sizeof(INDEX_MAGIC));
+  if (magic == NULL || memcmp(magic, INDEX_MAGIC, sizeof(INDEX_MAGIC)) != 0) goto done;
+  if (r.get<uint32_t>() != INDEX_VERSION) goto done;
+  if (r.get<uint32_t>() != (uint32_t)register_size_) goto done;
+  if (r.get<uint32_t>() != (uint32_t)register_count_) goto done;
+  if (r.get<uint32_t>() != (uint32_t)is_big_endian_) goto done;
+  // an index without values can't serve a trace that wants them
+  if (r.get<uint32_t>() != (uint32_t)value_index_) goto done;
+  if (r.get<uint32_t>() != (uint32_t)log_.version()) goto done;
+  if (r.get<Clnum>() != log_.GetFirstClnum()) goto done;
+  if (r.get<int32_t>() != log_.GetParentId()) goto done;
+  if (r.get<int32_t>() != log_.GetPid()) goto done;
+  entries_done = r.get<EntryNumber>();
+  last_change = r.get<struct change>();
+  // the log must still have everything the index covers
+  if (!r.ok() || entries_done < 1 || entries_done > entry_count) goto done;
+  if (!log_entry(entries_done-1, &logged_change)) goto done;
+  if (memcmp(&logged_change, &last_change, sizeof(struct change)) != 0) goto done;
+
+  max_clnum_ = r.get<Clnum>();
+  min_clnum_ = r.get<Clnum>();
+
+  {
+    Clnum clnum_base = r.get<Clnum>();
+    uint64_t cnt = r.get<uint64_t>();
+    const uint8_t *cdat = r.get_bytes(cnt*sizeof(EntryNumber));
+    if (cdat == NULL) goto done;
+    RWLOCK_WRLOCK(clnums_lock_);
+    clnum_base_ = clnum_base;
+    clnum_to_entry_number_.assign((const EntryNumber*)cdat, ((const EntryNumber*)cdat) + cnt);
+    RWLOCK_WRUNLOCK(clnums_lock_);
+  }
+
+  for (int i = 0; i < register_count_; i++) {
+    uint64_t cnt = r.get<uint64_t>();
+    const uint8_t *clnums = r.get_bytes(cnt*sizeof(Clnum));
+    const uint8_t *values = r.get_bytes(cnt*sizeof(uint64_t));
+    if (clnums == NULL || values == NULL) goto done;
+    RWLOCK_WRLOCK(registers_[i].lock);
+    registers_[i].clnums.assign((const Clnum*)clnums, ((const Clnum*)clnums) + cnt);
+    registers_[i].values.assign((const uint64_t*)values, ((const uint64_t*)values) + cnt);
+    RWLOCK_WRUNLOCK(registers_[i].lock);
+  }
+
+  for (int s = 0; s < INDEX_SHARDS && r.ok(); s++) {
+    IndexShard &shard = shards_[s];
+    RWLOCK_WRLOCK(shard.lock);
+    for (uint64_t cnt = r.get<uint64_t>(); r.ok() && cnt > 0; cnt--) {
+      Address a = r.get<Address>();
+      shard.pages.insert(shard.pages.end(), MP(a, r.get<char>()));
+    }
+
+    shard.heat_shift = r.get<uint32_t>();
+    for (uint64_t cnt = r.get<uint64_t>(); r.ok() && cnt > 0; cnt--) {
+      Address page = r.get<Address>();
+      uint64_t bucket_count = r.get<uint64_t>();
+      const uint8_t *counts = r.get_bytes(bucket_count*sizeof(uint32_t));
+      if (counts == NULL) break;
+      shard.heat[page].assign((const uint32_t *)counts, ((const uint32_t *)counts) + bucket_count);
+    }
+
+    for (uint64_t cnt = r.get<uint64_t>(); r.ok() && cnt > 0; cnt--) {
+      Address page = r.get<Address>();
+      MemoryPage *mp = new MemoryPage();
+      shard.memory.insert(shard.memory.end(), MP(page, mp));
+      if (!mp->Load(&r)) break;
+    }
+
+    for (uint64_t cnt = r.get<uint64_t>(); r.ok() && cnt > 0; cnt--) {
+      Address a = r.get<Address>();
+      char type = r.get<char>();
+      if (!shard.addresstype_to_clnums[MP(a, type)].Load(&r)) break;
+    }
+
+    for (uint64_t cnt = r.get<uint64_t>(); r.ok() && cnt > 0; cnt--) {
+      uint64_t value = r.get<uint64_t>();
+      char type = r.get<char>();
+      if (!shard.valuetype_to_clnums[MP(value, type)].Load(&r)) break;
+    }
+    RWLOCK_WRUNLOCK(shard.lock);
+  }
+
+  ok = r.ok();
+  if (ok) {
+    while (max_clnum_ >= first_clnum_ && ((max_clnum_ - first_clnum_) >> heat_shift_) >= HEAT_BUCKETS) heat_shift_++;
+    entries_done_ = entries_done;
+    printf("on %u loaded index with %" PRIu64 " entries\n", trace_index_, entries_done_);
+  }
+
+done:
+  if (!ok) {
+    // stale or broken, throw away anything half loaded and ingest from scratch
+    RWLOCK_WRLOCK(clnums_lock_);
+    clnum_to_entry_number_.clear();
+    clnum_base_ = 0;
+    RWLOCK_WRUNLOCK(clnums_lock_);
+    for (int i = 0; i < register_count_; i++) {
+      RWLOCK_WRLOCK(registers_[i].lock);
+      registers_[i].clnums.clear();
+      registers_[i].values.clear();
+      RWLOCK_WRUNLOCK(registers_[i].lock);
+    }
+    for (int s = 0; s < INDEX_SHARDS; s++) {
+      RWLOCK_WRLOCK(shards_[s].lock);
+      for (map<Address, MemoryPage*>::iterator it = shards_[s].memory.begin(); it != shards_[s].memory.end(); ++it) {
+        delete it->second;
+      }
+      shards_[s].memory.clear();
+      shards_[s].pages.clear();
+      shards_[s].heat.clear();
+      shards_[s].heat_shift = 0;
+      shards_[s].addresstype_to_clnums.clear();
+      shards_[s].valuetype_to_clnums.clear();
+      RWLOCK_WRUNLOCK(shards_[s].lock);
+    }
+    max_clnum_ = 0;
+    min_clnum_ = INVALID_CLNUM;
+    // nothing points into it anymore
+    unmap_index();
+  }
+  publish_epoch();
+  if (ok) {
+    did_update_ = true;
+    notify_update();
+  }
+  return ok;
+}
+
+void Trace::unmap_index() {
+  if (index_map_ == NULL) return;
+#ifdef _WIN32
+  free(index_map_);
+#else
+  munmap(index_map_, index_map_len_);
+#endif
+  index_map_ = NULL;
+  index_map_len_ = 0;
 }
 
 vector<Clnum> Trace::FetchClnumsByAddressAndType(Address address, char type,
       Clnum start_clnum, Clnum end_clnum, unsigned int limit) {
-  RWLOCK_RDLOCK(db_lock_);
+  Epoch e = GetEpoch();
+  vector<Clnum> ret;
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    ret = e.parent->FetchClnumsByAddressAndType(address, type, start_clnum, min(end_clnum, e.fork_clnum), limit);
+    if (limit != 0 && ret.size() >= limit) return ret;
+    if (limit != 0) limit -= ret.size();
+    start_clnum = e.fork_clnum;
+  }
+  if (e.min_clnum == INVALID_CLNUM) return ret;
+  // nothing past the epoch, even if its shard is already merged
+  if (end_clnum > e.max_clnum) end_clnum = e.max_clnum + 1;
+
+  IndexShard &shard = shards_[shard_for(address)];
+  RWLOCK_RDLOCK(shard.lock);
+  map<pair<Address, char>, PostingList>::iterator it = shard.addresstype_to_clnums.find(MP(address, type));
+  if (it != shard.addresstype_to_clnums.end()) {
+    it->second.Fetch(start_clnum, end_clnum, limit, &ret);
+  }
+  RWLOCK_UNLOCK(shard.lock);
+  return ret;
+}
+
+vector<Clnum> Trace::FetchClnumsByValue(uint64_t value, uint64_t mask, const char *types,
+      Clnum start_clnum, Clnum end_clnum, unsigned int limit) {
+  Epoch e = GetEpoch();
+  vector<Clnum> ret;
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    ret = e.parent->FetchClnumsByValue(value, mask, types, start_clnum, min(end_clnum, e.fork_clnum), limit);
+    if (limit != 0 && ret.size() >= limit) return ret;
+    if (limit != 0) limit -= ret.size();
+    start_clnum = e.fork_clnum;
+  }
+  if (!value_index_ || e.min_clnum == INVALID_CLNUM) return ret;
+  if (end_clnum > e.max_clnum) end_clnum = e.max_clnum + 1;
+  if (start_clnum >= end_clnum) return ret;
+
+  bool want[0x100] = {false};
+  for (const char *t = types; *t != '\0'; t++) want[(uint8_t)*t] = true;
+  value &= mask;
+
+  // an exact value lives in one shard, a masked one could be in any of them
+  bool exact = (mask == ~(uint64_t)0);
+  int first_shard = exact ? shard_for(value) : 0;
+  int last_shard = exact ? first_shard+1 : INDEX_SHARDS;
+  vector<Clnum> clnums;
+  for (int s = first_shard; s < last_shard; s++) {
+    IndexShard &shard = shards_[s];
+    RWLOCK_RDLOCK(shard.lock);
+    map<pair<uint64_t, char>, PostingList>::iterator it = exact ?
+      shard.valuetype_to_clnums.lower_bound(MP(value, (char)0)) : shard.valuetype_to_clnums.begin();
+    for (; it != shard.valuetype_to_clnums.end(); ++it) {
+      if (exact && it->first.first != value) break;
+      if ((it->first.first & mask) != value || !want[(uint8_t)it->first.second]) continue;
+      // the first limit of each list is enough for the first limit of the union
+      it->second.Fetch(start_clnum, end_clnum, limit, &clnums);
+    }
+    RWLOCK_UNLOCK(shard.lock);
+  }
+
+  sort(clnums.begin(), clnums.end());
+  clnums.erase(unique(clnums.begin(), clnums.end()), clnums.end());
+  if (limit != 0 && clnums.size() > limit) clnums.resize(limit);
+  ret.insert(ret.end(), clnums.begin(), clnums.end());
+  return ret;
+}
+
+vector<struct change> Trace::FetchChangesInRange(Address lo, Address hi, const char *types,
+      Clnum start_clnum, Clnum end_clnum, unsigned int limit) {
+  Epoch e = GetEpoch();
+  vector<struct change> ret;
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    ret = e.parent->FetchChangesInRange(lo, hi, types, start_clnum, min(end_clnum, e.fork_clnum), limit);
+    if (limit != 0 && ret.size() >= limit) return ret;
+    if (limit != 0) limit -= ret.size();
+    start_clnum = e.fork_clnum;
+  }
+  if (e.min_clnum == INVALID_CLNUM || lo >= hi) return ret;
+  if (end_clnum > e.max_clnum) end_clnum = e.max_clnum + 1;
+  if (start_clnum >= end_clnum) return ret;
+
+  bool want[0x100] = {false};
+  for (const char *t = types; *t != '\0'; t++) want[(uint8_t)*t] = true;
+
+  // the address index is in address order in every shard, so it's a walk from lo in each
+  // the ones that start before lo might not reach it, so they can't be cut off at the limit
+  Address first = (lo < MAX_CHANGE_BYTES) ? 0 : lo - (MAX_CHANGE_BYTES-1);
+  vector<Clnum> clnums;
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    IndexShard &shard = shards_[s];
+    RWLOCK_RDLOCK(shard.lock);
+    map<pair<Address, char>, PostingList>::iterator it = shard.addresstype_to_clnums.lower_bound(MP(first, (char)0));
+    for (; it != shard.addresstype_to_clnums.end() && it->first.first < hi; ++it) {
+      if (!want[(uint8_t)it->first.second]) continue;
+      it->second.Fetch(start_clnum, end_clnum, (it->first.first < lo) ? 0 : limit, &clnums);
+    }
+    RWLOCK_UNLOCK(shard.lock);
+  }
+  sort(clnums.begin(), clnums.end());
+  clnums.erase(unique(clnums.begin(), clnums.end()), clnums.end());
+
+  // then the changes themselves from the log, for the data and the size
+  for (size_t i = 0; i < clnums.size(); i++) {
+    vector<struct change> changes = FetchChangesByClnum(clnums[i], 0);
+    for (size_t j = 0; j < changes.size(); j++) {
+      const struct change &c = changes[j];
+      Address size = max((c.flags & SIZE_MASK) / 8, 1U);
+      if (!want[(uint8_t)get_type_from_flags(c.flags)] || c.address >= hi || c.address + size <= lo) continue;
+      ret.push_back(c);
+      if (limit != 0 && ret.size() >= limit) return ret;
+    }
+  }
+  return ret;
+}
+
+vector<PcSummary> Trace::FetchPcSummary(Address lo, Address hi, Clnum start_clnum, Clnum end_clnum) {
+  Epoch e = GetEpoch();
+  map<Address, PcSummary> pcs;
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    vector<PcSummary> before = e.parent->FetchPcSummary(lo, hi, start_clnum, min(end_clnum, e.fork_clnum));
+    for (size_t i = 0; i < before.size(); i++) pcs[before[i].address] = before[i];
+    start_clnum = e.fork_clnum;
+  }
+  if (e.min_clnum != INVALID_CLNUM && lo < hi) {
+    if (end_clnum > e.max_clnum) end_clnum = e.max_clnum + 1;
+    for (int s = 0; s < INDEX_SHARDS && start_clnum < end_clnum; s++) {
+      IndexShard &shard = shards_[s];
+      RWLOCK_RDLOCK(shard.lock);
+      map<pair<Address, char>, PostingList>::iterator it = shard.addresstype_to_clnums.lower_bound(MP(lo, (char)0));
+      for (; it != shard.addresstype_to_clnums.end() && it->first.first < hi; ++it) {
+        if (it->first.second != 'I') continue;
+        Clnum first, last;
+        uint64_t count = it->second.Count(start_clnum, end_clnum, &first, &last);
+        if (count == 0) continue;
+        // the fork's runs come after the parent's
+        map<Address, PcSummary>::iterator pit = pcs.find(it->first.first);
+        if (pit == pcs.end()) {
+          PcSummary pc;
+          pc.address = it->first.first; pc.count = count; pc.first_clnum = first; pc.last_clnum = last;
+          pcs.insert(MP(pc.address, pc));
+        } else {
+          pit->second.count += count;
+          pit->second.last_clnum = last;
+        }
+      }
+      RWLOCK_UNLOCK(shard.lock);
+    }
+  }
+  vector<PcSummary> ret;
+  for (map<Address, PcSummary>::iterator it = pcs.begin(); it != pcs.end(); ++it) ret.push_back(it->second);
+  return ret;
+}
+
+Clnum Trace::FetchClnumBefore(Address address, char type, Clnum clnum) {
+  Epoch e = GetEpoch();
+  Clnum ret = INVALID_CLNUM;
+  if (e.min_clnum != INVALID_CLNUM) {
+    // nothing past the epoch, even if its shard is already merged
+    if (clnum > e.max_clnum) clnum = e.max_clnum + 1;
+    IndexShard &shard = shards_[shard_for(address)];
+    RWLOCK_RDLOCK(shard.lock);
+    map<pair<Address, char>, PostingList>::iterator it = shard.addresstype_to_clnums.find(MP(address, type));
+    if (it != shard.addresstype_to_clnums.end()) ret = it->second.Before(clnum);
+    RWLOCK_UNLOCK(shard.lock);
+  }
+  // before the fork it's the parent's history
+  if (e.parent != NULL && (ret == INVALID_CLNUM || ret < e.fork_clnum)) {
+    ret = e.parent->FetchClnumBefore(address, type, min(clnum, e.fork_clnum));
+  }
+  return ret;
+}
+
+vector<Clnum> Trace::SliceStep(Slice *slice, unsigned int limit, int budget_ms) {
   vector<Clnum> ret;
-  pair<Address, char> p = MP(address, type);
-  unordered_map<pair<Address, char>, set<Clnum> >::iterator it = addresstype_to_clnums_.find(p);
-  if (it != addresstype_to_clnums_.end()) {
-    for (set<Clnum>::iterator it2 = it->second.lower_bound(start_clnum);
-         it2 != it->second.end() && *it2 < end_clnum; ++it2) {
-      ret.push_back(*it2);
-      if (ret.size() == limit) break;
+  uint64_t deadline = now_ms() + budget_ms;
+  while (!slice->pending.empty() && (limit == 0 || ret.size() < limit)) {
+    if (budget_ms != 0 && now_ms() >= deadline) break;
+    // nearest to where it started first
+    set<Clnum>::iterator pit = slice->forward ? slice->pending.begin() : --slice->pending.end();
+    Clnum clnum = *pit;
+    slice->pending.erase(pit);
+
+    vector<struct change> changes = FetchChangesByClnum(clnum, 0);
+    for (size_t i = 0; i < changes.size(); i++) {
+      const struct change &c = changes[i];
+      char type = get_type_from_flags(c.flags);
+      if ((type == 'R' || type == 'W') && slice->ignore_registers.count(c.address) != 0) continue;
+      vector<Clnum> found;
+      if (!slice->forward && (type == 'L' || type == 'R')) {
+        Clnum def = FetchClnumBefore(c.address, (type == 'L') ? 'S' : 'W', clnum);
+        if (def != INVALID_CLNUM) found.push_back(def);
+      } else if (slice->forward && (type == 'S' || type == 'W')) {
+        // an instruction reads before it writes, so the next write reads this one too
+        vector<Clnum> next = FetchClnumsByAddressAndType(c.address, type, clnum+1, INVALID_CLNUM, 1);
+        Clnum end_clnum = next.empty() ? INVALID_CLNUM : next[0]+1;
+        found = FetchClnumsByAddressAndType(c.address, (type == 'S') ? 'L' : 'R', clnum+1, end_clnum, 0);
+      }
+      for (size_t j = 0; j < found.size(); j++) {
+        if (!slice->seen.insert(found[j]).second) continue;
+        slice->pending.insert(found[j]);
+        ret.push_back(found[j]);
+      }
     }
   }
-  RWLOCK_UNLOCK(db_lock_);
   return ret;
 }
 
 vector<struct change> Trace::FetchChangesByClnum(Clnum clnum, unsigned int limit) {
-  RWLOCK_RDLOCK(db_lock_);
+  Epoch e = GetEpoch();
+  if (e.parent != NULL && clnum < e.fork_clnum) return e.parent->FetchChangesByClnum(clnum, limit);
   vector<struct change> ret;
+  if (e.min_clnum == INVALID_CLNUM || clnum > e.max_clnum) return ret;
+
   EntryNumber en = 0;
-  if (clnum < clnum_to_entry_number_.size()) {
-    en = clnum_to_entry_number_[clnum];
+  RWLOCK_RDLOCK(clnums_lock_);
+  if (clnum >= clnum_base_ && clnum - clnum_base_ < clnum_to_entry_number_.size()) {
+    en = clnum_to_entry_number_[clnum - clnum_base_];
   }
-  RWLOCK_UNLOCK(db_lock_);
+  RWLOCK_UNLOCK(clnums_lock_);
 
-  if (en != 0) {
-    MUTEX_LOCK(backing_mutex_);
-    const struct change* c = &backing_[en];
-    for (unsigned int i = 0; limit == 0 || i < limit; i++) {
-      if (en+i >= entries_done_) break;  // don't run off the end
+  // a chunk at a time, a clnum can straddle two
+  while (en != 0 && en < e.entries && (limit == 0 || ret.size() < limit)) {
+    EntryNumber count = e.entries - en;
+    const struct change *c = log_.Pin(en, &count);
+    EntryNumber i = 0;
+    for (; i < count && (limit == 0 || ret.size() < limit); i++, c++) {
       if (c->clnum != clnum) break; // on next change already
       ret.push_back(*c);  // copy?
-      ++c;
     }
-    MUTEX_UNLOCK(backing_mutex_);
+    log_.Unpin(c - i);
+    if (count == 0 || i < count) break;
+    en += count;
+  }
+  return ret;
+}
+
+bool Trace::log_entry(EntryNumber en, struct change *out) {
+  EntryNumber count = 1;
+  const struct change *c = log_.Pin(en, &count);
+  if (count == 1) *out = *c;
+  log_.Unpin(c);
+  return count == 1;
+}
+
+// the first entry at or after clnum
+EntryNumber Trace::entry_for_clnum(Clnum clnum, const Epoch &e) {
+  // must hold clnums_lock_
+  // the changes before the first instruction, like the initial stack, have no 'I'
+  if (clnum <= e.min_clnum || e.min_clnum == INVALID_CLNUM) return 1;
+  for (clnum = max(clnum, clnum_base_); clnum - clnum_base_ < clnum_to_entry_number_.size() && clnum <= e.max_clnum; clnum++) {
+    // 0 is a hole, the header is entry 0
+    EntryNumber en = clnum_to_entry_number_[clnum - clnum_base_];
+    if (en != 0) return en;
+  }
+  return e.entries;
+}
+
+const struct change *Trace::PinChanges(Clnum start_clnum, Clnum end_clnum, EntryNumber *count) {
+  Epoch e = GetEpoch();
+  RWLOCK_RDLOCK(clnums_lock_);
+  EntryNumber start = entry_for_clnum(start_clnum, e);
+  EntryNumber end = (end_clnum > start_clnum) ? entry_for_clnum(end_clnum, e) : start;
+  RWLOCK_UNLOCK(clnums_lock_);
+
+  *count = end - start;
+  return log_.PinContiguous(start, *count);
+}
+
+vector<pair<const struct change *, EntryNumber> > Trace::PinChangeChunks(Clnum start_clnum, Clnum end_clnum) {
+  Epoch e = GetEpoch();
+  RWLOCK_RDLOCK(clnums_lock_);
+  EntryNumber start = entry_for_clnum(start_clnum, e);
+  EntryNumber end = (end_clnum > start_clnum) ? entry_for_clnum(end_clnum, e) : start;
+  RWLOCK_UNLOCK(clnums_lock_);
+
+  vector<pair<const struct change *, EntryNumber> > ret;
+  log_.PinChunks(start, end - start, &ret);
+  return ret;
+}
+
+void Trace::UnpinChanges(const struct change *changes) {
+  log_.Unpin(changes);
+}
+
+// every change with start_clnum <= clnum < end_clnum whose type is in types
+vector<struct change> Trace::FetchChangesRange(Clnum start_clnum, Clnum end_clnum, const char *types, unsigned int limit_per_clnum) {
+  bool want[0x100] = {false};
+  for (const char *t = types; *t != '\0'; t++) want[(uint8_t)*t] = true;
+
+  vector<struct change> ret;
+  Epoch e = GetEpoch();
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    ret = e.parent->FetchChangesRange(start_clnum, min(end_clnum, e.fork_clnum), types, limit_per_clnum);
+    start_clnum = e.fork_clnum;
+  }
+
+  RWLOCK_RDLOCK(clnums_lock_);
+  EntryNumber en = entry_for_clnum(start_clnum, e);
+  EntryNumber end = (end_clnum > start_clnum) ? entry_for_clnum(end_clnum, e) : en;
+  RWLOCK_UNLOCK(clnums_lock_);
+
+  Clnum clnum = INVALID_CLNUM;
+  unsigned int this_clnum = 0;
+  // a chunk at a time, no need for the range to be contiguous
+  while (en < end) {
+    EntryNumber count = end - en;
+    const struct change *chunk = log_.Pin(en, &count);
+    if (count == 0) { log_.Unpin(chunk); break; }
+    const struct change *c = chunk;
+    for (EntryNumber i = 0; i < count; i++, c++) {
+      if (!want[(uint8_t)get_type_from_flags(c->flags)]) continue;
+      if (c->clnum != clnum) {
+        clnum = c->clnum;
+        this_clnum = 0;
+      }
+      if (limit_per_clnum != 0 && this_clnum == limit_per_clnum) continue;
+      this_clnum++;
+      ret.push_back(*c);
+    }
+    log_.Unpin(chunk);
+    en += count;
   }
   return ret;
 }
 
 vector<MemoryWithValid> Trace::FetchMemory(Clnum clnum, Address address, int len) {
-  RWLOCK_RDLOCK(db_lock_);
-  vector<MemoryWithValid> ret; 
-  for (Address i = address; i < address+len; i++) {
-    ret.push_back(get_byte(clnum, i));
+  Epoch e = GetEpoch();
+  vector<MemoryWithValid> ret;
+  if (e.parent != NULL) {
+    // before the fork it's all the parent's, after it the fork's writes go over the parent's memory at the fork
+    ret = e.parent->FetchMemory(min(clnum, e.fork_clnum-1), address, len);
+    if (clnum < e.fork_clnum) return ret;
+  } else {
+    ret.assign(len > 0 ? len : 0, 0);
+  }
+  if (e.min_clnum == INVALID_CLNUM) return ret;
+  if (clnum > e.max_clnum) clnum = e.max_clnum;
+
+  // a page at a time
+  for (int i = 0; i < len; ) {
+    Address a = address + i;
+    Address page = a & MEMORY_PAGE_MASK;
+    int offset = a - page;
+    int chunk = min(len - i, MEMORY_PAGE_SIZE - offset);
+    IndexShard &shard = shards_[shard_for(page)];
+    RWLOCK_RDLOCK(shard.lock);
+    map<Address, MemoryPage*>::iterator it = shard.memory.find(page);
+    if (it != shard.memory.end()) {
+      it->second->Fetch(clnum, offset, chunk, &ret[i]);
+    }
+    RWLOCK_UNLOCK(shard.lock);
+    i += chunk;
+  }
+  return ret;
+}
+
+// every page with memory at clnum, in no order and maybe twice
+void Trace::memory_pages(Clnum clnum, vector<Address> *out) {
+  Epoch e = GetEpoch();
+  if (e.parent != NULL) {
+    e.parent->memory_pages(min(clnum, e.fork_clnum-1), out);
+    if (clnum < e.fork_clnum) return;
+  }
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    RWLOCK_RDLOCK(shards_[s].lock);
+    for (map<Address, MemoryPage*>::iterator it = shards_[s].memory.begin(); it != shards_[s].memory.end(); ++it) {
+      out->push_back(it->first);
+    }
+    RWLOCK_UNLOCK(shards_[s].lock);
+  }
+}
+
+vector<Address> Trace::SearchMemory(Clnum clnum, const string &pattern, const vector<pair<Address, Address> > &ranges, unsigned int limit) {
+  vector<Address> ret;
+  if (pattern.empty()) return ret;
+  // what a matching byte looks like, the unknown ones never match
+  vector<MemoryWithValid> want(pattern.size());
+  for (size_t j = 0; j < pattern.size(); j++) want[j] = MEMORY_VALID | (uint8_t)pattern[j];
+
+  vector<Address> pages;
+  memory_pages(clnum, &pages);
+  sort(pages.begin(), pages.end());
+  pages.erase(unique(pages.begin(), pages.end()), pages.end());
+
+  // the end of the last page is kept, so matches can cross into the next one
+  vector<MemoryWithValid> window;
+  Address window_start = 0;
+  for (size_t p = 0; p < pages.size(); p++) {
+    Address page = pages[p];
+    bool wanted = ranges.empty();
+    for (size_t r = 0; r < ranges.size() && !wanted; r++) {
+      wanted = page < ranges[r].second && ranges[r].first < page + MEMORY_PAGE_SIZE;
+    }
+    if (!wanted) continue;
+
+    size_t keep = min(window.size(), pattern.size()-1);
+    if (window.empty() || window_start + window.size() != page) keep = 0;
+    window.erase(window.begin(), window.end() - keep);
+    window_start = page - keep;
+    vector<MemoryWithValid> mem = FetchMemory(clnum, page, MEMORY_PAGE_SIZE);
+    window.insert(window.end(), mem.begin(), mem.end());
+
+    for (size_t i = 0; i + want.size() <= window.size(); i++) {
+      if (window[i] != want[0]) continue;
+      size_t j = 1;
+      while (j < want.size() && window[i+j] == want[j]) j++;
+      if (j != want.size()) continue;
+      Address a = window_start + i;
+      bool in_range = ranges.empty();
+      for (size_t r = 0; r < ranges.size() && !in_range; r++) {
+        in_range = ranges[r].first <= a && a < ranges[r].second;
+      }
+      if (!in_range) continue;
+      ret.push_back(a);
+      if (limit != 0 && ret.size() == limit) return ret;
+    }
   }
-  RWLOCK_UNLOCK(db_lock_);
   return ret;
 }
 
 vector<uint64_t> Trace::FetchRegisters(Clnum clnum) {
-  RWLOCK_RDLOCK(db_lock_);
-  vector<uint64_t> ret;
+  Epoch e = GetEpoch();
+  vector<uint64_t> ret(register_count_, 0);
+  if (e.parent != NULL) {
+    // the registers the fork hasn't written yet are what they were at the fork
+    ret = e.parent->FetchRegisters(min(clnum, e.fork_clnum-1));
+    if (clnum < e.fork_clnum) return ret;
+    ret.resize(register_count_);
+  }
+  if (e.min_clnum == INVALID_CLNUM) return ret;
+  if (clnum > e.max_clnum) clnum = e.max_clnum;
+
   for (int i = 0; i < register_count_; i++) {
-    RegisterCell::iterator it = registers_[i].upper_bound(clnum);
-    if (it == registers_[i].begin()) ret.push_back(0);
-    else { --it; ret.push_back(it->second); }
+    RegisterColumn &col = registers_[i];
+    RWLOCK_RDLOCK(col.lock);
+    size_t idx = upper_bound(col.clnums.begin(), col.clnums.end(), clnum) - col.clnums.begin();
+    if (idx != 0) ret[i] = col.values[idx-1];
+    RWLOCK_UNLOCK(col.lock);
   }
-  RWLOCK_UNLOCK(db_lock_);
+  return ret;
+}
+
+// the registers at every clnum in [start_clnum, end_clnum), one row per clnum
+vector<uint64_t> Trace::FetchRegistersRange(Clnum start_clnum, Clnum end_clnum) {
+  Epoch e = GetEpoch();
+  size_t rows = (end_clnum > start_clnum) ? (end_clnum - start_clnum) : 0;
+  vector<uint64_t> ret(rows * register_count_);
+  if (rows == 0) return ret;
+
+  // the rows before the fork are the parent's, and the rest start from the parent's registers at the fork
+  size_t first_row = 0;
+  vector<uint64_t> base(register_count_, 0);
+  if (e.parent != NULL) {
+    if (start_clnum < e.fork_clnum) {
+      Clnum split = min(end_clnum, e.fork_clnum);
+      vector<uint64_t> before = e.parent->FetchRegistersRange(start_clnum, split);
+      copy(before.begin(), before.begin() + min(before.size(), ret.size()), ret.begin());
+      first_row = split - start_clnum;
+    }
+    if (first_row == rows) return ret;
+    base = e.parent->FetchRegisters(e.fork_clnum-1);
+    base.resize(register_count_);
+  }
+  if (e.min_clnum == INVALID_CLNUM) {
+    for (size_t row = first_row; row < rows; row++) {
+      copy(base.begin(), base.end(), ret.begin() + row*register_count_);
+    }
+    return ret;
+  }
+
+  Clnum first_clnum = start_clnum + first_row;
+  for (int i = 0; i < register_count_; i++) {
+    // one search, then sweep the change points alongside the rows
+    RegisterColumn &col = registers_[i];
+    RWLOCK_RDLOCK(col.lock);
+    size_t idx = upper_bound(col.clnums.begin(), col.clnums.end(), min(first_clnum, e.max_clnum)) - col.clnums.begin();
+    uint64_t value = (idx == 0) ? base[i] : col.values[idx-1];
+    for (size_t row = first_row; row < rows; row++) {
+      // rows past the epoch repeat its last value
+      Clnum clnum = min((Clnum)(start_clnum + row), e.max_clnum);
+      while (idx < col.clnums.size() && col.clnums[idx] <= clnum) {
+        value = col.values[idx++];
+      }
+      ret[row*register_count_ + i] = value;
+    }
+    RWLOCK_UNLOCK(col.lock);
+  }
+  return ret;
+}
+
+// adds the heat in [lo, hi) to the buckets of [start_clnum, end_clnum)
+void Trace::add_heat(Clnum start_clnum, Clnum end_clnum, int buckets, Clnum lo, Clnum hi, map<Address, vector<uint32_t> > *out) {
+  Epoch e = GetEpoch();
+  if (e.parent != NULL && lo < e.fork_clnum) {
+    e.parent->add_heat(start_clnum, end_clnum, buckets, lo, min(hi, e.fork_clnum), out);
+    lo = e.fork_clnum;
+  }
+  if (e.min_clnum == INVALID_CLNUM) return;
+  if (hi > e.max_clnum) hi = e.max_clnum + 1;
+  if (lo >= hi) return;
+
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    IndexShard &shard = shards_[s];
+    RWLOCK_RDLOCK(shard.lock);
+    for (map<Address, vector<uint32_t> >::iterator it = shard.heat.begin(); it != shard.heat.end(); ++it) {
+      const vector<uint32_t> &counts = it->second;
+      vector<uint32_t> *ret = NULL;
+      for (size_t b = 0; b < counts.size(); b++) {
+        if (counts[b] == 0) continue;
+        // a stored bucket goes where its middle is
+        Clnum clnum = first_clnum_ + ((Clnum)b << shard.heat_shift) + (((Clnum)1 << shard.heat_shift) >> 1);
+        if (clnum < lo || clnum >= hi) continue;
+        if (ret == NULL) {
+          ret = &(*out)[it->first];
+          ret->resize(buckets);
+        }
+        (*ret)[(clnum - start_clnum) * buckets / (end_clnum - start_clnum)] += counts[b];
+      }
+    }
+    RWLOCK_UNLOCK(shard.lock);
+  }
+}
+
+map<Address, vector<uint32_t> > Trace::GetPageHeatmap(Clnum start_clnum, Clnum end_clnum, int buckets) {
+  map<Address, vector<uint32_t> > ret;
+  if (buckets <= 0 || start_clnum >= end_clnum) return ret;
+  add_heat(start_clnum, end_clnum, buckets, start_clnum, end_clnum, &ret);
   return ret;
 }
 
 map<Address, char> Trace::GetPages() {
-  RWLOCK_RDLOCK(db_lock_);
-  map<Address, char> ret = pages_;
-  RWLOCK_UNLOCK(db_lock_);
+  Epoch e = GetEpoch();
+  map<Address, char> ret;
+  if (e.parent != NULL) ret = e.parent->GetPages();
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    RWLOCK_RDLOCK(shards_[s].lock);
+    for (map<Address, char>::iterator it = shards_[s].pages.begin(); it != shards_[s].pages.end(); ++it) {
+      ret[it->first] |= it->second;
+    }
+    RWLOCK_UNLOCK(shards_[s].lock);
+  }
   return ret;
 }
 
+
+// every trace t reads from, with the clnums before which it reads from it
+static void trace_ancestors(Trace *t, vector<pair<Trace*, Clnum> > *out) {
+  Clnum limit = INVALID_CLNUM;
+  while (t != NULL) {
+    out->push_back(MP(t, limit));
+    Epoch e = t->GetEpoch();
+    if (e.parent == NULL) break;
+    limit = min(limit, e.fork_clnum);
+    t = e.parent;
+  }
+}
+
+// the two traces are the same before this, they read the same history of a common ancestor
+Clnum Trace::shared_clnums(Trace *other) {
+  vector<pair<Trace*, Clnum> > mine, theirs;
+  trace_ancestors(this, &mine);
+  trace_ancestors(other, &theirs);
+  Clnum ret = 0;
+  for (size_t i = 0; i < mine.size(); i++) {
+    for (size_t j = 0; j < theirs.size(); j++) {
+      if (mine[i].first == theirs[j].first) ret = max(ret, min(mine[i].second, theirs[j].second));
+    }
+  }
+  return ret;
+}
+
+// the last clnum there's anything for, a fork that hasn't run yet ends where it was forked
+Clnum Trace::last_clnum() {
+  Epoch e = GetEpoch();
+  if (e.min_clnum != INVALID_CLNUM) return e.max_clnum;
+  if (e.parent != NULL) return min(e.parent->last_clnum(), e.fork_clnum-1);
+  return 0;
+}
+
+// every page with a write in [start_clnum, end_clnum], in no order and maybe twice
+void Trace::written_pages(Clnum start_clnum, Clnum end_clnum, vector<Address> *out) {
+  Epoch e = GetEpoch();
+  if (e.parent != NULL && start_clnum < e.fork_clnum) {
+    e.parent->written_pages(start_clnum, min(end_clnum, e.fork_clnum-1), out);
+    if (end_clnum < e.fork_clnum) return;
+  }
+  for (int s = 0; s < INDEX_SHARDS; s++) {
+    RWLOCK_RDLOCK(shards_[s].lock);
+    for (map<Address, MemoryPage*>::iterator it = shards_[s].memory.begin(); it != shards_[s].memory.end(); ++it) {
+      if (it->second->HasDeltas(start_clnum, end_clnum)) out->push_back(it->first);
+    }
+    RWLOCK_UNLOCK(shards_[s].lock);
+  }
+}
+
+TraceDiff Trace::Diff(Trace *other, Clnum start_clnum, Clnum end_clnum, unsigned int limit) {
+  TraceDiff ret;
+  ret.first_clnum = INVALID_CLNUM;
+  // nothing before this can differ, so it isn't walked
+  start_clnum = max(start_clnum, shared_clnums(other));
+  Clnum mine_last = last_clnum(), theirs_last = other->last_clnum();
+  Clnum end = min(end_clnum, min(mine_last, theirs_last) + 1);
+
+  bool branched = false;
+  for (Clnum batch = start_clnum; batch < end; batch += DIFF_BATCH) {
+    Clnum batch_end = min(end, batch + DIFF_BATCH);
+    vector<struct change> a = FetchChangesRange(batch, batch_end, "IsLSRW", 0);
+    vector<struct change> b = other->FetchChangesRange(batch, batch_end, "IsLSRW", 0);
+    // a clnum at a time from each
+    size_t i = 0, j = 0;
+    while (i < a.size() || j < b.size()) {
+      Clnum clnum = min((i < a.size()) ? a[i].clnum : INVALID_CLNUM, (j < b.size()) ? b[j].clnum : INVALID_CLNUM);
+      size_t i_end = i, j_end = j;
+      while (i_end < a.size() && a[i_end].clnum == clnum) i_end++;
+      while (j_end < b.size() && b[j_end].clnum == clnum) j_end++;
+
+      bool same = (i_end - i) == (j_end - j);
+      for (size_t k = 0; same && k < i_end - i; k++) {
+        same = a[i+k].address == b[j+k].address && a[i+k].data == b[j+k].data && a[i+k].flags == b[j+k].flags;
+      }
+      if (!same && ret.first_clnum == INVALID_CLNUM) ret.first_clnum = clnum;
+
+      Address pc = 0, other_pc = 0;
+      for (size_t k = i; k < i_end; k++) if (a[k].flags & IS_START) { pc = a[k].address; break; }
+      for (size_t k = j; k < j_end; k++) if (b[k].flags & IS_START) { other_pc = b[k].address; break; }
+      if (pc != other_pc && !branched) {
+        BranchDiff d;
+        d.clnum = clnum; d.address = pc; d.other_address = other_pc;
+        ret.branches.push_back(d);
+        if (limit != 0 && ret.branches.size() == limit) return ret;
+      }
+      branched = pc != other_pc;
+      i = i_end;
+      j = j_end;
+    }
+  }
+
+  // the same up to where the shorter one stops
+  if (ret.first_clnum == INVALID_CLNUM && mine_last != theirs_last && end < end_clnum) ret.first_clnum = end;
+  return ret;
+}
+
+vector<RegisterDiff> Trace::DiffRegisters(Trace *other, Clnum clnum) {
+  vector<RegisterDiff> ret;
+  vector<uint64_t> mine = FetchRegisters(clnum), theirs = other->FetchRegisters(clnum);
+  for (size_t i = 0; i < min(mine.size(), theirs.size()); i++) {
+    if (mine[i] == theirs[i]) continue;
+    RegisterDiff d;
+    d.reg = i; d.value = mine[i]; d.other_value = theirs[i];
+    ret.push_back(d);
+  }
+  return ret;
+}
+
+vector<MemoryDiff> Trace::DiffMemory(Trace *other, Clnum clnum, unsigned int limit) {
+  vector<MemoryDiff> ret;
+  Clnum shared = shared_clnums(other);
+  if (clnum < shared) return ret;
+
+  // a page neither wrote since they split is the same in both
+  vector<Address> pages;
+  written_pages(shared, clnum, &pages);
+  other->written_pages(shared, clnum, &pages);
+  sort(pages.begin(), pages.end());
+  pages.erase(unique(pages.begin(), pages.end()), pages.end());
+
+  for (size_t p = 0; p < pages.size(); p++) {
+    vector<MemoryWithValid> mine = FetchMemory(clnum, pages[p], MEMORY_PAGE_SIZE);
+    vector<MemoryWithValid> theirs = other->FetchMemory(clnum, pages[p], MEMORY_PAGE_SIZE);
+    for (int i = 0; i < MEMORY_PAGE_SIZE; i++) {
+      if (mine[i] == theirs[i]) continue;
+      MemoryDiff d;
+      d.address = pages[p] + i; d.value = mine[i]; d.other_value = theirs[i];
+      ret.push_back(d);
+      if (limit != 0 && ret.size() == limit) return ret;
+    }
+  }
+  return ret;
+}
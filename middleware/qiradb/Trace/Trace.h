@@ -15,6 +15,7 @@
   #endif
 #endif
 #include <set>
+#include <string>
 
 #ifndef _WIN32
 #include <stdint.h>
@@ -35,6 +36,12 @@
 #define RWLOCK_UNLOCK(x) pthread_rwlock_unlock(&x)
 #define RWLOCK_WRUNLOCK(x) pthread_rwlock_unlock(&x)
 
+#define MUTEX_INITIALIZER PTHREAD_MUTEX_INITIALIZER
+#define COND pthread_cond_t
+#define COND_INITIALIZER PTHREAD_COND_INITIALIZER
+#define COND_BROADCAST(x) pthread_cond_broadcast(&x)
+#define COND_WAIT(x, m) pthread_cond_wait(&x, &m)
+
 #define QIRAFILE int
 #else
 typedef unsigned char uint8_t;
@@ -58,6 +65,12 @@ typedef unsigned long long uint64_t;
 #define MUTEX_LOCK(x) RWLOCK_WRLOCK(x)
 #define MUTEX_UNLOCK(x) RWLOCK_WRUNLOCK(x)
 
+#define MUTEX_INITIALIZER SRWLOCK_INIT
+#define COND CONDITION_VARIABLE
+#define COND_INITIALIZER CONDITION_VARIABLE_INIT
+#define COND_BROADCAST(x) WakeAllConditionVariable(&x)
+#define COND_WAIT(x, m) SleepConditionVariableSRW(&x, &m, INFINITE, 0)
+
 #define QIRAFILE HANDLE
 
 #define usleep(ns) Sleep(ns/1000)
@@ -67,20 +80,28 @@ typedef unsigned long long uint64_t;
 
 using namespace std;
 
-typedef uint32_t EntryNumber;
-typedef uint32_t Clnum;
+typedef uint64_t EntryNumber;
+typedef uint64_t Clnum;
+#define INVALID_CLNUM 0xFFFFFFFFFFFFFFFFULL
 typedef uint16_t MemoryWithValid;
 #define MEMORY_VALID 0x100
 typedef uint64_t Address;
-typedef map<Clnum, uint8_t> MemoryCell;
-typedef map<Clnum, uint64_t> RegisterCell;
 
-// copied from qemu_mods/tci.c 
+// every change point of one register, sorted by clnum
+struct RegisterColumn {
+  vector<Clnum> clnums;
+  vector<uint64_t> values;
+  RWLOCK lock;
+};
+
+// copied from qemu_mods/tci.c, the v2 log record
+// v1 records are widened to this as they are read
 struct change {
   Address address;
   uint64_t data;
   Clnum clnum;
   uint32_t flags;
+  uint32_t padding;
 };
 
 #define IS_VALID      0x80000000
@@ -90,59 +111,277 @@ struct change {
 #define IS_SYSCALL    0x08000000
 #define SIZE_MASK     0xFF
 
+#include "Log.h"
+#include "Spill.h"
+#include "Memory.h"
+#include "PostingList.h"
+#include "DepthMap.h"
+
 #define PAGE_INSTRUCTION 1
 #define PAGE_READ 2
 #define PAGE_WRITE 4
 
+// the address keyed indexes are split into shards that ingest can merge into in parallel
+#define INDEX_SHARDS 16
+#define INGEST_BATCH 1000000
+// smaller batches aren't worth the threads
+#define INGEST_MIN_PARALLEL 0x10000
+// how long the ingest thread sleeps when the tracer is quiet, doubling up to the max
+// the tracer writes through a mapping, so nothing but a grow wakes it sooner
+#define INGEST_IDLE_MIN_MS 10
+#define INGEST_IDLE_MAX_MS 200
+// the index is saved whole, so it's saved at most this often, and the next save waits
+// INDEX_SAVE_RATIO times as long as the last one took, keeping saving under a twentieth of the time
+// it's always saved when the trace closes
+#define INDEX_SAVE_MIN_MS 5000
+#define INDEX_SAVE_RATIO 20
+// the biggest change, a range query looks back this far for ones that start before it
+#define MAX_CHANGE_BYTES 8
+// a diff compares the logs this many clnums at a time
+#define DIFF_BATCH 0x1000
+// the page heat is counted in at most this many clnum buckets, they double in width as the trace grows
+#define HEAT_BUCKETS 4096
+
+inline int shard_for(Address a) {
+  // the low bits of addresses are too regular to use straight
+  a ^= a >> 33;
+  a *= 0xff51afd7ed558ccdULL;
+  a ^= a >> 33;
+  return a % INDEX_SHARDS;
+}
+
+struct IndexShard {
+  // ingest only holds it while merging into this shard
+  RWLOCK lock;
+  // keyed by shard_for(address)
+  map<pair<Address, char>, PostingList> addresstype_to_clnums;
+  // keyed by shard_for(data), only with the value index on
+  map<pair<uint64_t, char>, PostingList> valuetype_to_clnums;
+  // keyed by shard_for(page)
+  map<Address, MemoryPage*> memory;
+  map<Address, char> pages;
+  // accesses to the page in buckets of 1 << heat_shift clnums from the first clnum
+  // each shard is only rescaled when it's next merged into, so they can differ
+  map<Address, vector<uint32_t> > heat;
+  int heat_shift;
+};
+
+// what one ingest worker pulls out of a batch for one shard
+struct IngestShard {
+  map<pair<Address, char>, vector<Clnum> > addresstype_to_clnums;
+  map<pair<uint64_t, char>, vector<Clnum> > valuetype_to_clnums;
+  map<Address, vector<MemoryWrite> > memory;
+  map<Address, char> pages;
+  map<pair<Address, uint64_t>, uint32_t> heat;
+};
+
+// what one ingest worker pulls out of a batch for the shards it owns, without the lock
+struct IngestJob {
+  class Trace *trace;
+  int worker, workers;
+  const struct change *entries;
+  EntryNumber count;
+  // the heat buckets are built at the shift the batch started with, and merged at this one
+  int heat_shift, merge_heat_shift;
+
+  IngestShard shards[INDEX_SHARDS];
+  vector<vector<pair<Clnum, uint64_t> > > registers;
+};
+
+// the part of the trace that readers can see
+// ingest publishes a new one once a batch is merged everywhere, so a query that
+// spans shards never sees half a batch
+struct Epoch {
+  EntryNumber entries;
+  Clnum max_clnum, min_clnum;
+  // a fork has no history before fork_clnum, it reads through to the parent's
+  class Trace *parent;
+  Clnum fork_clnum;
+};
+
+// where control flow went different ways, the first clnum of every run of different instructions
+struct BranchDiff {
+  Clnum clnum;
+  // 0 if the trace has no instruction there
+  Address address, other_address;
+};
+
+struct TraceDiff {
+  // the first clnum with different changes, INVALID_CLNUM if there's none
+  Clnum first_clnum;
+  vector<BranchDiff> branches;
+};
+
+struct RegisterDiff {
+  int reg;
+  uint64_t value, other_value;
+};
+
+struct MemoryDiff {
+  Address address;
+  MemoryWithValid value, other_value;
+};
+
+// how often the instruction at address ran, and when it first and last did
+struct PcSummary {
+  Address address;
+  uint64_t count;
+  Clnum first_clnum, last_clnum;
+};
+
+// a data flow slice from one clnum, taken a step at a time
+// backward it goes to the clnum of the last write before each read, forward to the reads of each write
+// up to and with the next write to it, both by (address, type), so a store is only seen by loads of the same address
+struct Slice {
+  Slice(Clnum clnum, bool forward) : forward(forward) { pending.insert(clnum); seen.insert(clnum); }
+  bool forward;
+  // in the slice, but what they read or wrote isn't followed yet
+  set<Clnum> pending;
+  set<Clnum> seen;
+  // by offset, everything reads the stack pointer
+  set<Address> ignore_registers;
+};
+
 void *thread_entry(void *);
 
+// every committed batch of every trace bumps the update sequence
+// blocks until it's past seq or timeout_ms runs out, and returns it
+uint64_t WaitForTraceUpdate(uint64_t seq, int timeout_ms);
+
+// for every trace in the process, the sealed index segments past budget bytes spill to disk
+// 0 is no budget, which is the default
+void SetMemoryBudget(uint64_t budget);
+SpillStats GetSpillStats();
+
 class Trace {
 public:
   Trace();
   ~Trace();
-  bool ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian);
+  void SetIngestThreads(int ingest_threads);
+  // off by default, it costs about as much as the address index
+  void SetValueIndex(bool value_index) { value_index_ = value_index; }
+  bool ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian, char *index_filename);
+  // from the log header, -1 if this isn't a fork
+  int GetParentId() { return parent_id_; }
+  // the parent must outlive this
+  void SetParent(Trace *parent);
 
   // these must be threadsafe
   vector<Clnum> FetchClnumsByAddressAndType(Address address, char type, Clnum start_clnum, Clnum end_clnum, unsigned int limit);
+  // the clnums where a change of one of types had (data & mask) == (value & mask)
+  vector<Clnum> FetchClnumsByValue(uint64_t value, uint64_t mask, const char *types, Clnum start_clnum, Clnum end_clnum, unsigned int limit);
   vector<struct change> FetchChangesByClnum(Clnum clnum, unsigned int limit);
+  vector<struct change> FetchChangesRange(Clnum start_clnum, Clnum end_clnum, const char *types, unsigned int limit_per_clnum);
+  // the changes of one of types that touch [lo, hi), in clnum order
+  vector<struct change> FetchChangesInRange(Address lo, Address hi, const char *types, Clnum start_clnum, Clnum end_clnum, unsigned int limit);
   vector<MemoryWithValid> FetchMemory(Clnum clnum, Address address, int len);
+  // where pattern is in memory at clnum, only in [start, end) of ranges unless it's empty
+  // only the memory the trace loaded or stored is searched
+  vector<Address> SearchMemory(Clnum clnum, const string &pattern, const vector<pair<Address, Address> > &ranges, unsigned int limit);
   vector<uint64_t> FetchRegisters(Clnum clnum);
+  vector<uint64_t> FetchRegistersRange(Clnum start_clnum, Clnum end_clnum);
+  // every instruction address in [lo, hi) that ran in [start_clnum, end_clnum), by address
+  // it's summed from the 'I' posting lists, which keep their count and ends
+  vector<PcSummary> FetchPcSummary(Address lo, Address hi, Clnum start_clnum, Clnum end_clnum);
+  // the last clnum before clnum with a change of type to address, INVALID_CLNUM if there's none
+  Clnum FetchClnumBefore(Address address, char type, Clnum clnum);
+  // follows the pending clnums of slice for about budget_ms, or until there are limit new ones if limit isn't 0
+  // a clnum is followed whole, so it can go over limit
+  // the new clnums in the slice, in the order they were found
+  vector<Clnum> SliceStep(Slice *slice, unsigned int limit, int budget_ms);
+
+  // walks both logs in lockstep from start_clnum, or from where they stop sharing history if that's later
+  // it stops after limit branches if limit isn't 0
+  TraceDiff Diff(Trace *other, Clnum start_clnum, Clnum end_clnum, unsigned int limit);
+  // what's different at clnum, the memory only on the pages either wrote since they stopped sharing history
+  vector<RegisterDiff> DiffRegisters(Trace *other, Clnum clnum);
+  vector<MemoryDiff> DiffMemory(Trace *other, Clnum clnum, unsigned int limit);
+
+  // zero copy access to the log unless the range spans chunks, the pointer stays valid until UnpinChanges
+  // NULL if the copy can't be allocated, count is still how many it would have had
+  // past a chunk (1 << chunk_shift entries) that copy is the whole range, PinChangeChunks never copies
+  const struct change *PinChanges(Clnum start_clnum, Clnum end_clnum, EntryNumber *count);
+  // the same changes as a piece per log chunk, each one stays valid until it's passed to UnpinChanges
+  vector<pair<const struct change *, EntryNumber> > PinChangeChunks(Clnum start_clnum, Clnum end_clnum);
+  void UnpinChanges(const struct change *changes);
 
   // simple ones
   map<Address, char> GetPages();
-  Clnum GetMaxClnum() { return max_clnum_; }
-  Clnum GetMinClnum() { return min_clnum_; }
+  // per page, how many instructions, loads and stores hit it in each of buckets slices of [start_clnum, end_clnum)
+  // it's only as fine as the trace's HEAT_BUCKETS
+  map<Address, vector<uint32_t> > GetPageHeatmap(Clnum start_clnum, Clnum end_clnum, int buckets);
+  Clnum GetMaxClnum() { return GetEpoch().max_clnum; }
+  Clnum GetMinClnum() { return GetEpoch().min_clnum; }
+  Epoch GetEpoch() { MUTEX_LOCK(epoch_mutex_); Epoch ret = epoch_; MUTEX_UNLOCK(epoch_mutex_); return ret; }
+  int GetRegisterCount() { return register_count_; }
 
   bool GetDidUpdate() { bool ret = did_update_; if (ret) { did_update_ = false; } return ret; }
 
   static char get_type_from_flags(uint32_t flags);
 
   // should be private
-  void process();
+  bool process();
+  bool LoadIndex();
+  bool SaveIndex();
+  // if it's dirty and the last save was long enough ago
+  bool WantsSave();
+  bool IsCaughtUp();
+  void WaitForLog(int timeout_ms);
+  bool index_dirty_;
   bool is_running_;
 private:
   THREAD thread;
 
-  inline void commit_memory(Clnum clnum, Address a, uint8_t d);
-  inline MemoryWithValid get_byte(Clnum clnum, Address a);
+  inline void commit_register(Clnum clnum, int reg, uint64_t d);
+
+  int ingest_threads_;
+  static void *build_entry(void *job);
+  static void *merge_entry(void *job);
+  void build_batch(IngestJob *job);
+  void merge_batch(IngestJob *job);
 
   bool is_big_endian_;
+  bool value_index_;
   // the backing of the database
-  RWLOCK db_lock_;
-  unordered_map<pair<Address, char>, set<Clnum> > addresstype_to_clnums_;
+  // readers lock only the shard or register they look at, and clamp to the epoch
+  IndexShard shards_[INDEX_SHARDS];
+  RWLOCK clnums_lock_;
+  // indexed by clnum - clnum_base_
   vector<EntryNumber> clnum_to_entry_number_;
-  vector<RegisterCell> registers_; int register_size_, register_count_;
-  map<Address, MemoryCell> memory_;
-  map<Address, char> pages_;
+  Clnum clnum_base_;
+  vector<RegisterColumn> registers_; int register_size_, register_count_;
+  // how far ingest is, only the ingest thread touches these
   Clnum max_clnum_, min_clnum_;
+
+  void publish_epoch();
+  MUTEX epoch_mutex_;
+  Epoch epoch_;
+  int parent_id_;
+  Clnum first_clnum_;
   
-  bool remap_backing(uint64_t);
-  MUTEX backing_mutex_;
-  const struct change* backing_;
-  uint64_t backing_size_;
-  QIRAFILE fd_;
+  string index_filename_;
+  uint64_t next_save_ms_;
+  // the loaded index, the sealed segments read back in from it until the trace is freed
+  uint8_t *index_map_;
+  size_t index_map_len_;
+  void unmap_index();
+
+  EntryNumber entry_for_clnum(Clnum clnum, const Epoch &e);
+  void memory_pages(Clnum clnum, vector<Address> *out);
+  void written_pages(Clnum start_clnum, Clnum end_clnum, vector<Address> *out);
+  Clnum shared_clnums(Trace *other);
+  Clnum last_clnum();
+  void add_heat(Clnum start_clnum, Clnum end_clnum, int buckets, Clnum lo, Clnum hi, map<Address, vector<uint32_t> > *out);
+  int heat_shift_;
+  bool log_entry(EntryNumber en, struct change *out);
+
+  Log log_;
   EntryNumber entries_done_;
 
+  // what WaitForLog sleeps on, the log's inotify and a pipe the destructor pokes
+  int notify_fd_;
+  int wake_fds_[2];
+
   bool did_update_;
   unsigned int trace_index_;
 };
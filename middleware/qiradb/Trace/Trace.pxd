@@ -1,15 +1,20 @@
 # distutils: language = c++
 
-from libc.stdint cimport uint32_t, uint64_t, uint16_t
+from libc.stdint cimport int32_t, uint32_t, uint64_t, uint16_t
 from libcpp cimport bool
 from libcpp.map cimport map
+from libcpp.set cimport set
+from libcpp.string cimport string
+from libcpp.utility cimport pair
 from libcpp.vector cimport vector
 
 cdef extern from "Trace.cpp":
   pass
 
-cdef extern from "Trace.h":
-  ctypedef uint32_t Clnum;
+# none of it touches python objects, so it can all run without the GIL
+cdef extern from "Trace.h" nogil:
+  ctypedef uint64_t EntryNumber;
+  ctypedef uint64_t Clnum;
   ctypedef uint64_t Address;
   ctypedef uint16_t MemoryWithValid;
 
@@ -18,19 +23,90 @@ cdef extern from "Trace.h":
     uint64_t data
     Clnum clnum
     uint32_t flags
+    uint32_t padding
+
+  cdef struct PcSummary:
+    Address address
+    uint64_t count
+    Clnum first_clnum
+    Clnum last_clnum
+
+  cdef struct BranchDiff:
+    Clnum clnum
+    Address address
+    Address other_address
+
+  cdef struct TraceDiff:
+    Clnum first_clnum
+    vector[BranchDiff] branches
+
+  cdef struct RegisterDiff:
+    int reg
+    uint64_t value
+    uint64_t other_value
+
+  cdef struct MemoryDiff:
+    Address address
+    MemoryWithValid value
+    MemoryWithValid other_value
+
+  cdef cppclass Slice:
+    Slice(Clnum clnum, bool forward)
+    bool forward
+    set[Clnum] pending
+    set[Clnum] seen
+    set[Address] ignore_registers
+
+  uint64_t WaitForTraceUpdate(uint64_t seq, int timeout_ms) nogil
+
+  cdef struct SpillStats:
+    uint64_t budget
+    uint64_t resident_bytes
+    uint64_t spilled_bytes
+    uint64_t spills
+    uint64_t reloads
+
+  void SetMemoryBudget(uint64_t budget)
+  SpillStats GetSpillStats()
+
+  cdef cppclass DepthMap:
+    DepthMap(bool branch_delay_slots)
+    void SetCall(Address pc)
+    void Add(const Address *addresses, const uint64_t *lengths, const Clnum *clnums, size_t count, vector[int32_t] *out)
+    int32_t Depth()
 
   cdef cppclass Trace:
     Trace()
-    bool ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian)
+    void SetIngestThreads(int ingest_threads)
+    void SetValueIndex(bool value_index)
+    bool ConnectToFileAndStart(char *filename, unsigned int trace_index, int register_size, int register_count, bool is_big_endian, char *index_filename)
+    int GetParentId()
+    void SetParent(Trace *parent)
     Clnum GetMaxClnum()
     Clnum GetMinClnum()
     bool GetDidUpdate()
+    int GetRegisterCount()
 
     map[Address, char] GetPages()
+    map[Address, vector[uint32_t]] GetPageHeatmap(Clnum start_clnum, Clnum end_clnum, int buckets)
     vector[Clnum] FetchClnumsByAddressAndType(Address, char, Clnum, Clnum, unsigned int)
+    vector[Clnum] FetchClnumsByValue(uint64_t value, uint64_t mask, const char *types, Clnum start_clnum, Clnum end_clnum, unsigned int limit)
     vector[uint64_t] FetchRegisters(Clnum clnum)
+    vector[uint64_t] FetchRegistersRange(Clnum start_clnum, Clnum end_clnum)
+    vector[PcSummary] FetchPcSummary(Address lo, Address hi, Clnum start_clnum, Clnum end_clnum)
+    Clnum FetchClnumBefore(Address address, char type, Clnum clnum)
+    vector[Clnum] SliceStep(Slice *slice, unsigned int limit, int budget_ms)
+    TraceDiff Diff(Trace *other, Clnum start_clnum, Clnum end_clnum, unsigned int limit)
+    vector[RegisterDiff] DiffRegisters(Trace *other, Clnum clnum)
+    vector[MemoryDiff] DiffMemory(Trace *other, Clnum clnum, unsigned int limit)
     vector[MemoryWithValid] FetchMemory(Clnum clnum, Address address, int len)
+    vector[Address] SearchMemory(Clnum clnum, const string &pattern, const vector[pair[Address, Address]] &ranges, unsigned int limit)
     vector[change] FetchChangesByClnum(Clnum clnum, unsigned int limit)
+    vector[change] FetchChangesRange(Clnum start_clnum, Clnum end_clnum, const char *types, unsigned int limit_per_clnum)
+    vector[change] FetchChangesInRange(Address lo, Address hi, const char *types, Clnum start_clnum, Clnum end_clnum, unsigned int limit)
+    const change *PinChanges(Clnum start_clnum, Clnum end_clnum, EntryNumber *count)
+    vector[pair[const change *, EntryNumber]] PinChangeChunks(Clnum start_clnum, Clnum end_clnum)
+    void UnpinChanges(const change *changes)
 
     char get_type_from_flags(uint32_t flags)
 
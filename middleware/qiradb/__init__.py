@@ -3,6 +3,6 @@ import sys
 # only pyximport this
 import pyximport
 py_importer, pyx_importer = pyximport.install()
-from .qiradb import PyTrace
+from .qiradb import PyTrace, PyDepthMap, RawChanges, CHANGE_FORMAT, wait_for_update, set_memory_budget, get_memory_stats
 sys.meta_path.remove(pyx_importer)
 
@@ -1,4 +1,16 @@
-from Trace.Trace cimport Trace
+from libc.stdint cimport int32_t, uint32_t, uint64_t
+from libc.string cimport memcpy
+from cpython.array cimport array
+from libcpp cimport bool
+from libcpp.map cimport map
+from libcpp.string cimport string
+from libcpp.utility cimport pair
+from libcpp.vector cimport vector
+from cython.view cimport array as cvarray
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_ND, PyBUF_STRIDES, PyBUF_WRITABLE
+from Trace.Trace cimport Trace, change, EntryNumber, Clnum, Address, MemoryWithValid, WaitForTraceUpdate
+from Trace.Trace cimport SetMemoryBudget, GetSpillStats, SpillStats
+from Trace.Trace cimport TraceDiff, RegisterDiff, MemoryDiff, PcSummary, DepthMap, Slice
 
 # copied from Trace.h
 SIZE_MASK = 0xFF
@@ -6,17 +18,84 @@ PAGE_INSTRUCTION = 1
 PAGE_READ = 2
 PAGE_WRITE = 4
 
-MAXINT = 2**32-1
+MAXINT = 2**64-1
+
+# struct change, for numpy.frombuffer and friends
+CHANGE_FORMAT = "T{Q:address:Q:data:Q:clnum:I:flags:I:padding:}"
+cdef bytes CHANGE_FORMAT_BYTES = CHANGE_FORMAT.encode('ascii')
+
+cdef class RawChanges
+cdef class PySlice
+
+def wait_for_update(seq=0, timeout=0.2):
+  """Block until any trace in the process commits a batch past seq, or timeout
+  seconds pass, and return the new seq to wait on next time."""
+  cdef uint64_t c_seq = seq
+  cdef int timeout_ms = int(timeout * 1000)
+  with nogil:
+    c_seq = WaitForTraceUpdate(c_seq, timeout_ms)
+  return c_seq
+
+def set_memory_budget(budget):
+  """Cap the memory the indexes of every trace in the process use, in bytes. Past it
+  the least recently used parts are spilled to a temp file and read back when a query
+  needs them. 0, the default, never spills."""
+  cdef uint64_t c_budget = budget
+  with nogil:
+    SetMemoryBudget(c_budget)
+
+def get_memory_stats():
+  """The budget, how many bytes of the spillable index are in memory and on disk, and
+  how many times parts were spilled and read back."""
+  cdef SpillStats stats = GetSpillStats()
+  return {'budget': stats.budget, 'resident_bytes': stats.resident_bytes, 'spilled_bytes': stats.spilled_bytes,
+          'spills': stats.spills, 'reloads': stats.reloads}
 
 cdef class PyTrace:
   cdef Trace *t
+  # a fork keeps its parent alive, it reads the history before the fork from it
+  cdef readonly PyTrace parent
 
-  def __cinit__(self, filename, trace_index, register_size, register_count, is_big_endian):
+  def __cinit__(self, filename, trace_index, register_size, register_count, is_big_endian, index_filename=None, ingest_threads=0, value_index=False):
     self.t = new Trace()
-    assert self.t.ConnectToFileAndStart(filename.encode('utf-8'), trace_index, register_size, register_count, is_big_endian)
+    # by default there is an ingest worker per core
+    if ingest_threads > 0:
+      self.t.SetIngestThreads(ingest_threads)
+    # what fetch_clnums_by_value needs, it's built during ingest
+    self.t.SetValueIndex(value_index)
+    # the index is optional, without it every open ingests the whole log
+    cdef char *c_index_filename = NULL
+    if index_filename is not None:
+      index_filename = index_filename.encode('utf-8')
+      c_index_filename = index_filename
+    # the index is loaded on the ingest thread, this only opens the log
+    filename = filename.encode('utf-8')
+    cdef char *c_filename = filename
+    cdef unsigned int c_trace_index = trace_index
+    cdef int c_register_size = register_size, c_register_count = register_count
+    cdef bool c_is_big_endian = is_big_endian
+    cdef bool ok
+    with nogil:
+      ok = self.t.ConnectToFileAndStart(c_filename, c_trace_index, c_register_size, c_register_count, c_is_big_endian, c_index_filename)
+    assert ok
+
+  # everything below does the native work without the GIL, and only then makes python objects
+  # so the webserver and the analysis threads don't stall behind one slow query
 
   def __dealloc__(self):
-    del self.t
+    # waits for the ingest thread to finish its batch, and saves the index
+    with nogil:
+      del self.t
+
+  def get_parent_id(self):
+    # the trace this was forked from, -1 if it wasn't
+    return self.t.GetParentId()
+
+  def set_parent(self, PyTrace parent not None):
+    if parent is self:
+      raise ValueError("a trace can't be its own parent")
+    self.parent = parent
+    self.t.SetParent(parent.t)
 
   def get_maxclnum(self):
     return self.t.GetMaxClnum()
@@ -29,7 +108,10 @@ cdef class PyTrace:
 
   def get_pmaps(self):
     ret = {}
-    pagemap = self.t.GetPages()
+    cdef map[Address, char] pages
+    with nogil:
+      pages = self.t.GetPages()
+    pagemap = pages
     for address,ttype in pagemap:
       if ttype & PAGE_INSTRUCTION:
         ret[address] = "instruction"
@@ -39,24 +121,231 @@ cdef class PyTrace:
         ret[address] = "romemory"
     return ret
 
+  def get_page_heatmap(self, clstart, clend, buckets=64):
+    # per page, the instructions, loads and stores in each of buckets slices of [clstart, clend)
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef int c_buckets = buckets
+    cdef map[Address, vector[uint32_t]] ret
+    with nogil:
+      ret = self.t.GetPageHeatmap(c_start, c_end, c_buckets)
+    return ret
+
   def fetch_clnums_by_address_and_type(self, address, ttype, start_clnum, end_clnum, limit):
-    return self.t.FetchClnumsByAddressAndType(address, ord(ttype), start_clnum, end_clnum, limit)
+    cdef Address c_address = address
+    cdef char c_type = ord(ttype)
+    cdef Clnum c_start = start_clnum, c_end = end_clnum
+    cdef unsigned int c_limit = limit
+    cdef vector[Clnum] ret
+    with nogil:
+      ret = self.t.FetchClnumsByAddressAndType(c_address, c_type, c_start, c_end, c_limit)
+    return ret
+
+  def fetch_clnums_by_value(self, value, mask=MAXINT, types="LSW", clstart=0, clend=MAXINT, limit=0):
+    # the clnums where a load, store or register write had value, comparing only the bits in mask
+    if limit == -1:
+      limit = 0
+    types = types.encode('utf-8')
+    cdef const char *c_types = types
+    cdef uint64_t c_value = value & MAXINT, c_mask = mask & MAXINT
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef unsigned int c_limit = limit
+    cdef vector[Clnum] ret
+    with nogil:
+      ret = self.t.FetchClnumsByValue(c_value, c_mask, c_types, c_start, c_end, c_limit)
+    return ret
 
   def fetch_registers(self, clnum):
     if clnum == -1:   # fetch the latest
       clnum = MAXINT
-    return self.t.FetchRegisters(clnum)
+    cdef Clnum c_clnum = clnum
+    cdef vector[uint64_t] ret
+    with nogil:
+      ret = self.t.FetchRegisters(c_clnum)
+    return ret
+
+  def fetch_registers_range(self, clstart, clend):
+    # rows are clnums in [clstart, clend), columns are registers
+    cdef int register_count = self.t.GetRegisterCount()
+    if clend <= clstart or register_count == 0:
+      raise ValueError("empty register range")
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef vector[uint64_t] regs
+    with nogil:
+      regs = self.t.FetchRegistersRange(c_start, c_end)
+    cdef cvarray ret = cvarray(shape=(clend-clstart, register_count), itemsize=sizeof(uint64_t), format="Q")
+    memcpy(ret.data, regs.data(), regs.size()*sizeof(uint64_t))
+    return ret
 
   def fetch_memory(self, clnum, address, llen):
     if clnum == -1:   # fetch the latest
       clnum = MAXINT
-    return self.t.FetchMemory(clnum, address, llen)
+    cdef Clnum c_clnum = clnum
+    cdef Address c_address = address
+    cdef int c_len = llen
+    cdef vector[MemoryWithValid] ret
+    with nogil:
+      ret = self.t.FetchMemory(c_clnum, c_address, c_len)
+    return ret
+
+  def search_memory(self, clnum, pattern, address_ranges=None, limit=0):
+    # the addresses pattern is at in memory at clnum, optionally only in [start, end) ranges
+    if clnum == -1:   # search the latest
+      clnum = MAXINT
+    if limit == -1:
+      limit = 0
+    if not isinstance(pattern, bytes):
+      pattern = pattern.encode('latin-1')
+    cdef Clnum c_clnum = clnum
+    cdef string c_pattern = pattern
+    cdef vector[pair[Address, Address]] c_ranges
+    if address_ranges is not None:
+      for (start, end) in address_ranges:
+        c_ranges.push_back(pair[Address, Address](start, end))
+    cdef unsigned int c_limit = limit
+    cdef vector[Address] ret
+    with nogil:
+      ret = self.t.SearchMemory(c_clnum, c_pattern, c_ranges, c_limit)
+    return ret
+
+  def fetch_pc_summary(self, lo, hi, clstart=0, clend=MAXINT):
+    # {address: (count, first clnum, last clnum)} for every instruction in [lo, hi) that ran in [clstart, clend)
+    # no clnums are fetched, so a whole function is cheap
+    cdef Address c_lo = lo, c_hi = hi
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef vector[PcSummary] ret
+    with nogil:
+      ret = self.t.FetchPcSummary(c_lo, c_hi, c_start, c_end)
+    return dict((pc.address, (pc.count, pc.first_clnum, pc.last_clnum)) for pc in ret)
+
+  def diff(self, PyTrace other, clstart=0, clend=MAXINT, limit=0, clnums=()):
+    # how other differs from this, walking only what they don't share, a fork and its parent share what's before the fork
+    # first_clnum is None if they're the same, branches are (clnum, address, other's address) where control flow split,
+    # and states has the registers and memory that differ at each of clnums, (index or address, value, other's value)
+    if limit == -1:
+      limit = 0
+    cdef Clnum c_start = clstart, c_end = clend, c_clnum
+    cdef unsigned int c_limit = limit
+    cdef TraceDiff d
+    cdef vector[RegisterDiff] registers
+    cdef vector[MemoryDiff] memory
+    with nogil:
+      d = self.t.Diff(other.t, c_start, c_end, c_limit)
+    ret = {'first_clnum': None if d.first_clnum == MAXINT else d.first_clnum,
+           'branches': [(b.clnum, b.address, b.other_address) for b in d.branches],
+           'states': {}}
+    for clnum in clnums:
+      c_clnum = clnum
+      with nogil:
+        registers = self.t.DiffRegisters(other.t, c_clnum)
+        memory = self.t.DiffMemory(other.t, c_clnum, c_limit)
+      ret['states'][clnum] = {'registers': [(r.reg, r.value, r.other_value) for r in registers],
+                              'memory': [(m.address, m.value, m.other_value) for m in memory]}
+    return ret
+
+  def fetch_clnum_before(self, address, typ, clnum):
+    # the last clnum before clnum with a change of typ to address, None if there's none
+    cdef Address c_address = address
+    cdef char c_type = ord(typ[0])
+    cdef Clnum c_clnum = clnum, ret
+    with nogil:
+      ret = self.t.FetchClnumBefore(c_address, c_type, c_clnum)
+    return None if ret == MAXINT else ret
+
+  def slice(self, clnum, forward=False, ignore_registers=()):
+    # a data flow slice from clnum, it's followed a step at a time with step()
+    cdef PySlice ret = PySlice.__new__(PySlice)
+    ret.s = new Slice(clnum, forward)
+    for address in ignore_registers:
+      ret.s.ignore_registers.insert(address)
+    ret.trace = self
+    return ret
+
+  def fetch_raw_changes(self, clstart=0, clend=MAXINT):
+    # every change with clstart <= clnum < clend, straight out of the log
+    # it's one buffer, so a range past one log chunk (1M changes by default) is a copy of all of it
+    # fetch_raw_change_chunks never copies
+    cdef EntryNumber count = 0
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef const change *changes
+    cdef RawChanges ret = RawChanges.__new__(RawChanges)
+    with nogil:
+      changes = self.t.PinChanges(c_start, c_end, &count)
+    if changes == NULL:
+      # the range spans chunks and there was no memory to copy it into
+      raise MemoryError("can't pin %d changes of the log" % count)
+    ret.changes = changes
+    ret.count = count
+    ret.trace = self
+    return ret
+
+  def fetch_raw_change_chunks(self, clstart=0, clend=MAXINT):
+    # the same changes as fetch_raw_changes, as a list of RawChanges with one per log chunk
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef vector[pair[const change *, EntryNumber]] parts
+    with nogil:
+      parts = self.t.PinChangeChunks(c_start, c_end)
+    cdef RawChanges raw
+    ret = []
+    for part in parts:
+      raw = RawChanges.__new__(RawChanges)
+      raw.changes = part.first
+      raw.count = part.second
+      raw.trace = self
+      ret.append(raw)
+    return ret
+
+  def fetch_changes_range(self, clstart, clend, types="ILSRWs", limit_per_clnum=0):
+    # the changes with clstart <= clnum < clend as columns, not one dict per change
+    if limit_per_clnum == -1:
+      limit_per_clnum = 0
+    types = types.encode('utf-8')
+    cdef const char *c_types = types
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef unsigned int c_limit = limit_per_clnum
+    cdef vector[change] its
+    with nogil:
+      its = self.t.FetchChangesRange(c_start, c_end, c_types, c_limit)
+    return self.changes_to_columns(its)
+
+  def fetch_changes_in_range(self, lo, hi, types="S", clstart=0, clend=MAXINT, limit=0):
+    # the changes that touch addresses [lo, hi) with clstart <= clnum < clend, as columns in clnum order
+    if limit == -1:
+      limit = 0
+    types = types.encode('utf-8')
+    cdef const char *c_types = types
+    cdef Address c_lo = lo, c_hi = hi
+    cdef Clnum c_start = clstart, c_end = clend
+    cdef unsigned int c_limit = limit
+    cdef vector[change] its
+    with nogil:
+      its = self.t.FetchChangesInRange(c_lo, c_hi, c_types, c_start, c_end, c_limit)
+    return self.changes_to_columns(its)
+
+  cdef changes_to_columns(self, vector[change] &its):
+    cdef size_t i, n = its.size()
+    cdef array addresses = array('Q', [0])*n
+    cdef array datas = array('Q', [0])*n
+    cdef array clnums = array('Q', [0])*n
+    cdef array sizes = array('B', [0])*n
+    cdef bytearray ttypes = bytearray(n)
+    for i in range(n):
+      addresses.data.as_ulonglongs[i] = its[i].address
+      datas.data.as_ulonglongs[i] = its[i].data
+      clnums.data.as_ulonglongs[i] = its[i].clnum
+      sizes.data.as_uchars[i] = its[i].flags & SIZE_MASK
+      ttypes[i] = self.t.get_type_from_flags(its[i].flags)
+    return {"address": addresses, "data": datas, "clnum": clnums,
+            "type": ttypes.decode('ascii'), "size": sizes}
 
   def fetch_changes_by_clnum(self, clnum, limit):
     ret = []
     if limit == -1:
       limit = 0
-    its = self.t.FetchChangesByClnum(clnum, limit)
+    cdef Clnum c_clnum = clnum
+    cdef unsigned int c_limit = limit
+    cdef vector[change] its
+    with nogil:
+      its = self.t.FetchChangesByClnum(c_clnum, c_limit)
     for it in its:
       tl = {"address": it.address,
             "data": it.data,
@@ -66,3 +355,106 @@ cdef class PyTrace:
       ret.append(tl)
     return ret
 
+cdef class PyDepthMap:
+  """The call depth at every clnum, built from the instruction flow a piece at a time.
+  Which pcs are calls is told to it with set_call before they show up in the flow."""
+  cdef DepthMap *d
+
+  def __cinit__(self, branch_delay_slots=False):
+    self.d = new DepthMap(branch_delay_slots)
+
+  def __dealloc__(self):
+    del self.d
+
+  def set_call(self, pc):
+    self.d.SetCall(pc)
+
+  def add(self, addresses, lengths, clnums):
+    """The depths for the next instructions, -1 for the clnums missing in between, then the
+    depth after the last of them, as an array('i')."""
+    cdef array c_addresses = addresses if isinstance(addresses, array) and addresses.typecode == 'Q' else array('Q', addresses)
+    cdef array c_lengths = lengths if isinstance(lengths, array) and lengths.typecode == 'Q' else array('Q', lengths)
+    cdef array c_clnums = clnums if isinstance(clnums, array) and clnums.typecode == 'Q' else array('Q', clnums)
+    cdef Py_ssize_t count = len(c_addresses)
+    if len(c_lengths) != count or len(c_clnums) != count:
+      raise ValueError("addresses, lengths and clnums aren't the same length")
+    cdef vector[int32_t] out
+    with nogil:
+      self.d.Add(<const Address *>c_addresses.data.as_ulonglongs, <const uint64_t *>c_lengths.data.as_ulonglongs,
+                 <const Clnum *>c_clnums.data.as_ulonglongs, <size_t>count, &out)
+      out.push_back(self.d.Depth())
+    cdef array ret = array('i', [0])*out.size()
+    memcpy(ret.data.as_ints, &out[0], out.size()*sizeof(int32_t))
+    return ret
+
+cdef class PySlice:
+  """A data flow slice from one clnum. Backward it's the clnums that wrote what it read, and
+  what wrote what they read, and so on. Forward it's the clnums that read what it wrote."""
+  cdef PyTrace trace
+  cdef Slice *s
+
+  def step(self, limit=0, budget=0.05):
+    """The clnums newly found in the slice, in about budget seconds or until there are at least
+    limit of them if limit isn't 0. 0 budget is until it's done."""
+    if limit == -1:
+      limit = 0
+    cdef unsigned int c_limit = limit
+    cdef int budget_ms = max(1, int(budget * 1000)) if budget > 0 else 0
+    cdef vector[Clnum] ret
+    with nogil:
+      ret = self.trace.t.SliceStep(self.s, c_limit, budget_ms)
+    return ret
+
+  def done(self):
+    return self.s.pending.empty()
+
+  def __dealloc__(self):
+    del self.s
+
+cdef class RawChanges:
+  """A read only view of the changes in the log, without copying them.
+  It exports the buffer protocol, one struct change per item."""
+  cdef PyTrace trace
+  cdef const change *changes
+  cdef Py_ssize_t count
+  cdef Py_ssize_t shape[1]
+  cdef Py_ssize_t strides[1]
+
+  def __len__(self):
+    return self.count
+
+  def __getbuffer__(self, Py_buffer *buffer, int flags):
+    if flags & PyBUF_WRITABLE:
+      raise BufferError("the trace log is read only")
+    buffer.buf = <void *>self.changes
+    buffer.obj = self
+    buffer.len = self.count * sizeof(change)
+    buffer.readonly = 1
+    buffer.ndim = 1
+    buffer.suboffsets = NULL
+    buffer.internal = NULL
+    if flags & PyBUF_FORMAT:
+      # one structured item per change
+      self.shape[0] = self.count
+      self.strides[0] = sizeof(change)
+      buffer.format = CHANGE_FORMAT_BYTES
+      buffer.itemsize = sizeof(change)
+    else:
+      # plain bytes
+      self.shape[0] = buffer.len
+      self.strides[0] = 1
+      buffer.format = NULL
+      buffer.itemsize = 1
+    buffer.shape = NULL
+    buffer.strides = NULL
+    if flags & PyBUF_ND:
+      buffer.shape = self.shape
+    if (flags & PyBUF_STRIDES) == PyBUF_STRIDES:
+      buffer.strides = self.strides
+
+  def __releasebuffer__(self, Py_buffer *buffer):
+    pass
+
+  def __dealloc__(self):
+    if self.trace is not None:
+      self.trace.t.UnpinChanges(self.changes)
@@ -0,0 +1,274 @@
+import sys
+sys.path.append("middleware/")
+import base64
+import io
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from PIL import Image
+import arch
+import qiradb
+import qira_analysis
+import qira_program
+from test_qiradb import write_trace, wait_for, IS_VALID, IS_WRITE, IS_MEM, IS_START
+
+class FakeTrace(object):
+  def __init__(self, dmap, maxd):
+    self.dmap = array('i', dmap)
+    self.maxd = maxd
+    self.minclnum = 0
+    self.maxclnum = len(dmap)
+
+def tile_pixels(dat):
+  im = Image.open(io.BytesIO(base64.b64decode(dat.split(",")[1])))
+  return [im.getpixel((0, y)) for y in range(im.size[1])]
+
+def test_vtimeline_tiles():
+  RED = (96, 32, 32)
+  BLACK = (0, 0, 0)
+  # every 50th clnum is missing
+  t = FakeTrace([-1 if i % 50 == 0 else i % 5 for i in range(300)], 4)
+  v = qira_analysis.VtimelineTiles(t)
+  tiles = v.get_tiles(0, 300, 1.0)
+  assert [(clstart, clend) for (clstart, clend, _) in tiles] == [(0, 256), (256, 512)]
+  px = tile_pixels(tiles[0][2])
+  assert px[0] == RED and px[50] == RED
+  assert px[1] == (0, 32, 32) and px[4] == (0, 128, 128)
+  # only the full one is kept
+  assert list(v.tiles) == [(0, 0)]
+  px = tile_pixels(tiles[1][2])
+  assert px[300-256-1] == (0, 128, 128) and px[300-256] == BLACK
+
+  # it grows, the last tile is drawn again with the new rows
+  t.dmap.extend([i % 5 for i in range(300, 600)])
+  t.maxclnum = 600
+  tiles = v.get_tiles(256, 600, 1.0)
+  px = tile_pixels(tiles[0][2])
+  assert px[300-256] == (0, 0, 0) and px[300-256+1] == (0, 32, 32) and px[255] == (0, 32, 32)
+  assert sorted(v.tiles) == [(0, 0), (0, 1)]
+
+  # a coarser level samples every other clnum
+  tiles = v.get_tiles(0, 600, 3.0)
+  assert v.get_level(3.0) == 1 and tiles[0][:2] == (0, 512)
+  px = tile_pixels(tiles[0][2])
+  assert px[25] == RED and px[1] == (0, 64, 64)
+
+  # dmap ahead of maxd while the analysis updates, it's drawn but not kept
+  t.dmap.extend([9]*256)
+  t.maxclnum = 856
+  tiles = v.get_tiles(512, 768, 1.0)
+  assert tile_pixels(tiles[0][2])[700-512] == (0, 128, 128)
+  assert (0, 2) not in v.tiles
+
+  # maxd moving on drops what's kept
+  t.maxd = 9
+  v.get_tiles(0, 256, 1.0)
+  assert list(v.tiles) == [(0, 0)]
+
+# a tiny i386 program for the call analysis, only what it looks at is there
+class FakeInstruction(object):
+  def __init__(self, call):
+    self.call = call
+  def is_call(self):
+    return self.call
+  def __str__(self):
+    return "call" if self.call else "nop"
+
+class FakeFunction(object):
+  def __init__(self):
+    self.abi = 'UNKNOWN'
+    self.nargs = 0
+
+class FakeAnalyzer(object):
+  def make_function_at(self, static, address):
+    static.setdefault(address, {}).setdefault('function', FakeFunction())
+
+class FakeStatic(dict):
+  def __init__(self, calls):
+    dict.__init__(self)
+    self.analyzer = FakeAnalyzer()
+    self['arch'] = 'i386'
+    for address in calls:
+      self[address] = {'instruction': FakeInstruction(True)}
+  def __missing__(self, address):
+    self[address] = {'instruction': FakeInstruction(False)}
+    return self[address]
+
+class FakeProgram(object):
+  def __init__(self, calls):
+    self.tregs = arch.X86REGS
+    self.static = FakeStatic(calls)
+  def read_asm_file(self):
+    pass
+
+class FakeCallTrace(object):
+  def __init__(self, db, program):
+    self.db = db
+    self.program = program
+    self.minclnum = 0
+
+EAX, ECX, EDX, EBX, ESP = 0, 1, 2, 3, 4
+CALLS = [0x110, 0x2010, 0x120]
+
+def call_flow():
+  # main calls f(1, 2) and h, f sets ECX and calls g with it, h saves and restores EBX around using ECX
+  # (address, length, registers read, registers written, memory loaded, memory stored)
+  instrs = [
+    (0x100, 3, [], [(EAX, 0x11), (ECX, 0x22), (EDX, 0x33), (EBX, 0x44), (ESP, 0xf000)], [], []),
+    (0x103, 5, [], [], [], [(0xeffc, 2), (0xeff8, 1)]),
+    (0x110, 5, [], [(ESP, 0xeff4)], [], [(0xeff4, 0x115)]),
+    (0x2000, 3, [], [(ECX, 5)], [], []),
+    (0x2003, 3, [], [], [0xeff8], []),
+    (0x2006, 3, [], [], [0xeffc], []),
+    (0x2010, 5, [], [(ESP, 0xeff0)], [], [(0xeff0, 0x2015)]),
+    (0x3000, 3, [ECX], [(EAX, 0x99)], [], []),
+    (0x3003, 1, [], [(ESP, 0xeff4)], [0xeff0], []),
+    (0x2015, 3, [], [(EAX, 0x77)], [], []),
+    (0x2018, 1, [], [(ESP, 0xeff8)], [0xeff4], []),
+    (0x115, 3, [], [], [], []),
+    (0x120, 5, [], [(ESP, 0xeff4)], [], [(0xeff4, 0x125)]),
+    (0x4000, 1, [EBX], [(ESP, 0xeff0)], [], [(0xeff0, 0x44)]),
+    (0x4001, 3, [ECX], [(EBX, 1), (EAX, 0x55)], [], []),
+    (0x4004, 1, [], [(EBX, 0x44), (ESP, 0xeff4)], [0xeff0], []),
+    (0x4005, 1, [], [(ESP, 0xeff8)], [0xeff4], []),
+    (0x125, 3, [], [], [], []),
+    (0x128, 3, [], [], [], []),
+  ]
+  regs = [0]*9
+  mem = {}
+  changes = []
+  for (clnum, (address, length, reads, writes, loads, stores)) in enumerate(instrs):
+    changes.append((address, length, clnum, IS_VALID | IS_START))
+    for reg in reads:
+      changes.append((reg*4, regs[reg], clnum, IS_VALID | 32))
+    for (reg, value) in writes:
+      regs[reg] = value
+      changes.append((reg*4, value, clnum, IS_VALID | IS_WRITE | 32))
+    for address in loads:
+      changes.append((address, mem.get(address, 0), clnum, IS_VALID | IS_MEM | 32))
+    for (address, value) in stores:
+      mem[address] = value
+      changes.append((address, value, clnum, IS_VALID | IS_WRITE | IS_MEM | 32))
+  return changes, len(instrs)
+
+def call_trace():
+  changes, n = call_flow()
+  d = tempfile.mkdtemp()
+  write_trace(os.path.join(d, "0"), changes)
+  db = qiradb.PyTrace(os.path.join(d, "0"), 0, 4, 9, False)
+  wait_for(db, n-1)
+  t = FakeCallTrace(db, FakeProgram(CALLS))
+  flow = qira_analysis.get_instruction_flow(t, t.program, 0, n)
+  dm = qira_analysis.DepthMap(t.program)
+  dm.add(flow)
+  t.dmap = dm.dmap
+  # like the analysis thread, the row before minclnum goes
+  if len(t.dmap) - n == 2:
+    del t.dmap[0]
+  return t, d, n
+
+def call_functions(t):
+  return dict((address, (v['function'].abi, v['function'].nargs))
+    for (address, v) in t.program.static.items() if isinstance(v, dict) and 'function' in v)
+
+def test_call_sweep():
+  t, d, n = call_trace()
+  try:
+    # a piece at a time like the analysis thread, h hasn't returned by the end of the first one
+    full = t.dmap
+    t.dmap = full[:16]
+    sweep = qira_analysis.analyse_calls(t)
+    assert [frame.clnum for frame in sweep.frames] == [12]
+    assert 0x4000 not in call_functions(t)
+    t.dmap = full
+    assert qira_analysis.analyse_calls(t, sweep) is sweep
+    assert sweep.frames == [] and sweep.writebacks == {}
+
+    # f loads two stack args, the ECX read is g's after f set it
+    # g and h read the ECX they're called with, the EBX h only saves and restores isn't an arg
+    assert call_functions(t) == {
+      0x2000: ('X86_CDECL', 2),
+      0x3000: ('X86_FASTCALL', 1),
+      0x4000: ('X86_FASTCALL', 1)}
+
+    # the args at the call and what it returned
+    assert qira_analysis.get_last_instr(t.dmap, 6) == 8
+    assert qira_analysis.display_call_args(None, t, 6) == "0x5 -> 0x99"
+    assert qira_analysis.display_call_args(None, t, 12) == "0x5 -> 0x55"
+  finally:
+    shutil.rmtree(d, ignore_errors=True)
+
+class StillTrace(qira_program.Trace):
+  # the analysis is run by hand, and there's no base memory
+  def analysis_thread(self):
+    pass
+  def load_base_memory(self):
+    pass
+
+def test_incremental_analysis():
+  changes, n = call_flow()
+  d = tempfile.mkdtemp()
+  try:
+    write_trace(os.path.join(d, "0"), changes)
+    full = StillTrace(os.path.join(d, "0"), 0, FakeProgram(CALLS), 4, 9, False)
+    wait_for(full.db, n-1)
+    full.update_analysis()
+
+    # the first piece stops while h runs, the rest is appended the way the tracer does it
+    fn = os.path.join(d, "1")
+    first = [c for c in changes if c[2] <= 15]
+    write_trace(fn, first)
+    t = StillTrace(fn, 1, FakeProgram(CALLS), 4, 9, False)
+    wait_for(t.db, 15)
+    t.update_analysis()
+    sweep = t.calls
+    assert [frame.clnum for frame in sweep.frames] == [12]
+    assert 0x4000 not in call_functions(t)
+    with open(fn, "r+b") as f:
+      f.seek(0, 2)
+      for c in changes[len(first):]:
+        f.write(struct.pack("QQII", *c))
+      f.seek(0)
+      f.write(struct.pack("I", len(changes)+1))
+    wait_for(t.db, n-1)
+    t.update_analysis()
+
+    # the same as in one go, the row before minclnum only went the first time
+    assert t.calls is sweep and sweep.frames == []
+    assert t.flow == full.flow and t.maxd == full.maxd
+    assert list(t.dmap) == list(full.dmap) and len(t.dmap) == n
+    assert call_functions(t) == call_functions(full)
+    assert call_functions(t)[0x4000] == ('X86_FASTCALL', 1)
+
+    # nothing new, nothing done
+    t.update_analysis()
+    assert t.calls is sweep and len(t.flow) == n-1
+
+    # a trace that got shorter starts over
+    t.maxclnum = n+10
+    t.update_analysis()
+    assert t.calls is not sweep and t.maxclnum == n-1
+    assert t.flow == full.flow and list(t.dmap) == list(full.dmap)
+    # closing saves the index, while the directory is still there
+    del t.db, full.db
+  finally:
+    shutil.rmtree(d, ignore_errors=True)
+
+def test_slice_cache():
+  t, d, n = call_trace()
+  try:
+    cache = qira_analysis.SliceCache(t, size=2)
+    # g's ECX is the one f set
+    got = cache.get(7)
+    assert 3 in got
+    assert got == set(t.db.slice(7, False, qira_analysis.get_stack_registers(t.program)).step(0, 0))
+    # asking again is the same slice, the oldest goes past size
+    assert cache.get(7) is got
+    cache.get(15)
+    cache.get(14, True)
+    assert list(cache.slices) == [(15, False), (14, True)]
+    assert cache.get(7) is not got and cache.get(7) == got
+  finally:
+    shutil.rmtree(d, ignore_errors=True)
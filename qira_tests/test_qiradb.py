@@ -1,5 +1,13 @@
 from __future__ import print_function
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
 import qiradb
+import qira_log
 import time
 #print dir(qiradb)
 
@@ -60,3 +68,788 @@ def test():
     ret = t.fetch_memory(0, 0xf6fff080, 0x10)
   """
 
+
+# the trace directories, removed when the tests in here are done
+temp_dirs = []
+
+def temp_dir():
+  d = tempfile.mkdtemp()
+  temp_dirs.append(d)
+  return d
+
+def teardown_module():
+  for d in temp_dirs:
+    shutil.rmtree(d, ignore_errors=True)
+  del temp_dirs[:]
+
+def wait_until(cond, timeout=30):
+  start = time.time()
+  while not cond():
+    assert time.time() - start < timeout, "timed out"
+    time.sleep(0.05)
+
+def wait_for(t, clnum, timeout=30):
+  # until the ingest gets to clnum
+  wait_until(lambda: t.get_maxclnum() == clnum, timeout)
+
+def test_index():
+  index_filename = os.path.join(temp_dir(), "hello_trace_index")
+
+  t = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False, index_filename=index_filename)
+  wait_for(t, 116)
+  # the index is written once the ingest catches up
+  wait_until(lambda: os.path.isfile(index_filename))
+
+  # reopening comes up from the index
+  t2 = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False, index_filename=index_filename)
+  wait_for(t2, 116)
+  assert t2.get_maxclnum() == t.get_maxclnum()
+  assert t2.get_minclnum() == t.get_minclnum()
+  assert t2.fetch_clnums_by_address_and_type(0xf6fff090, 'L', 0, 1000, LIMIT) == [0,2]
+  assert t2.fetch_registers(113) == t.fetch_registers(113)
+  assert t2.fetch_memory(116, 0xf6fff080, 0x10) == t.fetch_memory(116, 0xf6fff080, 0x10)
+  assert t2.fetch_changes_by_clnum(2, LIMIT) == t.fetch_changes_by_clnum(2, LIMIT)
+  assert t2.get_pmaps() == t.get_pmaps()
+
+  # an index for another trace is ignored
+  open(index_filename, "r+b").write(b"junk")
+  t3 = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False, index_filename=index_filename)
+  wait_for(t3, 116)
+
+def test_index_save_rate():
+  fn = os.path.join(temp_dir(), "0")
+  write_trace(fn, [(0x1000, 4, clnum, IS_VALID | IS_START) for clnum in range(10)])
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=fn+"_index")
+  wait_until(lambda: os.path.isfile(fn+"_index"))
+  saved = open(fn+"_index", "rb").read()
+
+  # caught up again right after, but it was saved too recently to save again
+  with open(fn, "r+b") as f:
+    f.seek(0, 2)
+    for clnum in range(10, 20):
+      f.write(struct.pack("QQII", 0x1000, 4, clnum, IS_VALID | IS_START))
+    f.seek(0)
+    f.write(struct.pack("I", 21))
+  wait_for(t, 19)
+  time.sleep(0.5)
+  assert open(fn+"_index", "rb").read() == saved
+
+  # closing saves it
+  del t
+  assert open(fn+"_index", "rb").read() != saved
+  t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=fn+"_index")
+  wait_for(t, 19)
+  assert t.fetch_clnums_by_address_and_type(0x1000, 'I', 0, 100, 0) == list(range(20))
+
+def test_index_lazy_load():
+  fn = os.path.join(temp_dir(), "0")
+  # several sealed segments of one page, and several sealed spans of one posting list
+  changes = []
+  for clnum in range(20000):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    changes.append((0x10000 + (clnum % 0x1000), clnum & 0xFF, clnum, IS_VALID | IS_WRITE | IS_MEM | 8))
+  write_trace(fn, changes)
+
+  # saving doesn't read back what spilled during ingest
+  qiradb.set_memory_budget(64*1024)
+  try:
+    before = qiradb.get_memory_stats()
+    t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=fn+"_index")
+    wait_until(lambda: os.path.isfile(fn+"_index"))
+    stats = qiradb.get_memory_stats()
+    assert stats['spills'] > before['spills'] and stats['reloads'] == before['reloads']
+  finally:
+    qiradb.set_memory_budget(0)
+  assert t.get_maxclnum() == 19999
+  expected = t.fetch_memory(12345, 0x10000, 0x1000)
+  del t
+
+  # the sealed parts stay in the index file until a query needs them
+  before = qiradb.get_memory_stats()
+  t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=fn+"_index")
+  wait_for(t, 19999)
+  loaded = qiradb.get_memory_stats()
+  assert loaded['spilled_bytes'] > before['spilled_bytes'] and loaded['reloads'] == before['reloads']
+  assert t.fetch_memory(12345, 0x10000, 0x1000) == expected
+  assert t.fetch_clnums_by_address_and_type(0x1000, 'I', 0, 20000, 0) == list(range(20000))
+  after = qiradb.get_memory_stats()
+  assert after['reloads'] > loaded['reloads'] and after['spilled_bytes'] < loaded['spilled_bytes']
+
+def write_trace(fn, changes, first_clnum=0, parent_id=-1):
+  # a minimal log, the header is the change count and then the first clnum, parent and pid
+  with open(fn, "wb") as f:
+    f.write(struct.pack("IIIIii", len(changes)+1, 0, 0, first_clnum, parent_id, 0))
+    for (address, data, clnum, flags) in changes:
+      f.write(struct.pack("QQII", address, data, clnum, flags))
+
+IS_VALID = 0x80000000
+IS_WRITE = 0x40000000
+IS_MEM = 0x20000000
+IS_START = 0x10000000
+
+def test_memory_keyframes():
+  fn = os.path.join(temp_dir(), "0")
+
+  # enough stores to one page to cut several keyframes
+  random.seed(1)
+  changes = []
+  model = []
+  for clnum in range(20000):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    address = 0x10000 + random.randrange(0x1010)
+    data = random.randrange(0x100)
+    changes.append((address, data, clnum, IS_VALID | IS_WRITE | IS_MEM | 8))
+    model.append((address, data))
+  write_trace(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 19999)
+
+  for clnum in [0, 4095, 4096, 5000, 12345, 19999]:
+    mem = {}
+    for (address, data) in model[:clnum+1]:
+      mem[address] = data
+    expected = [(0x100 | mem[a]) if a in mem else 0 for a in range(0xfff0, 0x11020)]
+    assert t.fetch_memory(clnum, 0xfff0, 0x1030) == expected
+
+def test_registers_range():
+  t = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False)
+  wait_for(t, 116)
+
+  ret = t.fetch_registers_range(100, 117)
+  assert ret.shape == (17, 9)
+  for i in range(17):
+    assert list(ret[i]) == t.fetch_registers(100+i)
+
+def test_raw_changes():
+  t = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False)
+  wait_for(t, 116)
+
+  raw = t.fetch_raw_changes(2, 3)
+  mv = memoryview(raw)
+  assert mv.format == qiradb.CHANGE_FORMAT
+  assert mv.itemsize == 0x20 and mv.shape == (len(raw),)
+  changes = [struct.unpack("QQQII", mv.tobytes()[i:i+0x20]) for i in range(0, mv.nbytes, 0x20)]
+  assert [(a, d, c) for (a, d, c, f, p) in changes] == \
+    [(x['address'], x['data'], x['clnum']) for x in t.fetch_changes_by_clnum(2, LIMIT)]
+
+  # the whole log
+  assert len(t.fetch_raw_changes()) == 50462
+
+def test_changes_range():
+  t = qiradb.PyTrace("qira_tests/bin/hello_trace", 0, 4, 9, False)
+  wait_for(t, 116)
+
+  # the instruction flow in one call
+  ret = t.fetch_changes_range(0, 117, "I", 1)
+  assert list(ret['clnum']) == list(range(1, 117))
+  assert ret['type'] == "I"*116
+  assert ret['address'][1] == t.fetch_changes_by_clnum(2, 1)[0]['address']
+
+  ret = t.fetch_changes_range(2, 3, "RW")
+  expected = [c for c in t.fetch_changes_by_clnum(2, LIMIT) if c['type'] in "RW"]
+  assert list(ret['address']) == [c['address'] for c in expected]
+  assert list(ret['data']) == [c['data'] for c in expected]
+  assert ret['type'] == ''.join(c['type'] for c in expected)
+
+def test_parallel_ingest():
+  fn = os.path.join(temp_dir(), "0")
+
+  # big enough for the ingest to split up, with stores crossing pages
+  random.seed(2)
+  changes = []
+  for clnum in range(40000):
+    changes.append((0x1000 + clnum*4, 4, clnum, IS_VALID | IS_START))
+    changes.append((random.randrange(9)*4, clnum, clnum, IS_VALID | IS_WRITE | 32))
+    changes.append((0x10ffc + random.randrange(0x3000), random.randrange(2**64), clnum, IS_VALID | IS_WRITE | IS_MEM | 64))
+  write_trace(fn, changes)
+
+  ts = []
+  for ingest_threads in [1, 4]:
+    t = qiradb.PyTrace(fn, 0, 4, 9, False, ingest_threads=ingest_threads)
+    wait_for(t, 39999)
+    ts.append(t)
+
+  (t1, t4) = ts
+  assert t1.get_pmaps() == t4.get_pmaps()
+  for clnum in [0, 1000, 39999]:
+    assert t1.fetch_registers(clnum) == t4.fetch_registers(clnum)
+    assert t1.fetch_memory(clnum, 0x10ff0, 0x3020) == t4.fetch_memory(clnum, 0x10ff0, 0x3020)
+  for address in [0, 4, 0x1000, 0x1004, 0x11000]:
+    for typ in "IW":
+      assert t1.fetch_clnums_by_address_and_type(address, typ, 0, 40000, 0) == \
+             t4.fetch_clnums_by_address_and_type(address, typ, 0, 40000, 0)
+  assert t4.fetch_clnums_by_address_and_type(0x1004, 'I', 0, 40000, 0) == [1]
+  assert len(t4.fetch_changes_range(0, 40000, "I", 1)['clnum']) == 40000
+
+def test_posting_lists():
+  fn = os.path.join(temp_dir(), "0")
+
+  # thousands of loads of one address, and one that shows up late
+  changes = []
+  model = []
+  for clnum in range(3000):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    if clnum % 3 == 0:
+      changes.append((0x5000, 1, clnum, IS_VALID | IS_MEM | 32))
+      changes.append((0x5000, 1, clnum, IS_VALID | IS_MEM | 32))
+      model.append(clnum)
+  changes.append((0x5000, 1, 1000, IS_VALID | IS_MEM | 32))
+  changes.append((0x5000, 1, 1001, IS_VALID | IS_MEM | 32))
+  model = sorted(set(model + [1000, 1001]))
+  write_trace(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 2999)
+  time.sleep(0.1)
+
+  assert t.fetch_clnums_by_address_and_type(0x5000, 'L', 0, 3000, 0) == model
+  for (start, end, limit) in [(0, 3000, 10), (384, 390, 0), (385, 1500, 200), (999, 1003, 0), (1001, 3000, 1), (3000, 4000, 0)]:
+    expected = [x for x in model if start <= x < end]
+    if limit != 0:
+      expected = expected[:limit]
+    assert t.fetch_clnums_by_address_and_type(0x5000, 'L', start, end, limit) == expected
+  assert t.fetch_clnums_by_address_and_type(0x1000, 'I', 0, 3000, 0) == list(range(3000))
+
+def test_short_posting_lists():
+  fn = os.path.join(temp_dir(), "0")
+
+  # lists of one to four clnums, the first two are kept without blocks, and late ones on short lists
+  model = {}
+  changes = []
+  for clnum in range(100):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    for n in range(1, 5):
+      if clnum % 10 == 0 and clnum // 10 < n:
+        changes.append((0x6000 + n, 1, clnum, IS_VALID | IS_MEM | 8))
+        model.setdefault(0x6000 + n, []).append(clnum)
+  for (address, clnum) in [(0x6001, 5), (0x6002, 95), (0x6002, 3)]:
+    changes.append((address, 1, clnum, IS_VALID | IS_MEM | 8))
+    model[address] = sorted(model[address] + [clnum])
+  write_trace(fn, changes)
+
+  for index_filename in [fn+"_index", fn+"_index"]:
+    t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=index_filename)
+    wait_for(t, 99)
+    time.sleep(0.1)
+    for (address, clnums) in model.items():
+      assert t.fetch_clnums_by_address_and_type(address, 'L', 0, 100, 0) == clnums
+      for (start, end, limit) in [(0, 100, 1), (1, 100, 0), (0, 10, 0), (10, 11, 0), (11, 100, 2)]:
+        expected = [x for x in clnums if start <= x < end]
+        if limit != 0:
+          expected = expected[:limit]
+        assert t.fetch_clnums_by_address_and_type(address, 'L', start, end, limit) == expected
+      for clnum in [0, 1, 10, 11, 31, 100]:
+        before = [x for x in clnums if x < clnum]
+        assert t.fetch_clnum_before(address, 'L', clnum) == (before[-1] if before else None)
+    del t
+
+def test_wait_for_update():
+  fn = os.path.join(temp_dir(), "0")
+  write_trace(fn, [(0x1000, 4, clnum, IS_VALID | IS_START) for clnum in range(10)])
+
+  seq = qiradb.wait_for_update(0, 0)
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  start = time.time()
+  while t.get_maxclnum() != 9:
+    seq = qiradb.wait_for_update(seq, 1.0)
+    assert time.time() - start < 5
+
+  # the tracer appends and then bumps the count in the header
+  with open(fn, "r+b") as f:
+    f.seek(0, 2)
+    for clnum in range(10, 20):
+      f.write(struct.pack("QQII", 0x1000, 4, clnum, IS_VALID | IS_START))
+    f.seek(0)
+    f.write(struct.pack("I", 21))
+  start = time.time()
+  while t.get_maxclnum() != 19:
+    seq = qiradb.wait_for_update(seq, 1.0)
+    assert time.time() - start < 5
+
+def test_epochs():
+  fn = os.path.join(temp_dir(), "0")
+  write_trace(fn, [])
+
+  # queries while the trace grows see all of an epoch and nothing past it
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  with open(fn, "r+b") as f:
+    for step in range(20):
+      f.seek(0, 2)
+      for clnum in range(step*500, (step+1)*500):
+        f.write(struct.pack("QQII", 0x1000, 4, clnum, IS_VALID | IS_START))
+        f.write(struct.pack("QQII", 0, clnum, clnum, IS_VALID | IS_WRITE | 32))
+      f.seek(0)
+      f.write(struct.pack("I", (step+1)*1000+1))
+      f.flush()
+      for i in range(20):
+        before = t.get_maxclnum()
+        clnums = t.fetch_clnums_by_address_and_type(0x1000, 'I', 0, 100000, 0)
+        regs = t.fetch_registers(100000)
+        after = t.get_maxclnum()
+        assert clnums == list(range(len(clnums)))
+        assert before + 1 <= len(clnums) <= after + 1 or (before == 0 and clnums == [])
+        assert before <= regs[0] <= after
+  wait_for(t, 9999)
+
+def test_fork():
+  d = temp_dir()
+
+  # the parent writes eax and a byte at every clnum, the fork starts at 50 and writes something else
+  changes = []
+  for clnum in range(100):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    changes.append((0, clnum, clnum, IS_VALID | IS_WRITE | 32))
+    changes.append((0x5000 + clnum, clnum, clnum, IS_VALID | IS_WRITE | IS_MEM | 8))
+  write_trace(os.path.join(d, "0"), changes, 1)
+  changes = []
+  for clnum in range(50, 80):
+    changes.append((0x2000, 4, clnum, IS_VALID | IS_START))
+    changes.append((4, clnum, clnum, IS_VALID | IS_WRITE | 32))
+    changes.append((0x5000 + clnum, 0xff, clnum, IS_VALID | IS_WRITE | IS_MEM | 8))
+  write_trace(os.path.join(d, "1"), changes, 50, 0)
+
+  parent = qiradb.PyTrace(os.path.join(d, "0"), 0, 4, 9, False)
+  child = qiradb.PyTrace(os.path.join(d, "1"), 1, 4, 9, False)
+  assert child.get_parent_id() == 0 and parent.get_parent_id() == -1
+  child.set_parent(parent)
+  wait_for(parent, 99)
+  wait_for(child, 79)
+
+  # the fork's own range doesn't change
+  assert child.get_minclnum() == 50
+
+  # before the fork it's the parent
+  assert child.fetch_registers(20)[0:2] == [20, 0]
+  assert child.fetch_memory(20, 0x5000, 0x40) == parent.fetch_memory(20, 0x5000, 0x40)
+  assert child.fetch_changes_by_clnum(20, 0) == parent.fetch_changes_by_clnum(20, 0)
+
+  # after it, the fork's writes over the parent's state at the fork
+  assert child.fetch_registers(60)[0:2] == [49, 60]
+  mem = child.fetch_memory(60, 0x5000, 0x60)
+  assert mem[0:50] == [0x100 | i for i in range(50)]
+  assert mem[50:61] == [0x1ff]*11
+  assert mem[61:] == [0]*(0x60-61)
+
+  regs = child.fetch_registers_range(45, 55)
+  assert [regs[i, 0] for i in range(10)] == [45, 46, 47, 48, 49, 49, 49, 49, 49, 49]
+  assert [regs[i, 1] for i in range(10)] == [0]*5 + [50, 51, 52, 53, 54]
+
+  assert child.fetch_clnums_by_address_and_type(0x1000, 'I', 40, 60, 0) == list(range(40, 50))
+  assert child.fetch_clnums_by_address_and_type(0x2000, 'I', 40, 60, 0) == list(range(50, 60))
+  assert child.fetch_clnums_by_address_and_type(0x5000+45, 'S', 0, 100, 0) == [45]
+  assert child.fetch_clnums_by_address_and_type(0x5000+55, 'S', 0, 100, 0) == [55]
+  assert child.fetch_clnum_before(0, 'W', 70) == 49
+  assert child.fetch_clnum_before(4, 'W', 70) == 69
+
+  ch = child.fetch_changes_range(48, 52, "I")
+  assert list(ch["clnum"]) == [48, 49, 50, 51]
+  assert list(ch["address"]) == [0x1000, 0x1000, 0x2000, 0x2000]
+
+  assert 0x1000 in child.get_pmaps() and 0x2000 in child.get_pmaps()
+
+def test_fork_diff():
+  d = temp_dir()
+
+  def step(clnum, branched):
+    if branched:
+      return [(0x3000, 4, clnum, IS_VALID | IS_START),
+              (4, clnum, clnum, IS_VALID | IS_WRITE | 32),
+              (0x6000 + clnum, 0xff, clnum, IS_VALID | IS_WRITE | IS_MEM | 8)]
+    return [(0x1000 + (clnum % 4)*4, 4, clnum, IS_VALID | IS_START),
+            (0, clnum, clnum, IS_VALID | IS_WRITE | 32),
+            (0x5000 + (clnum % 0x40), clnum & 0xFF, clnum, IS_VALID | IS_WRITE | IS_MEM | 8)]
+
+  # the fork at 100 takes another path for 120-129 and 140-141, and an exact copy that stops early
+  write_trace(os.path.join(d, "0"), sum([step(c, False) for c in range(200)], []))
+  write_trace(os.path.join(d, "1"), sum([step(c, 120 <= c < 130 or c in (140, 141)) for c in range(100, 160)], []), 100, 0)
+  write_trace(os.path.join(d, "2"), sum([step(c, False) for c in range(100, 150)], []), 100, 0)
+
+  parent = qiradb.PyTrace(os.path.join(d, "0"), 0, 4, 9, False)
+  child = qiradb.PyTrace(os.path.join(d, "1"), 1, 4, 9, False)
+  copy = qiradb.PyTrace(os.path.join(d, "2"), 2, 4, 9, False)
+  child.set_parent(parent)
+  copy.set_parent(parent)
+  wait_for(parent, 199)
+  wait_for(child, 159)
+  wait_for(copy, 149)
+
+  ret = child.diff(parent, clnums=[110, 135])
+  assert ret['first_clnum'] == 120
+  assert ret['branches'] == [(120, 0x3000, 0x1000), (140, 0x3000, 0x1000)]
+  assert child.diff(parent, limit=1)['branches'] == [(120, 0x3000, 0x1000)]
+  assert child.diff(parent, clstart=130)['first_clnum'] == 140
+  assert ret['states'][110] == {'registers': [], 'memory': []}
+  assert ret['states'][135]['registers'] == [(1, 129, 0)]
+  expected = []
+  for page in [0x5000, 0x6000]:
+    mine, theirs = child.fetch_memory(135, page, 0x1000), parent.fetch_memory(135, page, 0x1000)
+    expected += [(page+i, mine[i], theirs[i]) for i in range(0x1000) if mine[i] != theirs[i]]
+  assert ret['states'][135]['memory'] == expected
+  assert (0x6000 + 125, 0x1ff, 0) in expected
+
+  # siblings share what's before the fork, and a copy only differs where it stops
+  assert copy.diff(child)['first_clnum'] == 120
+  assert copy.diff(parent) == {'first_clnum': 150, 'branches': [], 'states': {}}
+  assert copy.diff(parent, clend=150)['first_clnum'] is None
+  assert parent.diff(parent, clnums=[50])['states'][50] == {'registers': [], 'memory': []}
+
+def test_pc_summary():
+  d = temp_dir()
+
+  # a loop body that runs every time, a branch taken a third of the time, and code that runs once
+  random.seed(3)
+  changes = []
+  for clnum in range(20000):
+    pc = 0x1000 + random.choice([0, 4, 8, 8, 8, 0xc]) if clnum > 0 else 0x2000
+    changes.append((pc, 4, clnum, IS_VALID | IS_START))
+  # out of order, and once already in the list
+  again = [c for (pc, _, c, _) in changes if pc == 0x1004][10]
+  changes.append((0x1004, 4, 5, IS_VALID | IS_START))
+  changes.append((0x1004, 4, again, IS_VALID | IS_START))
+  write_trace(os.path.join(d, "0"), changes)
+  # a fork at 15000 that only runs the loop body
+  write_trace(os.path.join(d, "1"), [(0x1008, 4, clnum, IS_VALID | IS_START) for clnum in range(15000, 16000)], 15000, 0)
+
+  t = qiradb.PyTrace(os.path.join(d, "0"), 0, 4, 9, False)
+  fork = qiradb.PyTrace(os.path.join(d, "1"), 1, 4, 9, False)
+  fork.set_parent(t)
+  wait_for(t, 19999)
+  wait_for(fork, 15999)
+  time.sleep(0.1)
+
+  def expected(trace, lo, hi, start, end):
+    ret = {}
+    for pc in range(lo, hi, 4):
+      clnums = trace.fetch_clnums_by_address_and_type(pc, 'I', start, end, 0)
+      if clnums:
+        ret[pc] = (len(clnums), clnums[0], clnums[-1])
+    return ret
+
+  assert t.fetch_pc_summary(0x2000, 0x2010) == {0x2000: (1, 0, 0)}
+  for (start, end) in [(0, 2**64-1), (0, 20000), (1, 2), (5, 6), (100, 9000), (777, 13001), (19990, 30000)]:
+    assert t.fetch_pc_summary(0x1000, 0x1010, start, end) == expected(t, 0x1000, 0x1010, start, end)
+  assert fork.fetch_pc_summary(0x1000, 0x3000) == expected(fork, 0x1000, 0x3000, 0, 16000)
+  assert fork.fetch_pc_summary(0x1008, 0x100c)[0x1008][2] == 15999
+
+def test_chunked_log():
+  fn = os.path.join(temp_dir(), "0")
+
+  # small chunks so clnums straddle them, and clnums past 32 bits
+  base = 0x100000000
+  changes = []
+  for i in range(1000):
+    changes.append((0x1000 + i, 4, base+i, IS_VALID | IS_START))
+    changes.append((0, base+i, base+i, IS_VALID | IS_WRITE | 32))
+    changes.append((0x20000 + (i % 0x100), i & 0xFF, base+i, IS_VALID | IS_WRITE | IS_MEM | 8))
+  qira_log.write_log(fn, changes, chunk_shift=8, first_clnum=base)
+  assert os.path.isfile(fn + "_chunk_11")
+  assert qira_log.read_log(fn) == changes
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, base+999)
+  assert t.get_minclnum() == base
+
+  assert t.fetch_clnums_by_address_and_type(0x1000 + 500, 'I', 0, base+1000, 0) == [base+500]
+  assert t.fetch_registers(base+700)[0] == base+700
+  assert [c['address'] for c in t.fetch_changes_by_clnum(base+85, LIMIT)] == [0x1000 + 85, 0, 0x20000 + 85]
+  assert t.fetch_memory(base+999, 0x20000 + 231, 1) == [0x100 | 0xE7]
+  assert t.fetch_memory(base+500, 0x20000 + 244, 1) == [0x100 | 0xF4]
+
+  ret = t.fetch_changes_range(base, base+1000, "I")
+  assert list(ret['clnum']) == list(range(base, base+1000))
+  raw = t.fetch_raw_changes(base+80, base+90)
+  assert qira_log.parse_changes(raw) == changes[80*3:90*3]
+  # past a chunk it's a piece per chunk instead of a copy, clnum c starts at entry 3*c+1 after the header
+  parts = t.fetch_raw_change_chunks(base+80, base+500)
+  assert [len(raw) for raw in parts] == [256-241, 256, 256, 256, 256, 500*3+1 - 5*256]
+  assert sum([qira_log.parse_changes(raw) for raw in parts], []) == changes[80*3:500*3]
+
+def test_memory_far_clnums():
+  fn = os.path.join(temp_dir(), "0")
+
+  # stores to one page further apart than the 44 bits a delta keeps, and one that shows up late
+  clnums = [5, 1 << 44, (1 << 44) + 6, 1 << 50, (1 << 50) + 1]
+  changes = [(0x10000 + i, i + 1, clnum, IS_VALID | IS_WRITE | IS_MEM | 8) for (i, clnum) in enumerate(clnums)]
+  changes.append((0x10010, 0xAA, (1 << 44) + 2, IS_VALID | IS_WRITE | IS_MEM | 8))
+  qira_log.write_log(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, (1 << 50) + 1)
+  def expected(clnum):
+    ret = [0]*0x20
+    for (address, data, c, flags) in changes:
+      if c <= clnum:
+        ret[address - 0x10000] = 0x100 | data
+    return ret
+  for clnum in [4, 5, (1 << 44) - 1, 1 << 44, (1 << 44) + 2, (1 << 44) + 5, (1 << 50), (1 << 50) + 1]:
+    assert t.fetch_memory(clnum, 0x10000, 0x20) == expected(clnum)
+
+def test_compressed_log():
+  d = temp_dir()
+
+  # a v2 log archived in blocks smaller than its chunks
+  changes = []
+  for i in range(1000):
+    changes.append((0x1000 + i, 4, i, IS_VALID | IS_START))
+    changes.append((0x20000 + (i % 0x100), i & 0xFF, i, IS_VALID | IS_WRITE | IS_MEM | 8))
+  qira_log.write_log(os.path.join(d, "0"), changes, chunk_shift=10)
+  qira_log.compress_log(os.path.join(d, "0"), os.path.join(d, "1"), chunk_shift=8)
+  fn = os.path.join(d, "1")
+  assert os.path.getsize(fn) < len(changes)*qira_log.CHANGE_SIZE
+  assert qira_log.read_logstate(fn) == (len(changes)+1, 0, -1, 8)
+  assert qira_log.read_log(fn) == changes
+  assert qira_log.read_log(fn, 700, 100) == changes[699:799]
+
+  t = qiradb.PyTrace(fn, 1, 4, 9, False)
+  wait_for(t, 999)
+  assert t.fetch_clnums_by_address_and_type(0x1000 + 500, 'I', 0, 1000, 0) == [500]
+  assert t.fetch_memory(999, 0x20000 + 231, 1) == [0x100 | 0xE7]
+  raw = t.fetch_raw_changes(600, 610)
+  assert qira_log.parse_changes(raw) == changes[600*2:610*2]
+
+  # and a v1 log reads the same as the original
+  qira_log.compress_log("qira_tests/bin/hello_trace", os.path.join(d, "2"))
+  t = qiradb.PyTrace(os.path.join(d, "2"), 2, 4, 9, False)
+  wait_for(t, 116)
+  assert qira_log.read_log(os.path.join(d, "2")) == qira_log.read_log("qira_tests/bin/hello_trace")
+
+def test_value_index():
+  fn = os.path.join(temp_dir(), "0")
+
+  changes = []
+  for clnum in range(300):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    changes.append((0x20000 + clnum, 0x41414100 | (clnum % 0x10), clnum, IS_VALID | IS_WRITE | IS_MEM | 32))
+    changes.append((0x30000, clnum * 3, clnum, IS_VALID | IS_MEM | 32))
+    changes.append((0, clnum * 5, clnum, IS_VALID | IS_WRITE | 32))
+  write_trace(fn, changes)
+
+  for index_filename in [None, fn+"_index", fn+"_index"]:
+    t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=index_filename, value_index=True)
+    wait_for(t, 299)
+
+    # stored, loaded and written to a register
+    assert t.fetch_clnums_by_value(0x41414103) == [c for c in range(300) if c % 0x10 == 3]
+    assert t.fetch_clnums_by_value(15) == [3, 5]
+    assert t.fetch_clnums_by_value(15, types="L") == [5]
+    assert t.fetch_clnums_by_value(15, types="W") == [3]
+    assert t.fetch_clnums_by_value(0x41414100, mask=0xFFFFFF00, types="S") == list(range(300))
+    assert t.fetch_clnums_by_value(0x41414105, clstart=100, clend=200, limit=3) == [101, 117, 133]
+    assert t.fetch_clnums_by_value(0x12345678) == []
+    del t
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 299)
+  assert t.fetch_clnums_by_value(15) == []
+
+def test_search_memory():
+  fn = os.path.join(temp_dir(), "0")
+
+  changes = []
+  def store(clnum, address, dat):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    for i, b in enumerate(bytearray(dat)):
+      changes.append((address+i, b, clnum, IS_VALID | IS_WRITE | IS_MEM | 8))
+  store(0, 0x10000, b"hello world")
+  store(1, 0x10ffc, b"hello across")     # crosses into the next page
+  store(2, 0x30000, b"hello")
+  store(3, 0x10000, b"HELLO")
+  write_trace(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 3)
+
+  assert t.search_memory(0, b"hello") == [0x10000]
+  assert t.search_memory(2, b"hello") == [0x10000, 0x10ffc, 0x30000]
+  assert t.search_memory(3, b"hello") == [0x10ffc, 0x30000]
+  assert t.search_memory(-1, b"o acr") == [0x11000]
+  assert t.search_memory(2, b"hello", limit=2) == [0x10000, 0x10ffc]
+  assert t.search_memory(2, b"hello", [(0x10001, 0x20000)]) == [0x10ffc]
+  assert t.search_memory(2, b"hello", [(0x11000, 0x40000)]) == [0x30000]
+  # never written isn't zero
+  assert t.search_memory(2, b"\x00") == []
+
+def test_changes_in_range():
+  fn = os.path.join(temp_dir(), "0")
+
+  # a 0x40 byte struct at 0x10000, with stores all around it
+  changes = []
+  for clnum in range(100):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    changes.append((0x10000 - 0x40 + (clnum*4) % 0xC0, clnum, clnum, IS_VALID | IS_WRITE | IS_MEM | 32))
+    changes.append((0x10000 + (clnum % 0x10)*4, clnum, clnum, IS_VALID | IS_MEM | 32))
+  # reaches into the struct from before it, and one that stops right before it
+  changes.append((0x1000, 4, 100, IS_VALID | IS_START))
+  changes.append((0x10000 - 4, 0x1122334455667788, 100, IS_VALID | IS_WRITE | IS_MEM | 64))
+  changes.append((0x1000, 4, 101, IS_VALID | IS_START))
+  changes.append((0x10000 - 4, 0x11223344, 101, IS_VALID | IS_WRITE | IS_MEM | 32))
+  write_trace(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 101)
+
+  expected = [c for c in changes if c[3] & IS_WRITE and c[0] < 0x10040 and c[0] + (c[3] & 0xFF)//8 > 0x10000]
+  ret = t.fetch_changes_in_range(0x10000, 0x10040)
+  assert list(zip(ret['address'], ret['data'], ret['clnum'])) == [(a, d, c) for (a, d, c, f) in expected]
+  assert ret['type'] == "S"*len(expected)
+  assert ret['clnum'][-1] == 100
+
+  ret = t.fetch_changes_in_range(0x10000, 0x10040, "S", 20, 60, 5)
+  assert list(ret['clnum']) == [c for (a, d, c, f) in expected if 20 <= c < 60][:5]
+
+  ret = t.fetch_changes_in_range(0x10010, 0x10014, "L")
+  assert list(ret['clnum']) == [c for c in range(100) if c % 0x10 == 4]
+
+def test_page_heatmap():
+  fn = os.path.join(temp_dir(), "0")
+
+  # code on one page, a stack page hit all the time, and a heap page only in the second half
+  changes = []
+  for clnum in range(10000):
+    changes.append((0x1000 + (clnum % 0x100), 4, clnum, IS_VALID | IS_START))
+    changes.append((0x7000, clnum, clnum, IS_VALID | IS_WRITE | IS_MEM | 32))
+    if clnum >= 5000:
+      changes.append((0x9000, clnum, clnum, IS_VALID | IS_MEM | 32))
+  # small chunks, so it's ingested in many batches and the buckets widen along the way
+  qira_log.write_log(fn, changes, chunk_shift=10)
+
+  for index_filename in [fn+"_index", fn+"_index"]:
+    t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=index_filename)
+    wait_for(t, 9999)
+
+    ret = t.get_page_heatmap(0, 10000, 2)
+    assert sorted(ret.keys()) == [0x1000, 0x7000, 0x9000]
+    assert sum(ret[0x1000]) == 10000 and sum(ret[0x7000]) == 10000
+    assert ret[0x9000] == [0, 5000]
+    # 4096 buckets over 10000 clnums are 4 clnums wide
+    ret = t.get_page_heatmap(0, 10000, 100)
+    assert ret[0x7000] == [100]*100
+    ret = t.get_page_heatmap(2000, 3000, 10)
+    assert ret[0x7000] == [100]*10 and 0x9000 not in ret
+    del t
+
+def test_memory_budget():
+  fn = os.path.join(temp_dir(), "0")
+
+  # many segments of one page and a long posting list, and a store that shows up late
+  random.seed(2)
+  changes = []
+  model = []
+  for clnum in range(20000):
+    changes.append((0x1000, 4, clnum, IS_VALID | IS_START))
+    address = 0x10000 + random.randrange(0xff8)
+    data = random.randrange(1 << 64)
+    changes.append((address, data, clnum, IS_VALID | IS_WRITE | IS_MEM | 64))
+    model += [(clnum, address+i, (data >> (i*8)) & 0xFF) for i in range(8)]
+  changes.append((0x10005, 0xAB, 100, IS_VALID | IS_WRITE | IS_MEM | 8))
+  model.append((100, 0x10005, 0xAB))
+  model.sort(key=lambda x: x[0])
+  write_trace(fn, changes)
+
+  qiradb.set_memory_budget(64*1024)
+  try:
+    for index_filename in [fn+"_index", fn+"_index"]:
+      t = qiradb.PyTrace(fn, 0, 4, 9, False, index_filename=index_filename)
+      wait_for(t, 19999)
+      time.sleep(0.1)
+
+      for clnum in [19999, 0, 100, 5000, 12345, 100]:
+        mem = dict((address, data) for (c, address, data) in model if c <= clnum)
+        expected = [(0x100 | mem[a]) if a in mem else 0 for a in range(0x10000, 0x11000)]
+        assert t.fetch_memory(clnum, 0x10000, 0x1000) == expected
+      assert t.fetch_clnums_by_address_and_type(0x1000, 'I', 0, 20000, 0) == list(range(20000))
+      assert t.fetch_clnums_by_address_and_type(0x1000, 'I', 9000, 9010, 0) == list(range(9000, 9010))
+
+      # queries on other threads read segments back in and spill them at the same time
+      expected = dict((clnum, t.fetch_memory(clnum, 0x10000, 0x1000)) for clnum in [0, 100, 5000, 12345, 19999])
+      errors = []
+      def reader(seed):
+        r = random.Random(seed)
+        for i in range(20):
+          clnum = r.choice(sorted(expected))
+          if t.fetch_memory(clnum, 0x10000, 0x1000) != expected[clnum]:
+            errors.append(clnum)
+      threads = [threading.Thread(target=reader, args=(i,)) for i in range(4)]
+      for th in threads:
+        th.start()
+      for th in threads:
+        th.join()
+      assert errors == []
+
+      stats = qiradb.get_memory_stats()
+      assert stats['budget'] == 64*1024 and stats['resident_bytes'] <= 64*1024
+      assert stats['spills'] > 0 and stats['reloads'] > 0 and stats['spilled_bytes'] > 0
+      del t
+  finally:
+    qiradb.set_memory_budget(0)
+
+def test_depth_map():
+  d = qiradb.PyDepthMap()
+  d.set_call(0x10)
+  d.set_call(0x30)
+  # call, call, the inner one returns, clnum 5 is missing, the outer one returns
+  ret = d.add([0x10, 0x100, 0x30, 0x200], [2, 4, 2, 4], [0, 1, 2, 3])
+  assert ret.typecode == 'i' and list(ret) == [0, 1, 1, 2, 2]
+  assert list(d.add(array('Q', [0x32, 0x12]), array('Q', [4, 4]), array('Q', [4, 6]))) == [1, -1, 0, 0]
+  # a return address that's on the stack twice only pops the last one
+  assert list(d.add([0x10, 0x10, 0x10, 0x12], [2, 2, 2, 4], [7, 8, 9, 10])) == [0, 1, 2, 2, 2]
+  assert list(d.add([0x12], [4], [11])) == [1, 1]
+
+  # the call takes the branch delay slot with it
+  d = qiradb.PyDepthMap(branch_delay_slots=True)
+  d.set_call(0x10)
+  assert list(d.add([0x10, 0x14, 0x100, 0x18], [4, 4, 4, 4], [0, 1, 2, 3])) == [0, 0, 1, 0, 0]
+
+def test_slice():
+  fn = os.path.join(temp_dir(), "0")
+
+  IS_LOAD = IS_VALID | IS_MEM | 32
+  IS_STORE = IS_VALID | IS_WRITE | IS_MEM | 32
+  IS_READ = IS_VALID | 32
+  IS_REG_WRITE = IS_VALID | IS_WRITE | 32
+  changes = []
+  for (clnum, rest) in enumerate([
+      [(0, 1, IS_REG_WRITE)],
+      [(0x2000, 2, IS_STORE)],
+      [(0, 1, IS_READ), (4, 3, IS_REG_WRITE)],
+      [(0x2000, 2, IS_LOAD), (4, 3, IS_READ), (8, 4, IS_REG_WRITE)],
+      [(0x2000, 5, IS_STORE)],
+      [(0x2000, 5, IS_LOAD), (0, 5, IS_REG_WRITE)],
+      # esp
+      [(8, 4, IS_READ), (0x10, 6, IS_READ), (0x10, 7, IS_REG_WRITE)],
+      [(0x10, 7, IS_READ)]]):
+    changes.append((0x1000 + clnum*4, 4, clnum, IS_VALID | IS_START))
+    changes += [(address, data, clnum, flags) for (address, data, flags) in rest]
+  write_trace(fn, changes)
+
+  t = qiradb.PyTrace(fn, 0, 4, 9, False)
+  wait_for(t, 7)
+
+  assert t.fetch_clnum_before(0x2000, 'S', 5) == 4
+  assert t.fetch_clnum_before(0x2000, 'S', 4) == 1
+  assert t.fetch_clnum_before(0x2000, 'S', 1) is None
+
+  def full(clnum, forward=False, ignore_registers=()):
+    s = t.slice(clnum, forward, ignore_registers)
+    ret = s.step(0, 0)
+    assert s.done()
+    return sorted(ret)
+  assert full(3) == [0, 1, 2]
+  assert full(5) == [4]
+  assert full(6, ignore_registers=[0x10]) == [0, 1, 2, 3]
+  assert full(7) == [0, 1, 2, 3, 6]
+  assert full(7, ignore_registers=[0x10]) == []
+  assert full(1, True) == [3, 6, 7]
+  assert full(1, True, [0x10]) == [3, 6]
+  assert full(4, True) == [5]
+
+  # a step at a time
+  s = t.slice(7)
+  got = []
+  while not s.done():
+    step = s.step(1)
+    assert len(step) > 0 or s.done()
+    got += step
+  assert sorted(got) == [0, 1, 2, 3, 6]
@@ -90,8 +90,10 @@ static inline void _perror_exit(const char *s) {
 
 #ifdef TARGET_WINDOWS
 #define atomic_postinc32(x) (InterlockedIncrement((long volatile*)(x))-1)
+#define atomic_postinc64(x) (InterlockedIncrement64((LONGLONG volatile*)(x))-1)
 #else
 #define atomic_postinc32(x) __sync_fetch_and_add((x), 1)
+#define atomic_postinc64(x) __sync_fetch_and_add((x), 1)
 #endif
 
 #ifdef TARGET_WINDOWS
@@ -241,20 +243,29 @@ static inline void mmap_unmap(void *buf, size_t size) {
 #define IS_SYSCALL  0x08000000
 #define SIZE_MASK   0xFF
 
+// v2 log: N is just the header, the changes are in N_chunk_0, N_chunk_1, ...
+// 1<<LOG_CHUNK_SHIFT entries per chunk, entry 0 is the header slot
+#define LOG_MAGIC "QIRALOG2"
+#define LOG_CHUNK_SHIFT 20
+#define LOG_CHUNK_ENTRIES ((uint64_t)1 << LOG_CHUNK_SHIFT)
+
 struct logstate {
-	uint32_t change_count;
-	uint32_t changelist_number;
+	char magic[8];
+	uint64_t change_count;
+	uint64_t changelist_number;
+	uint64_t first_changelist_number;
 	uint32_t is_filtered;
-	uint32_t first_changelist_number;
-	uint32_t parent_id;
-	uint32_t this_pid;
+	uint32_t chunk_shift;
+	int32_t parent_id;
+	int32_t this_pid;
 };
 
 struct change {
 	uint64_t address;
 	uint64_t data;
-	uint32_t changelist_number;
+	uint64_t changelist_number;
 	uint32_t flags;
+	uint32_t padding;
 };
 
 ////////////////////////////////////////////////////////////////
@@ -298,11 +309,25 @@ class Thread_State {
 
 	FILE *strace_file;
 
+	char path[2100];
+	int path_len;
 	MMAPFILE file_handle;
 	void *logstate_region;
-	void *mapped_region;
-	size_t mapped_region_start;
-	size_t mapped_region_end;
+	MMAPFILE chunk_handle;
+	struct change *chunk_region;
+	uint64_t chunk_number;
+
+	void map_chunk(uint64_t chunk) {
+		if(chunk_region) {
+			mmap_unmap(chunk_region, LOG_CHUNK_ENTRIES*sizeof(struct change));
+			mmap_close(chunk_handle);
+		}
+		// the whole chunk is sized up front, qira only reads up to change_count
+		snprintf(path+path_len, sizeof(path) - path_len, "_chunk_%llu", (unsigned long long)chunk);
+		chunk_handle = mmap_open(path);
+		chunk_region = static_cast<struct change *>(mmap_map(chunk_handle, LOG_CHUNK_ENTRIES*sizeof(struct change), 0));
+		chunk_number = chunk;
+	}
 
 public:
 	static inline Thread_State *get(THREADID tid) {
@@ -312,33 +337,35 @@ public:
 		return get(PIN_ThreadId());
 	}
 	
-	Thread_State(uint32_t fileid, uint32_t parent, uint32_t chglist) : qira_fileid(fileid) {
-		char path[2100];
-		int len = snprintf(path, sizeof path, "%s/%u", KnobOutputDir.Value().c_str(), qira_fileid);
-		file_handle = mmap_open(path);
-		
-		mapped_region_start = 0;
-		mapped_region_end = ALLOC_GRAN; // Initial size
-		mapped_region = mmap_map(file_handle, mapped_region_end - mapped_region_start, mapped_region_start);
-		logstate_region = mmap_map(file_handle, sizeof(struct logstate), 0);
-		
-		snprintf(path+len, sizeof(path) - len, "_strace");
+	Thread_State(uint32_t fileid, uint32_t parent, uint64_t chglist) : qira_fileid(fileid), chunk_region(NULL) {
+		path_len = snprintf(path, sizeof path, "%s/%u", KnobOutputDir.Value().c_str(), qira_fileid);
+		map_chunk(0);
+
+		snprintf(path+path_len, sizeof(path) - path_len, "_strace");
 		strace_file = fopen(path, "wb");
 		if(!strace_file) perror_exit("fopen");
-		
+
+		// the header goes last, qira waits on the magic
+		path[path_len] = '\0';
+		file_handle = mmap_open(path);
+		logstate_region = mmap_map(file_handle, sizeof(struct logstate), 0);
+
 		struct logstate *log = logstate();
 		log->change_count = 1;
 		log->changelist_number = chglist;
 		log->is_filtered = 1;
 		log->first_changelist_number = chglist;
+		log->chunk_shift = LOG_CHUNK_SHIFT;
 		log->parent_id = parent;
 		log->this_pid = qira_fileid;
+		memcpy(log->magic, LOG_MAGIC, sizeof(log->magic));
 	}
 
 	~Thread_State() {
 		mmap_unmap(logstate_region, sizeof(struct logstate));
-		mmap_unmap(mapped_region, mapped_region_end - mapped_region_start);
 		mmap_close(file_handle);
+		mmap_unmap(chunk_region, LOG_CHUNK_ENTRIES*sizeof(struct change));
+		mmap_close(chunk_handle);
 		fclose(strace_file);
 	}
 
@@ -348,29 +375,11 @@ public:
 		return static_cast<struct logstate *>(logstate_region);
 	}
 
-	// Get a change, shifting (and expanding) the loaded region of the file as necessary
-	inline struct change *change(size_t i) {
-		size_t target = sizeof(struct change) * (i+1); // +1 because first "change" is actually a header.
-		register size_t endtarget = target + sizeof(struct change);
-		if(endtarget > mapped_region_end) { // Ran out of space, shift the mapped_region frame forward.
-			size_t region_size = mapped_region_end - mapped_region_start;
-			mmap_unmap(mapped_region, region_size);
-
-			const register size_t behind = 32*sizeof(struct change); // Overlap the old region a bit. Seems prudent.
-			mapped_region_start = target > behind ? target - behind : 0;
-			mapped_region_start &= ALLOC_GRAN_MASK;
-			region_size = region_size*3/2 + 2*ALLOC_GRAN; // Allocate more space than we did last time.
-			region_size &= ALLOC_GRAN_MASK;
-
-			// Clip to maximum 512 MB.
-			if(region_size > (512<<20)) region_size = (512<<20);
-			if(endtarget > mapped_region_start+region_size) { // Bizarre edge case that won't happen.
-				region_size = (endtarget - mapped_region_start + ALLOC_GRAN) & ALLOC_GRAN_MASK;
-			}
-			mapped_region_end = mapped_region_start + region_size;
-			mapped_region = mmap_map(file_handle, region_size, mapped_region_start);
-		}
-		return reinterpret_cast<struct change *>((char*)mapped_region + target - mapped_region_start);
+	// Get a change, moving on to the next chunk file as necessary
+	inline struct change *change(uint64_t i) {
+		uint64_t entry = i+1; // +1 because first "change" is actually a header.
+		if((entry >> LOG_CHUNK_SHIFT) != chunk_number) map_chunk(entry >> LOG_CHUNK_SHIFT);
+		return &chunk_region[entry & (LOG_CHUNK_ENTRIES-1)];
 	}
 
 	// TODO: Maybe need to do something smart to not screw up on forks
@@ -391,7 +400,7 @@ class Process_State {
 	PIN_LOCK lock;
 	uint32_t main_id; // lol
 	volatile uint32_t threads_created;
-	volatile uint32_t changelist_number;
+	volatile uint64_t changelist_number;
 	FILE *base_file;
 
 public:
@@ -466,8 +475,8 @@ public:
 
 	void thread_fini(THREADID tid) {}
 
-	inline int claim_changelist_number() {
-		return atomic_postinc32(&changelist_number);
+	inline uint64_t claim_changelist_number() {
+		return atomic_postinc64(&changelist_number);
 	}
 
 	inline int base_printf(const char *fmt, ...) {
@@ -758,7 +767,7 @@ VOID SyscallEntry(THREADID tid, CONTEXT *ctx, SYSCALL_STANDARD std, VOID *v) {
 	tls->syscall = sys_nr;
 	if(sys_nr < MAX_SYSCALL_NUM) {
 		tls->nargs = syscalls[sys_nr].nargs;
-		state->strace_printf("%u %u %s(", state->logstate()->changelist_number, state->logstate()->this_pid, syscalls[sys_nr].name);
+		state->strace_printf("%llu %u %s(", (unsigned long long)state->logstate()->changelist_number, state->logstate()->this_pid, syscalls[sys_nr].name);
 		for(int i = 0; i < syscalls[sys_nr].nargs; i++) {
 			if(isMac && i >= 6) {
 				// Avoids "REG_SysCallArgReg: 163: Syscall arg 6th should be taken from stack."
@@ -794,8 +803,8 @@ VOID SyscallEntry(THREADID tid, CONTEXT *ctx, SYSCALL_STANDARD std, VOID *v) {
 		for(int i = 0; i < 6; i++) {
 			tls->arg[i] = PIN_GetSyscallArgument(ctx, std, i);
 		}
-		state->strace_printf("%u %u %lu(%p, %p, %p, %p, %p, %p) = ",
-			state->logstate()->changelist_number, state->logstate()->this_pid, sys_nr,
+		state->strace_printf("%llu %u %lu(%p, %p, %p, %p, %p, %p) = ",
+			(unsigned long long)state->logstate()->changelist_number, state->logstate()->this_pid, sys_nr,
 			(void*)tls->arg[0], (void*)tls->arg[1], (void*)tls->arg[2],
 			(void*)tls->arg[3], (void*)tls->arg[4], (void*)tls->arg[5]
 		);
@@ -172,6 +172,8 @@ window.onkeydown = function(e) {
   } else if (e.keyCode == 'U'.charCodeAt(0)) {  // u, make undefined
     stream.emit('make', 'undefined', Session.get("iaddr"));
     Session.set("flat", Session.get("flat"));
+  } else if (e.keyCode == 'S'.charCodeAt(0)) {  // s, flag the slice back, shift-s forward
+    do_slice(e.shiftKey);
   } else if (e.keyCode == 38) {
     Session.set("clnum", Session.get("clnum")-1);
   } else if (e.keyCode == 40) {
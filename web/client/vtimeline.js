@@ -1,36 +1,65 @@
 stream = io.connect(STREAM_URL);
 
 // *** the analysis overlay ***
+// the server renders the depth map as tiles at the level of detail of the view, they're asked for
+// when the view or the trace changes
 var overlays = {};
 
 function update_picture(forknum) {
   var vt = $('#vtimeline'+forknum);
   if (vt.length == 0) return;
-  vt.css('background-image', "");
-  if (overlays[forknum] === undefined) return;
   var cview = Session.get("cview");
   if (cview === undefined) return;
   var maxclnum = Session.get("max_clnum");
   if (maxclnum === undefined) return;
+  var cscale = get_cscale();
+  if (cscale === undefined) return;
 
   var max = maxclnum[forknum];
+  if (max === undefined) return;
+
+  if (overlays[forknum] === undefined) overlays[forknum] = {};
+  var overlay = overlays[forknum];
+  var request = [cview[0], cview[1], cscale];
+  if (overlay['request'] === undefined || overlay['request'].join() != request.join()) {
+    overlay['request'] = request;
+    stream.emit('getvtimeline', forknum, cview, cscale);
+  }
 
-  var loading_scale = ((overlays[forknum][1]-overlays[forknum][0])*1.0)/(max[1]-max[0]);
-
-  vt.css('background-image', "url('"+overlays[forknum][2]+"')");
-  // so it looks like size is applied before position, hence we divide position by cscale
-  var cscale = get_cscale();
-  vt.css('background-size', "100% " + (max[1] / cscale) * loading_scale + "px")
-  vt.css('background-position-y', -1*((Math.max(max[0],cview[0])-max[0])/cscale) + "px");
+  var tiles = overlay['tiles'];
+  if (tiles === undefined || tiles.length == 0) {
+    vt.css('background-image', "");
+    return;
+  }
+  var top = Math.max(max[0], cview[0]);
+  var images = [], sizes = [], positions = [];
+  for (var i = 0; i < tiles.length; i++) {
+    images.push("url('"+tiles[i]['data']+"')");
+    sizes.push("100% " + ((tiles[i]['clend'] - tiles[i]['clstart']) / cscale) + "px");
+    positions.push(((tiles[i]['clstart'] - top) / cscale) + "px");
+  }
+  vt.css('background-image', images.join(", "));
+  vt.css('background-size', sizes.join(", "));
+  vt.css('background-position-y', positions.join(", "));
   vt.css('background-repeat', "no-repeat");
+  // a row is at least a pixel, when it's more it stays sharp
+  vt.css('image-rendering', "pixelated");
 }
 
-function on_setpicture(msg) { DS("setpicture");
-  //p(msg);
-  forknum = msg['forknum'];
-  overlays[forknum] = [msg['minclnum'], msg['maxclnum'], msg['data']];
+function on_vtimelinetiles(msg) { DS("vtimelinetiles");
+  var forknum = msg['forknum'];
+  if (overlays[forknum] === undefined) return;
+  overlays[forknum]['tiles'] = msg['tiles'];
+  update_picture(forknum);
+} stream.on('vtimelinetiles', on_vtimelinetiles);
+
+function on_vtimelineupdate(msg) { DS("vtimelineupdate");
+  var forknum = msg['forknum'];
+  if (overlays[forknum] === undefined) overlays[forknum] = {};
+  // the trace grew, ask again
+  delete overlays[forknum]['request'];
   update_picture(forknum);
-} stream.on('setpicture', on_setpicture);
+} stream.on('vtimelineupdate', on_vtimelineupdate);
 
 // *** functions for dealing with the zoom function ***
 
@@ -376,6 +405,29 @@ function on_changes(msg) { DS("changes");
   redraw_flags();
 } stream.on('changes', on_changes);
 
+// the slice that's flagged, what comes in for any other is dropped
+var slice_of = undefined;
+
+// public, no var
+do_slice = function (forward) {
+  var forknum = Session.get("forknum");
+  var clnum = Session.get("clnum");
+  slice_of = [forknum, clnum, forward].join(",");
+  remove_flags("slice");
+  redraw_flags();
+  stream.emit('doslice', forknum, clnum, forward);
+};
+
+function on_slice(msg) { DS("slice");
+  // it comes in pieces as it's found
+  if ([msg['forknum'], msg['clnum'], msg['forward']].join(",") != slice_of) return;
+  var clnums = msg['clnums'];
+  for (var i = 0; i < clnums.length; i++) {
+    add_flag("slice", msg['forknum'], clnums[i]);
+  }
+  redraw_flags();
+} stream.on('slice', on_slice);
+
 // fix the resize problem
 window.onresize = redraw_flags;
 